@@ -79,15 +79,8 @@ class HierarchicalMemoryManager(BaseMemoryManager):
             self.load(re_init)
 
     def init_tb(self, do_init: bool=None):
-        tb_dict = {"TbaseHandler": TbaseHandler}
-        tb_class =  tb_dict.get(self.tb_config.tb_type, TbaseHandler)
-        tbase_args = {
-            "host": self.tb_config.host,
-            "port": self.tb_config.port,
-            "username": self.tb_config.username,
-            "password": self.tb_config.password,
-        }
-        self.vb = tb_class(tbase_args, self.tb_config.index_name, tb_config=self.tb_config)
+        # handlers of the same tbase share one connection pool
+        self.vb = get_tbase_handler(self.tb_config, self.tb_config.index_name)
 
     def init_gb(self, do_init: bool=None):
         gb_dict = {"NebulaHandler": NebulaHandler, "NetworkxHandler": NetworkxHandler}
@@ -1,8 +1,9 @@
 from abc import abstractmethod, ABC
-from typing import List, Dict
-import os, sys, copy, json, uuid, random
+from typing import List, Dict, Union
+import os, sys, copy, json, uuid, random, hashlib, threading, zlib, base64, atexit, weakref
+from concurrent.futures import ThreadPoolExecutor
 from jieba.analyse import extract_tags
-from collections import Counter
+from collections import Counter, OrderedDict
 from loguru import logger
 import numpy as np
 
@@ -243,6 +244,8 @@ class LocalMemoryManager(BaseMemoryManager):
         self.tb_config = tb_config
         self.do_init = do_init
         self.kb_root_path = kb_root_path
+        # all sessions in one vector store, searched with a chat_index filter, instead of one store per session
+        self.shared_kb_name: str = self.vb_config.extra_kwargs.get("shared_kb_name")
         self.embed_config: EmbedConfig = embed_config
         self.llm_config: LLMConfig = llm_config
 
@@ -283,15 +286,8 @@ class LocalMemoryManager(BaseMemoryManager):
             self.load(re_init)
 
     def init_tb(self, do_init: bool=None):
-        tb_dict = {"TbaseHandler": TbaseHandler}
-        tb_class =  tb_dict.get(self.tb_config.tb_type, TbaseHandler)
-        tbase_args = {
-            "host": self.tb_config.host,
-            "port": self.tb_config.port,
-            "username": self.tb_config.username,
-            "password": self.tb_config.password,
-        }
-        self.vb = tb_class(tbase_args, self.tb_config.index_name)
+        # handlers of the same tbase share one connection pool
+        self.vb = get_tbase_handler(self.tb_config, self.tb_config.index_name)
 
     def init_gb(self, do_init: bool=None):
         pass
@@ -330,7 +326,7 @@ class LocalMemoryManager(BaseMemoryManager):
             save_to_json_file(json_messages, self.uuid_file)
 
         if self.embed_config:
-            self.vb.add_docs(docs, kb_name=self.kb_name)
+            self.vb.add_docs(docs, kb_name=self.shared_kb_name or self.kb_name)
 
     def extend(self, memory: Memory):
         for message in memory.messages:
@@ -403,6 +399,13 @@ class LocalMemoryManager(BaseMemoryManager):
 
         if text is None: return []
 
+        if self.shared_kb_name:
+            docs = self.vb.search(
+                text, top_k=top_k, score_threshold=score_threshold, kb_name=self.shared_kb_name,
+                filter={"chat_index": chat_index}
+            )
+            return [Message(**doc.metadata) for doc, score in docs]
+
         kb_name = self.get_vbname_from_chatindex(chat_index)
         docs = self.vb.search(text, top_k=top_k, score_threshold=score_threshold, kb_name=kb_name)
         return [Message(**doc.metadata) for doc, score in docs]
@@ -551,6 +554,24 @@ MESSAGE_SCHEMA = [
     TagField(name='keyword', separator='|')
 ]
 
+# write-behind managers which still may hold buffered messages
+_OPEN_MANAGERS: "weakref.WeakSet[TbaseMemoryManager]" = weakref.WeakSet()
+
+
+@atexit.register
+def close_memory_managers():
+    for manager in list(_OPEN_MANAGERS):
+        try:
+            manager.close()
+        except Exception as e:
+            logger.error(f"close memory manager failed: {e}")
+
+
+def _stop_events(*events: threading.Event):
+    for event in events:
+        event.set()
+
+
 class TbaseMemoryManager(BaseMemoryManager):
 
     def __init__(
@@ -563,6 +584,12 @@ class TbaseMemoryManager(BaseMemoryManager):
             do_init: bool = False,
             tbase_handler: TbaseHandler = None,
             use_vector: bool = False,
+            embedding_cache_size: int = 1024,
+            write_behind: bool = False,
+            flush_size: int = 100,
+            flush_interval: float = 1.0,
+            compaction_interval: float = None,
+            session_idle_time: float = 3600,
         ):
         self.user_name = user_name
         self.unique_name = unique_name
@@ -576,8 +603,48 @@ class TbaseMemoryManager(BaseMemoryManager):
             'parsed_output', 'parsed_output_list', 'customed_kargs', "db_docs", "code_docs", "search_docs", 'start_datetime', 'end_datetime', 
             "keyword", "vector", "role_tags"
         ]
+        # 读取 message 时不取回 vector
+        self.return_message_keys = [k for k in self.save_message_keys if k != "vector"]
         self.use_vector = use_vector
+        # query embedding lru cache, (embed model, text hash) -> vector bytes
+        self.embedding_cache_size = embedding_cache_size
+        self.embedding_cache: OrderedDict = OrderedDict()
+        self._embedding_cache_lock = threading.Lock()
+        # embedding computation overlaps with keyword search in hybrid_retrieval
+        self.retrieval_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="memory_retrieval")
+        # write-behind buffer, chat_index -> {message_index: message}, reads of buffered messages are served from it
+        self.write_behind = write_behind
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._write_buffer: Dict[str, OrderedDict] = {}
+        self._inflight_buffer: Dict[str, OrderedDict] = {}
+        self._buffer_lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        # one flusher thread per manager: _flush_pending wakes it when the buffer gets a message,
+        # it then waits flush_interval seconds unless _flush_now is set by a full buffer or close()
+        self._flush_pending = threading.Event()
+        self._flush_now = threading.Event()
+        self._flush_stop = threading.Event()
+        self._flush_thread: threading.Thread = None
+        # sessions idle for session_idle_time are folded into one summary record every compaction_interval seconds
+        self.compaction_interval = compaction_interval
+        self.session_idle_time = session_idle_time
+        self._compaction_stop = threading.Event()
+        self._compaction_thread: threading.Thread = None
         self.init_tb()
+        # the background threads only hold a weakref to the manager, they stop once it is collected
+        weakref.finalize(
+            self, _stop_events, self._flush_stop, self._flush_pending, self._flush_now, self._compaction_stop
+        ).atexit = False
+        if self.compaction_interval:
+            self.start_compaction()
+        if self.write_behind:
+            self._flush_thread = threading.Thread(
+                target=self._flush_loop, args=(weakref.ref(self), self._flush_pending, self._flush_now, self._flush_stop),
+                name="memory_flush", daemon=True)
+            self._flush_thread.start()
+            # buffered messages are written before the interpreter exits
+            _OPEN_MANAGERS.add(self)
 
     def re_init(self, do_init: bool=False):
         self.init_tb(do_init)
@@ -589,14 +656,240 @@ class TbaseMemoryManager(BaseMemoryManager):
             logger.info(res)
 
     def append(self, message: Message) -> None:
+        if self.write_behind:
+            self._buffer_message(message)
+            return
+
         tbase_message = self.localMessage2TbaseMessage(message)
         # logger.debug(f"{type(tbase_message)}\n{tbase_message}")
         self.th.insert_data_hash(tbase_message)
+        if self.compaction_interval:
+            self.th.touch_sessions([message.chat_index])
 
     def extend(self, memory: Memory):
         for message in memory.messages:
             self.append(message)
 
+    def _buffer_message(self, message: Message):
+        '''
+        coalesce the message into the write buffer, a later message with the same message_index replaces the earlier one.
+        the flusher thread writes the buffer flush_interval seconds after its first message,
+        or right away when it holds flush_size messages
+        '''
+        with self._buffer_lock:
+            messages = self._write_buffer.setdefault(message.chat_index, OrderedDict())
+            messages.pop(message.message_index, None)
+            messages[message.message_index] = message.copy(deep=True)
+            buffer_size = sum(len(v) for v in self._write_buffer.values())
+        self._flush_pending.set()
+        if buffer_size >= self.flush_size:
+            self._flush_now.set()
+
+    @staticmethod
+    def _flush_loop(manager_ref: weakref.ref, pending: threading.Event, now: threading.Event, stop: threading.Event):
+        while not stop.is_set():
+            pending.wait()
+            manager = manager_ref()
+            if manager is None:
+                return
+            flush_interval = manager.flush_interval
+            del manager
+            now.wait(flush_interval)
+            pending.clear()
+            now.clear()
+            manager = manager_ref()
+            if manager is None:
+                return
+            try:
+                manager.flush()
+            except Exception as e:
+                logger.error(f"flush memory failed: {e}")
+            del manager
+
+    def close(self):
+        '''write the buffered messages and stop the background threads, later appends are written through'''
+        self.stop_compaction()
+        if self.retrieval_executor is not None:
+            self.retrieval_executor.shutdown(wait=False)
+            self.retrieval_executor = None
+        if self._flush_thread is not None:
+            self._flush_stop.set()
+            self._flush_pending.set()
+            self._flush_now.set()
+            self._flush_thread.join()
+            self._flush_thread = None
+        self.write_behind = False
+        self.flush()
+        _OPEN_MANAGERS.discard(self)
+
+    def flush(self) -> int:
+        '''
+        write the buffered messages into tbase by one pipelined insert, failed messages stay in the buffer
+        :return: the number of written messages
+        '''
+        with self._flush_lock:
+            with self._buffer_lock:
+                self._inflight_buffer, self._write_buffer = self._write_buffer, {}
+                messages = [m for v in self._inflight_buffer.values() for m in v.values()]
+
+            if not messages:
+                return 0
+
+            status = {}
+            try:
+                tbase_messages = [self.localMessage2TbaseMessage(message) for message in messages]
+                status = self.th.bulk_insert_data_hash(tbase_messages)
+                if self.compaction_interval:
+                    self.th.touch_sessions(list({message.chat_index for message in messages}))
+            except Exception as e:
+                logger.error(f"flush memory failed: {e}")
+
+            with self._buffer_lock:
+                failed_messages = [
+                    message for message in messages 
+                    if not status.get(f"{self.th.definition_value}:{message.message_index}", False)
+                ]
+                for message in failed_messages:
+                    # 重新写回 buffer, 除非已被更新的 message 覆盖
+                    buffered = self._write_buffer.setdefault(message.chat_index, OrderedDict())
+                    if message.message_index not in buffered:
+                        buffered[message.message_index] = message
+                self._inflight_buffer = {}
+            if failed_messages:
+                # retried by the flusher after flush_interval
+                self._flush_pending.set()
+            return len(messages) - len(failed_messages)
+
+    def start_compaction(self):
+        '''start the background compaction of finished sessions'''
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return
+        self._compaction_stop.clear()
+        self._compaction_thread = threading.Thread(
+            target=self._compaction_loop, args=(weakref.ref(self), self._compaction_stop, self.compaction_interval),
+            name="memory_compaction", daemon=True)
+        self._compaction_thread.start()
+
+    def stop_compaction(self):
+        self._compaction_stop.set()
+
+    @staticmethod
+    def _compaction_loop(manager_ref: weakref.ref, stop: threading.Event, compaction_interval: float):
+        while not stop.wait(compaction_interval):
+            manager = manager_ref()
+            if manager is None:
+                return
+            try:
+                manager.compact_finished_sessions()
+            except Exception as e:
+                logger.error(f"memory compaction failed: {e}")
+            del manager
+
+    def compact_finished_sessions(self) -> int:
+        '''
+        fold every session without writes for session_idle_time into its summary record
+        :return: the number of compacted sessions
+        '''
+        chat_indexes, cutoff = self.th.idle_sessions(self.session_idle_time)
+        for chat_index in chat_indexes:
+            self.compact_session(chat_index)
+        self.th.remove_idle_sessions(cutoff)
+        return len(chat_indexes)
+
+    def compact_session(self, chat_index: str, digest_size: int = 20) -> int:
+        '''
+        fold the session's messages into one summary record and delete them, 
+        the summary keeps the last digest_size messages as text and all messages zlib-compressed in customed_kargs
+        :return: the number of folded messages
+        '''
+        self.flush()
+        summary_index = f"{chat_index}-summary"
+        memory = self.tbasedoc2Memory(self.th.search_iter(
+            f"@chat_index:{chat_index}", return_fields=self.return_message_keys))
+        messages, message_indexes = [], []
+        for message in memory.messages:
+            if message.chat_index != chat_index: continue
+            if message.message_index == summary_index:
+                # 之前的 summary 一起合并
+                messages = self.decompress_messages(message) + messages
+            else:
+                messages.append(message.dict())
+                message_indexes.append(message.message_index)
+        if not message_indexes:
+            return 0
+
+        compressed = base64.b64encode(zlib.compress(json.dumps(messages, ensure_ascii=False).encode("utf-8")))
+        summary = Message(
+            chat_index=chat_index,
+            message_index=summary_index,
+            user_name=messages[0].get("user_name", "default"),
+            role_name="summary",
+            role_type="summary",
+            role_content="\n".join(
+                f"{m['role_name']}: {m['role_content']}"[:200] for m in messages[-digest_size:]),
+            customed_kargs={"compressed_messages": compressed.decode(), "message_count": len(messages)},
+            start_datetime=messages[0]["start_datetime"],
+            end_datetime=messages[-1]["end_datetime"],
+        )
+        self.th.insert_data_hash(self.localMessage2TbaseMessage(summary))
+        self.th.bulk_delete(message_indexes)
+        return len(message_indexes)
+
+    def decompress_messages(self, summary: Message) -> List[dict]:
+        '''messages folded into a summary record'''
+        compressed = summary.customed_kargs.get("compressed_messages")
+        if not compressed:
+            return []
+        return json.loads(zlib.decompress(base64.b64decode(compressed)).decode("utf-8"))
+
+    def _buffered_messages(self, search_key_contents: dict) -> Union[List[Message], None]:
+        '''
+        buffered messages matching search_key_contents, same filters as get_memory_pool_by_all.
+        return None if the filters can't be evaluated locally, e.g. keyword
+        '''
+        with self._buffer_lock:
+            chat_index = search_key_contents.get("chat_index")
+            messages = {}
+            for buffer in (self._inflight_buffer, self._write_buffer):
+                for k, v in buffer.items():
+                    if chat_index and k != chat_index: continue
+                    messages.update(v)
+
+        if not messages:
+            return []
+        if search_key_contents.get("keyword"):
+            return None
+
+        def _match(message: Message) -> bool:
+            for k, v in search_key_contents.items():
+                if not v: continue
+                if k == "role_tags":
+                    tags = v if isinstance(v, list) else [v]
+                    if not any(tag in message.role_tags for tag in tags):
+                        return False
+                elif k == "start_datetime":
+                    timestamp = dateformatToTimestamp(message.start_datetime, 1000, "%Y-%m-%d %H:%M:%S.%f")
+                    if not (v[0] <= timestamp <= v[1]):
+                        return False
+                else:
+                    value = f"{getattr(message, k, '')}"
+                    if f"{v}" != value and f"{v}" not in value.split():
+                        return False
+            return True
+
+        return [message.copy(deep=True) for message in messages.values() if _match(message)]
+
+    def _overlay_messages(self, memory: Memory, buffered_messages: List[Message]) -> Memory:
+        '''buffered messages take the place of their stale copies in tbase'''
+        if not buffered_messages:
+            return memory
+        message_indexes = {message.message_index for message in buffered_messages}
+        memory = Memory(messages=[
+            message for message in memory.messages if message.message_index not in message_indexes
+        ] + buffered_messages)
+        memory.sort_by_key("end_datetime")
+        return memory
+
     def append_tools(self, tool_information: dict, chat_index: str, nodeid: str, user_name: str) -> None:
         '''
         硬编码逻辑不通用
@@ -649,13 +942,15 @@ class TbaseMemoryManager(BaseMemoryManager):
         ]
         query = f"({')('.join(querys)})" if len(querys) >=2 else "".join(querys)
         logger.debug(f"{query}")
+        buffered_messages = self._buffered_messages({"chat_index": chat_index, "role_tags": tags})
         r = self.th.search(query, limit=limit)
-        return self.tbasedoc2Memory(r)
+        return self._overlay_messages(self.tbasedoc2Memory(r), buffered_messages)
 
     def get_memory_pool(self, chat_index: str = "") -> Memory:
         return self.get_memory_pool_by_all({"chat_index": chat_index})
 
     def get_memory_pool_by_content(self, content: str, ):
+        self.flush()
         r = self.th.search(content)
         return self.tbasedoc2Memory(r)
 
@@ -664,14 +959,16 @@ class TbaseMemoryManager(BaseMemoryManager):
             query = f"@{key}:{{{content}}}"
         else:
             query = f"@{key}:{content}"
+        self.flush()
         r = self.th.search(content)
         return self.tbasedoc2Memory(r)
 
-    def get_memory_pool_by_all(self, search_key_contents: dict, limit: int =10):
+    def get_memory_pool_by_all(self, search_key_contents: dict, limit: int = None):
         '''
         search_key_contents:
             - key: str, key must in message keys
             - value: str, key' value
+        limit: None means all matched messages, read page by page
         '''
         querys = []
         for k, v in search_key_contents.items():
@@ -688,29 +985,99 @@ class TbaseMemoryManager(BaseMemoryManager):
                 querys.append(f"@{k}:{v}")
         
         query = f"({')('.join(querys)})" if len(querys) >=2 else "".join(querys)
-        r = self.th.search(query, limit=limit)
-        return self.tbasedoc2Memory(r)
+        buffered_messages = self._buffered_messages(search_key_contents)
+        if buffered_messages is None:
+            self.flush()
+        if limit is None:
+            r = self.th.search_iter(query, return_fields=self.return_message_keys)
+        else:
+            r = self.th.search(query, limit=limit, return_fields=self.return_message_keys)
+        return self._overlay_messages(self.tbasedoc2Memory(r), buffered_messages)
         
-    def embedding_retrieval(self, text: str, top_k=1, score_threshold=1.0, chat_index: str = "default", **kwargs) -> List[Message]:
+    def router_retrieval(self, 
+        chat_index: str = "default", text: str=None, datetime: str = None, 
+        n=5, top_k=5, retrieval_type: str = "embedding", **kwargs
+    ) -> List[Message]:
+        retrieval_func_dict = {
+            "embedding": self.embedding_retrieval, "text": self.text_retrieval, "datetime": self.datetime_retrieval,
+            "hybrid": self.hybrid_retrieval,
+            }
+        
+        # 确保提供了合法的检索类型
+        if retrieval_type not in retrieval_func_dict:
+            raise ValueError(f"Invalid retrieval_type: '{retrieval_type}'. Available types: {list(retrieval_func_dict.keys())}")
+
+        retrieval_func = retrieval_func_dict[retrieval_type]
+        # 
+        params = locals()
+        params.pop("self")
+        params.pop("retrieval_type")
+        params.update(params.pop('kwargs', {}))
+        # 
+        return retrieval_func(**params)
+
+    def embedding_retrieval(self, text: str, top_k=1, score_threshold=1.0, chat_index: str = "default", query_embedding: bytes = None, **kwargs) -> List[Message]:
         if text is None: return []
-        if not self.use_vector and self.embed_config:
-            logger.error(f"can't use vector search, because the use_vector is {self.use_vector}")
+        if not (self.use_vector and self.embed_config):
+            # messages have no real vectors, skip the knn search
+            logger.error(f"can't use vector search, because the use_vector is {self.use_vector} or embed_config is None")
             return []
         
-        if self.use_vector and self.embed_config:
-            vector_dict = get_embedding(
-                self.embed_config.embed_engine, [text],
-                self.embed_config.embed_model_path, self.embed_config.model_device,
-                self.embed_config
-            )
-            query_embedding = np.array(vector_dict[text]).astype(dtype=np.float32).tobytes()
-        else:
-            query_embedding = np.array([random.random() for _ in range(768)]).astype(dtype=np.float32).tobytes()
-        
+        query_embedding = query_embedding or self.get_query_embedding(text)
+        # knn search can't see buffered messages
+        self.flush()
         base_query = f'(@chat_index:{chat_index})=>[KNN {top_k} @vector $vector AS distance]'
         query_params = {"vector": query_embedding}
-        r = self.th.vector_search(base_query, query_params=query_params)
+        r = self.th.vector_search(
+            base_query, query_params=query_params, return_fields=self.return_message_keys + ["distance"]
+        )
         return self.tbasedoc2Memory(r).messages
+
+    def hybrid_retrieval(self, text: str, top_k=1, chat_index: str = "default", **kwargs) -> List[Message]:
+        '''
+        keyword search while the query embedding is computed, then knn search, 
+        messages from knn search come first
+        '''
+        if text is None: return []
+        use_vector = self.use_vector and self.embed_config
+        # a closed manager computes the embedding inline
+        executor = self.retrieval_executor
+        future = executor.submit(self.get_query_embedding, text) if use_vector and executor is not None else None
+        messages = self.text_retrieval(text, chat_index=chat_index)
+        if not use_vector:
+            return messages
+
+        query_embedding = future.result() if future is not None else self.get_query_embedding(text)
+        vector_messages = self.embedding_retrieval(
+            text, top_k=top_k, chat_index=chat_index, query_embedding=query_embedding)
+        message_indexes = {message.message_index for message in vector_messages}
+        return vector_messages + [message for message in messages if message.message_index not in message_indexes]
+
+    def get_query_embedding(self, text: str) -> bytes:
+        '''
+        query embedding by the embed model, repeated queries are served from the lru cache
+        '''
+        key = (
+            self.embed_config.embed_engine, 
+            self.embed_config.embed_model or self.embed_config.embed_model_path, 
+            hashlib.sha1(text.encode("utf-8")).hexdigest()
+        )
+        with self._embedding_cache_lock:
+            if key in self.embedding_cache:
+                self.embedding_cache.move_to_end(key)
+                return self.embedding_cache[key]
+
+        vector_dict = get_embedding(
+            self.embed_config.embed_engine, [text],
+            self.embed_config.embed_model_path, self.embed_config.model_device,
+            self.embed_config
+        )
+        query_embedding = np.array(vector_dict[text]).astype(dtype=np.float32).tobytes()
+        with self._embedding_cache_lock:
+            self.embedding_cache[key] = query_embedding
+            while len(self.embedding_cache) > self.embedding_cache_size:
+                self.embedding_cache.popitem(last=False)
+        return query_embedding
     
     def text_retrieval(self, text: str, chat_index: str = "default", **kwargs)  -> List[Message]:
         keywords = extract_tags(text, topK=-1)
@@ -720,7 +1087,8 @@ class TbaseMemoryManager(BaseMemoryManager):
         else:
             query = f"@chat_index:{chat_index}"
         # logger.debug(f"text_retrieval query: {query}")
-        r = self.th.search(query)
+        self.flush()
+        r = self.th.search(query, return_fields=self.return_message_keys)
         memory = self.tbasedoc2Memory(r)
         return self._text_retrieval_from_cache(memory.messages, text)
 
@@ -728,6 +1096,7 @@ class TbaseMemoryManager(BaseMemoryManager):
         intput_timestamp = dateformatToTimestamp(datetime, 1000, "%Y-%m-%d %H:%M:%S.%f")
         query = f"(@chat_index:{chat_index})(@{key}:[{intput_timestamp-n*60} {intput_timestamp+n*60}])"
         # logger.debug(f"datetime_retrieval query: {query}")
+        self.flush()
         r = self.th.search(query)
         memory = self.tbasedoc2Memory(r)
         return self._text_retrieval_from_cache(memory.messages, text)
@@ -831,7 +1200,8 @@ class TbaseMemoryManager(BaseMemoryManager):
         convert redis documents to Message
         '''
         memory = Memory()
-        for doc in r_docs.docs:
+        docs = r_docs.docs if hasattr(r_docs, "docs") else r_docs
+        for doc in docs:
             tbase_message = {}
             for k, v in doc.__dict__.items():
                 if k in ["role_content", "input_query"]:
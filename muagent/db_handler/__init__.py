@@ -6,12 +6,14 @@
 @desc:
 '''
 
-from .graph_db_handler import NebulaHandler, NetworkxHandler, AliYunSLSHandler, GeaBaseHandler, GBHandler
-from .vector_db_handler import LocalFaissHandler, TbaseHandler, ChromaHandler
+from .graph_db_handler import NebulaHandler, NetworkxHandler, AliYunSLSHandler, GeaBaseHandler, GBHandler, CachedGBHandler
+from .vector_db_handler import LocalFaissHandler, TbaseHandler, ChromaHandler, \
+    get_tbase_handler, get_connection_pool, tbase_pool_stats
 
 
 __all__ = [
-    "GBHandler", "NebulaHandler", "NetworkxHandler", "GeaBaseHandler", 
+    "GBHandler", "NebulaHandler", "NetworkxHandler", "GeaBaseHandler", "CachedGBHandler", 
     "ChromaHandler", "TbaseHandler", "LocalFaissHandler", 
+    "get_tbase_handler", "get_connection_pool", "tbase_pool_stats",
     "AliYunSLSHandler"
 ]
\ No newline at end of file
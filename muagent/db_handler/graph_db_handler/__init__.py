@@ -10,9 +10,10 @@ from .nebula_handler import NebulaHandler
 from .networkx_handler import NetworkxHandler
 from .aliyun_sls_hanlder import AliYunSLSHandler
 from .geabase_handler import GeaBaseHandler
+from .cached_gb_handler import CachedGBHandler
 
 
 __all__ = [
     "GBHandler", "NebulaHandler", "NetworkxHandler", "GeaBaseHandler",
-    "AliYunSLSHandler"
+    "AliYunSLSHandler", "CachedGBHandler"
 ]
\ No newline at end of file
@@ -1,11 +1,26 @@
 from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
 import uuid
+import threading
 from loguru import logger
 import json
 
 from muagent.schemas.common import *
 
 
+_FETCH_EXECUTOR: ThreadPoolExecutor = None
+_FETCH_EXECUTOR_LOCK = threading.Lock()
+# threads shared by the fetch_nodes_by_ids calls of every handler in the process
+FETCH_EXECUTOR_WORKERS = 8
+
+
+def get_fetch_executor() -> ThreadPoolExecutor:
+    global _FETCH_EXECUTOR
+    with _FETCH_EXECUTOR_LOCK:
+        if _FETCH_EXECUTOR is None:
+            _FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=FETCH_EXECUTOR_WORKERS, thread_name_prefix="gb_fetch")
+        return _FETCH_EXECUTOR
+
 
 
 class GBHandler:
@@ -17,13 +32,31 @@ class GBHandler:
         return self.add_nodes([node])
 
     def add_nodes(self, nodes: List[GNode]) -> GbaseExecStatus:
+        '''the returned status merges the batch, its results hold one GbaseExecStatus per node in input order'''
         pass
 
     def add_edge(self, edge: GEdge) -> GbaseExecStatus:
         return self.add_edges([edge])
 
     def add_edges(self, edges: List[GEdge]) -> GbaseExecStatus:
-        pass
+        '''the returned status merges the batch, its results hold one GbaseExecStatus per edge in input order'''
+        pass
+
+    @staticmethod
+    def merge_exec_status(results: List[GbaseExecStatus]) -> GbaseExecStatus:
+        '''汇总批量执行的状态, 全部成功时返回 GDB_SUCCEED, 否则返回第一个失败状态, results 保留每一项的状态'''
+        failed = [res for res in results if res.errorCode != 0]
+        if failed:
+            return GbaseExecStatus(
+                errorMessage=failed[0].errorMessage, 
+                errorCode=failed[0].errorCode, 
+                results=results
+                )
+        return GbaseExecStatus(
+            errorMessage="GDB_SUCCEED", 
+            errorCode=0, 
+            results=results
+            )
 
     def update_node(self, attributes: dict, set_attributes: dict, node_type: str = None, ID: int = None) -> GbaseExecStatus:
         pass
@@ -52,6 +85,43 @@ class GBHandler:
     def get_nodes_by_ids(self, ids: List[int] = []) -> List[GNode]:
         pass
 
+    def fetch_nodes_by_ids(self, ids: List[int] = [], chunk_size: int = 500, max_workers: int = 4) -> GNodesFetchResult:
+        '''
+        bulk version of get_nodes_by_ids: ids are de-duplicated and split into IN-lists of chunk_size,
+        chunks run as at most max_workers tasks of the shared fetch executor, nodes keep the input order and
+        ids without a node are returned in missing_ids
+        '''
+        unique_ids = list(dict.fromkeys(ids))
+        chunks = [unique_ids[i: i+chunk_size] for i in range(0, len(unique_ids), chunk_size)]
+        if len(chunks) <= 1 or max_workers <= 1:
+            chunk_results = [self.get_nodes_by_ids(chunk) for chunk in chunks]
+        else:
+            # each task fetches its share of the chunks one by one
+            n = min(max_workers, len(chunks))
+            groups = [chunks[i::n] for i in range(n)]
+            chunk_results = [
+                nodes
+                for group_results in get_fetch_executor().map(
+                    lambda group: [self.get_nodes_by_ids(chunk) for chunk in group], groups)
+                for nodes in group_results
+            ]
+
+        # ids may come back as int or str (e.g. from tbase), match both ID and id
+        node_dict = {}
+        for nodes in chunk_results:
+            for node in nodes or []:
+                node_dict.setdefault(str(node.attributes.get("ID")), node)
+                node_dict.setdefault(str(node.id), node)
+
+        result = GNodesFetchResult()
+        for ID in unique_ids:
+            node = node_dict.get(str(ID))
+            if node is None:
+                result.missing_ids.append(ID)
+            else:
+                result.nodes.append(node)
+        return result
+
     def get_current_nodes(self, attributes: dict, node_type: str = None, return_keys: list = []) -> List[GNode]:
         pass
     
@@ -66,3 +136,21 @@ class GBHandler:
 
     def get_hop_infos(self, attributes: dict, node_type: str = None, hop: int = 2, block_attributes: List[dict] = {}, select_attributes: dict = {}, reverse=False) -> Graph:
         pass
+
+    def get_reachable_nodeids(self, attributes: dict, node_type: str = None, hop: int = 15, reverse=False) -> set:
+        '''
+        ids of the nodes within hop steps of the matched nodes (themselves included),
+        every node is expanded once and no paths are built
+        '''
+        visited = set(node.id for node in self.get_current_nodes(attributes, node_type))
+        frontier = list(visited)
+        for _ in range(hop):
+            next_frontier = []
+            for node_id in frontier:
+                for node in self.get_neighbor_nodes({"id": node_id}, reverse=reverse):
+                    if node.id not in visited:
+                        visited.add(node.id)
+                        next_frontier.append(node.id)
+            if not next_frontier: break
+            frontier = next_frontier
+        return visited
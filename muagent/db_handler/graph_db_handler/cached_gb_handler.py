@@ -0,0 +1,320 @@
+import copy
+import time
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Hashable, Callable
+from loguru import logger
+
+from muagent.schemas.common import *
+from muagent.utils.common_utils import double_hashing
+from .base_gb_handler import GBHandler
+
+
+def _freeze(value: Any) -> Hashable:
+    '''convert dict/list into hashable tuples for cache keys'''
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class LRUTTLCache:
+    '''LRU cache with optional ttl, every entry can be tagged for invalidation'''
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._key2tags: Dict[Hashable, set] = {}
+        self._tag2keys: Dict[Hashable, set] = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable):
+        '''return (hit, value)'''
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or (self.ttl and time.time() > item[0]):
+                if item is not None:
+                    self._pop(key)
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True, item[1]
+
+    def set(self, key: Hashable, value: Any, tags: set = set()):
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (time.time() + self.ttl if self.ttl else None, value)
+            self._key2tags[key] = set(tags)
+            for tag in tags:
+                self._tag2keys.setdefault(tag, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._pop(next(iter(self._data)))
+
+    def invalidate(self, tags: set) -> int:
+        '''drop every entry tagged with any of tags, return the number of dropped entries'''
+        with self._lock:
+            keys = set()
+            for tag in tags:
+                keys.update(self._tag2keys.get(tag, set()))
+            for key in keys:
+                self._pop(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._key2tags.clear()
+            self._tag2keys.clear()
+
+    def _pop(self, key: Hashable):
+        self._data.pop(key, None)
+        for tag in self._key2tags.pop(key, set()):
+            keys = self._tag2keys.get(tag)
+            if keys is None: continue
+            keys.discard(key)
+            if not keys:
+                self._tag2keys.pop(tag)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class CachedGBHandler(GBHandler):
+    '''
+    read-through cache in front of any GBHandler, node/neighbor/hop results are cached
+    and write methods only invalidate the entries which touch the written nodes.
+    methods not defined in GBHandler are delegated to the wrapped handler
+    '''
+
+    # entries queried by attributes other than id are tagged by node type,
+    # adding or updating a node of that type may change their result
+    TYPE_TAG = "__node_type__"
+    # entries queried by attributes other than id, any edge write may change their result
+    ATTR_TAG = "__attributes__"
+    # hop results filtered by block/select attributes depend on nodes outside of the result
+    FILTER_TAG = "__hop_filter__"
+
+    def __init__(self, gb_handler: GBHandler, maxsize: int = 10000, ttl: float = 300):
+        self.gb_handler = gb_handler
+        self.cache = LRUTTLCache(maxsize=maxsize, ttl=ttl)
+
+    def __getattr__(self, name: str):
+        if name == "gb_handler":
+            raise AttributeError(name)
+        return getattr(self.gb_handler, name)
+
+    def cache_info(self) -> Dict:
+        return {
+            "hits": self.cache.hits, "misses": self.cache.misses,
+            "size": len(self.cache), "maxsize": self.cache.maxsize, "ttl": self.cache.ttl,
+        }
+
+    def clear_cache(self):
+        self.cache.clear()
+
+    # ---------------- write methods ----------------
+    # entries are dropped before the write and again after it, a read racing with the write
+    # could otherwise cache the old result again right after the first invalidation
+
+    def add_node(self, node: GNode) -> GbaseExecStatus:
+        return self._write(
+            lambda: self._invalidate_nodes([node]),
+            lambda: self.gb_handler.add_node(node))
+
+    def add_nodes(self, nodes: List[GNode]) -> GbaseExecStatus:
+        return self._write(
+            lambda: self._invalidate_nodes(nodes),
+            lambda: self.gb_handler.add_nodes(nodes))
+
+    def add_edge(self, edge: GEdge) -> GbaseExecStatus:
+        return self._write(
+            lambda: self.cache.invalidate({edge.start_id, edge.end_id, self.ATTR_TAG}),
+            lambda: self.gb_handler.add_edge(edge))
+
+    def add_edges(self, edges: List[GEdge]) -> GbaseExecStatus:
+        return self._write(
+            lambda: self.cache.invalidate(
+                set([edge.start_id for edge in edges] + [edge.end_id for edge in edges] + [self.ATTR_TAG])),
+            lambda: self.gb_handler.add_edges(edges))
+
+    def update_node(self, attributes: dict, set_attributes: dict, node_type: str = None, ID: int = None) -> GbaseExecStatus:
+        return self._write(
+            lambda: self._invalidate_by_attributes(attributes, node_type, [ID], filters=True),
+            lambda: self.gb_handler.update_node(attributes, set_attributes, node_type=node_type, ID=ID))
+
+    def update_edge(self, src_id, dst_id, set_attributes: dict, edge_type: str = None) -> GbaseExecStatus:
+        return self._write(
+            lambda: self.cache.invalidate({src_id, dst_id, self.ATTR_TAG}),
+            lambda: self.gb_handler.update_edge(src_id, dst_id, set_attributes, edge_type=edge_type))
+
+    def delete_node(self, attributes: dict, node_type: str = None, ID: int = None) -> GbaseExecStatus:
+        return self._write(
+            lambda: self._invalidate_by_attributes(attributes, node_type, [ID]),
+            lambda: self.gb_handler.delete_node(attributes, node_type=node_type, ID=ID))
+
+    def delete_nodes(self, attributes: dict, node_type: str = None, IDs: List[int] = []) -> GbaseExecStatus:
+        return self._write(
+            lambda: self._invalidate_by_attributes(attributes, node_type, IDs),
+            lambda: self.gb_handler.delete_nodes(attributes, node_type=node_type, IDs=IDs))
+
+    def delete_edge(self, src_id, dst_id, edge_type: str = None) -> GbaseExecStatus:
+        return self._write(
+            lambda: self.cache.invalidate({src_id, dst_id, self.ATTR_TAG}),
+            lambda: self.gb_handler.delete_edge(src_id, dst_id, edge_type=edge_type))
+
+    def delete_edges(self, id_pairs: List, edge_type: str = None) -> GbaseExecStatus:
+        return self._write(
+            lambda: self.cache.invalidate(set([i for id_pair in id_pairs for i in id_pair] + [self.ATTR_TAG])),
+            lambda: self.gb_handler.delete_edges(id_pairs, edge_type=edge_type))
+
+    def _write(self, invalidate: Callable[[], Any], write: Callable[[], GbaseExecStatus]) -> GbaseExecStatus:
+        invalidate()
+        try:
+            return write()
+        finally:
+            invalidate()
+
+    # ---------------- read methods ----------------
+
+    def get_nodeIDs(self, attributes: dict, node_type: str) -> List[int]:
+        result = self.get_current_nodes(attributes, node_type)
+        return [i.attributes.get("ID") for i in result]
+
+    def get_current_node(self, attributes: dict, node_type: str = None, return_keys: list = []) -> GNode:
+        key = ("current_node", _freeze(attributes), node_type, _freeze(return_keys))
+        return self._cached_call(
+            key, lambda: self.gb_handler.get_current_node(attributes, node_type, return_keys),
+            attributes, node_type,
+        )
+
+    def get_nodes_by_ids(self, ids: List[int] = []) -> List[GNode]:
+        key = ("nodes_by_ids", _freeze(ids))
+        return self._cached_call(
+            key, lambda: self.gb_handler.get_nodes_by_ids(ids), extra_tags=set(ids)
+        )
+
+    def get_current_nodes(self, attributes: dict, node_type: str = None, return_keys: list = []) -> List[GNode]:
+        key = ("current_nodes", _freeze(attributes), node_type, _freeze(return_keys))
+        return self._cached_call(
+            key, lambda: self.gb_handler.get_current_nodes(attributes, node_type, return_keys),
+            attributes, node_type,
+        )
+
+    def get_current_edge(self, src_id, dst_id, edge_type: str = None, return_keys: list = []) -> GEdge:
+        key = ("current_edge", src_id, dst_id, edge_type, _freeze(return_keys))
+        return self._cached_call(
+            key, lambda: self.gb_handler.get_current_edge(src_id, dst_id, edge_type, return_keys),
+            extra_tags={src_id, dst_id}
+        )
+
+    def get_neighbor_nodes(self, attributes: dict, node_type: str = None, return_keys: list = [], reverse=False) -> List[GNode]:
+        key = ("neighbor_nodes", _freeze(attributes), node_type, _freeze(return_keys), reverse)
+        return self._cached_call(
+            key, lambda: self.gb_handler.get_neighbor_nodes(attributes, node_type, return_keys, reverse=reverse),
+            attributes, node_type,
+        )
+
+    def get_neighbor_edges(self, attributes: dict, node_type: str = None, return_keys: list = []) -> List[GEdge]:
+        key = ("neighbor_edges", _freeze(attributes), node_type, _freeze(return_keys))
+        return self._cached_call(
+            key, lambda: self.gb_handler.get_neighbor_edges(attributes, node_type, return_keys),
+            attributes, node_type,
+        )
+
+    def check_neighbor_exist(self, attributes: dict, node_type: str = None, check_attributes: dict = {}) -> bool:
+        result = self.get_neighbor_nodes(attributes, node_type)
+        filter_result = [i for i in result if all([item in i.attributes.items() for item in check_attributes.items()])]
+        return len(filter_result) > 0
+
+    def get_hop_infos(self, attributes: dict, node_type: str = None, hop: int = 2, block_attributes: List[dict] = {}, select_attributes: dict = {}, reverse=False) -> Graph:
+        key = ("hop_infos", _freeze(attributes), node_type, hop, _freeze(block_attributes), _freeze(select_attributes), reverse)
+        return self._cached_call(
+            key,
+            lambda: self.gb_handler.get_hop_infos(
+                attributes, node_type, hop,
+                block_attributes=block_attributes, select_attributes=select_attributes, reverse=reverse
+            ),
+            attributes, node_type,
+            extra_tags={self.FILTER_TAG} if (block_attributes or select_attributes) else set(),
+        )
+
+    def get_hop_nodes(self, attributes: dict, node_type: str = None, hop: int = 2, block_attributes: List[dict] = []) -> List[GNode]:
+        return self.get_hop_infos(attributes, node_type, hop, block_attributes).nodes
+
+    def get_hop_edges(self, attributes: dict, node_type: str = None, hop: int = 2, block_attributes: List[dict] = []) -> List[GEdge]:
+        return self.get_hop_infos(attributes, node_type, hop, block_attributes).edges
+
+    def get_hop_paths(self, attributes: dict, node_type: str = None, hop: int = 2, block_attributes: List[dict] = []) -> List[str]:
+        return self.get_hop_infos(attributes, node_type, hop, block_attributes).paths
+
+    def get_reachable_nodeids(self, attributes: dict, node_type: str = None, hop: int = 15, reverse=False) -> set:
+        # not cached, the backend traversal is a single query and callers keep their own cache
+        return self.gb_handler.get_reachable_nodeids(attributes, node_type, hop, reverse=reverse)
+
+    # ---------------- helpers ----------------
+
+    def _cached_call(self, key, func, attributes: dict = {}, node_type: str = None, extra_tags: set = set()):
+        hit, value = self.cache.get(key)
+        if hit:
+            return copy.deepcopy(value)
+
+        value = func()
+        tags = set(extra_tags) | self._result_tags(value)
+        if "id" in attributes:
+            tags.add(attributes["id"])
+        else:
+            tags.update([(self.TYPE_TAG, node_type), self.ATTR_TAG])
+        self.cache.set(key, copy.deepcopy(value), tags)
+        return value
+
+    def _result_tags(self, value) -> set:
+        '''tag the entry by every node id (and its int ID) and edge endpoint in the result'''
+        if isinstance(value, Graph):
+            items = value.nodes + value.edges
+        elif isinstance(value, list):
+            items = value
+        else:
+            items = [value]
+
+        tags = set()
+        for item in items:
+            if isinstance(item, GNode):
+                tags.add(item.id)
+                if item.attributes.get("ID") is not None:
+                    tags.add(item.attributes["ID"])
+            elif isinstance(item, GEdge):
+                tags.update([item.start_id, item.end_id])
+                for k in ["SRCID", "DSTID"]:
+                    if item.attributes.get(k) is not None:
+                        tags.add(item.attributes[k])
+        return tags
+
+    def _invalidate_nodes(self, nodes: List[GNode]):
+        tags = set()
+        for node in nodes:
+            tags.update([
+                node.id, double_hashing(node.id), (self.TYPE_TAG, node.type), (self.TYPE_TAG, None)])
+            if node.attributes.get("ID") is not None:
+                tags.add(node.attributes["ID"])
+        self.cache.invalidate(tags)
+
+    def _invalidate_by_attributes(self, attributes: dict, node_type: str, IDs: List[int], filters: bool = False):
+        tags = set([ID for ID in IDs if ID is not None])
+        tags.update([(self.TYPE_TAG, node_type), (self.TYPE_TAG, None)])
+        if filters:
+            tags.add(self.FILTER_TAG)
+
+        if (attributes or {}).get("id"):
+            tags.update([attributes["id"], double_hashing(attributes["id"])])
+        elif not tags - {(self.TYPE_TAG, node_type), (self.TYPE_TAG, None), self.FILTER_TAG}:
+            # can't locate the written nodes, drop everything
+            logger.debug("can't locate the written nodes, clear all graph cache")
+            self.cache.clear()
+            return
+        self.cache.invalidate(tags)
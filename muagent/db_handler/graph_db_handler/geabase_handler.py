@@ -10,7 +10,8 @@ except:
     logger.error("ignore this sdk")
 
 from .base_gb_handler import GBHandler
-from muagent.db_handler.utils import deduplicate_dict
+from .query_builder import GeaBaseQueryBuilder
+from muagent.db_handler.utils import bfs_hop_traversal
 from muagent.schemas.db import GBConfig
 from muagent.schemas.common import *
 from muagent.utils.common_utils import double_hashing, func_timer
@@ -37,15 +38,15 @@ class GeaBaseHandler(GBHandler):
                 self.metaserver_address, self.project,self.city,
                 graph_name=self.graph_name
             )
-            self.hop_max = 6
         else:
             self.geabase_client = GeaBaseClient(
                 self.metaserver_address, self.project,self.city,
             )
-            self.hop_max = 8
 
         # option 指定
         self.option = GeaBaseEnv.QueryRequestOption.newBuilder().gqlType(GeaBaseEnv.QueryProtocol.GQLType.GQL_ISO).build()
+        # 按 (label, 属性集合) 缓存语句模板
+        self.query_builder = GeaBaseQueryBuilder()
 
     def execute(self, gql: str, option=None, return_keys: list = []) -> Dict:
         option = option or self.option
@@ -59,51 +60,41 @@ class GeaBaseHandler(GBHandler):
         return self.add_nodes([node])
 
     def add_nodes(self, nodes: List[GNode]) -> GbaseExecStatus:
-        node_str_list = []
+        rows = []
         for node in nodes:
-            node_type = node.type
             node_attributes = {"id": node.id}
             node_attributes["@id"] = node.attributes.pop("ID", "") or double_hashing(node.id)
             node_attributes.update(node.attributes)
+            rows.append((node.type, node_attributes))
 
-            node_str = ", ".join([f"{k}: '{v}'" if isinstance(v, (str, bool)) else f"{k}: {v}" for k, v in node_attributes.items()])
-            node_str_list.append(f"(:{node_type} {{{node_str}}})")
-
-        gql = f"INSERT {','.join(node_str_list)}"
-        return self._get_crud_status(self.execute(gql))
+        gql = self.query_builder.insert_nodes(rows)
+        return self._batch_status(self._get_crud_status(self.execute(gql)), len(nodes))
 
     def add_edge(self, edge: GEdge) -> GbaseExecStatus:
         return self.add_edges([edge])
 
     def add_edges(self, edges: List[GEdge]) -> GbaseExecStatus:
         '''不支持批量edge插入'''
-        edge_str_list = []
+        rows = []
         for edge in edges:
-            edge_type = edge.type
             edge_attributes = {
                 "@src_id": edge.attributes.pop("SRCID", 0) or double_hashing(edge.start_id,),
                 "@dst_id": edge.attributes.pop("DSTID", 0) or double_hashing(edge.end_id,)
             }
             edge_attributes.update(edge.attributes)
+            rows.append((edge.type, edge_attributes))
 
-            edge_str = ", ".join([f"{k}: '{v}'" if isinstance(v, (str, bool)) else f"{k}: {v}" for k, v in edge_attributes.items()])
-            edge_str_list.append(f"()-[:{edge_type} {{{edge_str}}}]->()")
-
-        gql = f"INSERT {','.join(edge_str_list)}"
-        return self._get_crud_status(self.execute(gql))
+        gql = self.query_builder.insert_edges(rows)
+        return self._batch_status(self._get_crud_status(self.execute(gql)), len(edges))
 
     def update_node(self, attributes: dict, set_attributes: dict, node_type: str = None, ID: int = None) -> GbaseExecStatus:
         # demo: "MATCH (n:opsgptkg_employee {@ID: xxxx}) SET n.originname = 'xxx', n.description = 'xxx'"
-        set_str = ", ".join([
-            f"n.{k}='{v}'" if isinstance(v, (str, bool)) else f"n.{k}={v}"
-            for k, v in set_attributes.items()
-            if k not in ["ID"]
-        ])
+        set_attributes = {k: v for k, v in set_attributes.items() if k not in ["ID"]}
 
         if (ID is None) or (not isinstance(ID, int)):
             ID = self.get_current_nodeID(attributes, node_type)
             # ID = double_hashing(ID)
-        gql = f"MATCH (n:{node_type}) WHERE n.@ID={ID} SET {set_str}"
+        gql = self.query_builder.update_node(node_type, ID, set_attributes)
         return self._get_crud_status(self.execute(gql))
 
     def update_edge(self, src_id, dst_id, set_attributes: dict, edge_type: str = None) -> GbaseExecStatus:
@@ -111,13 +102,8 @@ class GeaBaseHandler(GBHandler):
         src_id, dst_id, timestamp = self.get_current_edgeID(src_id, dst_id, edge_type)
         src_type, dst_type = self.get_nodetypes_by_edgetype(edge_type)
         # src_id, dst_id = double_hashing(src_id), double_hashing(dst_id)
-        set_str = ", ".join([
-            f"e.{k}='{v}'"  if isinstance(v, (str, bool)) else f"e.{k}={v}" 
-            for k, v in set_attributes.items()
-        ])
         # demo： MATCH ()-[r:PlayFor{@src_id:1, @dst_id:100, @timestamp:0}]->() SET r.contract = 0;
-        # gql = f"MATCH ()-[e:{edge_type}{{@src_id:{src_id}, @dst_id:{dst_id}, timestamp:{timestamp}}}]->() SET {set_str}"
-        gql = f"MATCH (n0:{src_type} {{@id: {src_id}}})-[e]->(n1:{dst_type} {{@id:{dst_id}}}) SET {set_str}"
+        gql = self.query_builder.update_edge(src_type, dst_type, src_id, dst_id, set_attributes)
         return self._get_crud_status(self.execute(gql))
     
     def delete_node(self, attributes: dict, node_type: str = None, ID: int = None) -> GbaseExecStatus:
@@ -252,49 +238,70 @@ class GeaBaseHandler(GBHandler):
             reverse=False
         ) -> Graph:
         '''
-        hop >= 1
+        hop >= 1, expand level by level with one query per level
         '''
-        hop_max = self.hop_max
-        # 
-        where_str = ' and '.join([f"n0.{k}='{v}'" for k, v in attributes.items()])
+        roots = self.get_current_nodes(attributes, node_type)
+        node_dicts = {
+            node.id: {**{"id": node.id, "type": node.type}, **node.attributes} 
+            for node in roots
+        }
+
+        def _is_blocked(node_id) -> bool:
+            node = node_dicts.get(node_id, {})
+            return any(
+                # 这里block为空时也会生效，属于合理情况
+                block_attribute and all(item in node.items() for item in block_attribute.items())
+                for block_attribute in block_attributes
+            ) or (
+                select_attributes and any(item in node.items() for item in select_attributes.items())
+            )
+
+        def _expand(frontier_ids: List[str]) -> List:
+            gql = self.query_builder.match_neighbors([node_dicts[i]["ID"] for i in frontier_ids], reverse)
+            result = self.decode_result(self.execute(gql), gql)
+            for node in result.get("n1", []):
+                node_dicts.setdefault(node["id"], node)
+
+            return [
+                (edge["end_id"], edge["start_id"], edge) if reverse else (edge["start_id"], edge["end_id"], edge)
+                for edge in result.get("e", [])
+            ]
+
+        visited_ids, edges, paths = bfs_hop_traversal(
+            [node.id for node in roots], _expand, hop, is_blocked=_is_blocked
+        )
+        if not paths:
+            return Graph(nodes=[], edges=[], paths=[])
+
+        path_nodeids = set([j for i in paths for j in i])
+        nodes = self.convert2GNodes([dict(node_dicts[i]) for i in visited_ids if i in path_nodeids])
+        edges = self.convert2GEdges([
+            edge for edge in edges 
+            if edge["start_id"] in path_nodeids and edge["end_id"] in path_nodeids
+        ])
+        # paths keep the edge direction
         if reverse:
-            gql = f"MATCH p = (n0:{node_type} WHERE {where_str})<-[e]-{{0,{min(hop, hop_max)}}}(n1) RETURN n0, n1, e, p"
-        else:
-            gql = f"MATCH p = (n0:{node_type} WHERE {where_str})-[e]->{{0,{min(hop, hop_max)}}}(n1) RETURN n0, n1, e, p"
-        last_node_ids, last_node_types = [], []
-
-        result = {}
-        iter_index = 0
-        while hop >= 1:
-            if last_node_ids == [] and iter_index==0:
-                # 
-                result = self.execute(gql)
-                result = self.decode_result(result, gql)
-            elif last_node_ids == []:
-                pass
-            else:
-                for _node_id, _node_type in zip(last_node_ids, last_node_types):
-                    where_str = f"n0.id='{_node_id}'"
-                    if reverse:
-                        gql = f"MATCH p = (n0:{_node_type} WHERE {where_str})<-[e]-{{1,{min(hop, hop_max)}}}(n1) RETURN n0, n1, e, p"
-                    else:
-                        gql = f"MATCH p = (n0:{_node_type} WHERE {where_str})-[e]->{{1,{min(hop, hop_max)}}}(n1) RETURN n0, n1, e, p"
-                    # 
-                    _result = self.execute(gql)
-                    _result = self.decode_result(_result, gql)
-                    # logger.info(f"p_lens: {_result['p']}")
-        
-                    result = self.merge_hotinfos(result, _result, reverse=reverse)
-            # 
-            last_node_ids, last_node_types, result = self.deduplicate_paths(
-                result, block_attributes, select_attributes, hop=min(hop, hop_max)+iter_index*hop_max, reverse=reverse)
-            hop -= hop_max
-            iter_index += 1
-
-        nodes = self.convert2GNodes(result.get("n1", [])+result.get("n0", []))
-        edges = self.convert2GEdges(result.get("e", []))
-        return Graph(nodes=nodes, edges=edges, paths=result.get("p", []))
+            paths = [path[::-1] for path in paths]
+        return Graph(nodes=nodes, edges=edges, paths=paths)
     
+    def get_reachable_nodeids(self, attributes: dict, node_type: str = None, hop: int = 15, reverse=False) -> set:
+        '''
+        one neighbor query per level which only returns the new nodes, no paths are built
+        '''
+        roots = self.get_current_nodes(attributes, node_type)
+        visited = set(node.id for node in roots)
+        frontier_IDs = [node.attributes["ID"] for node in roots]
+        for _ in range(hop):
+            if not frontier_IDs: break
+            gql = self.query_builder.match_neighbors(frontier_IDs, reverse, return_edges=False)
+            result = self.decode_result(self.execute(gql), gql)
+            frontier_IDs = []
+            for node in result.get("n1", []):
+                if node["id"] not in visited:
+                    visited.add(node["id"])
+                    frontier_IDs.append(node["ID"])
+        return visited
+
     def get_hop_nodes(self, attributes: dict, node_type: str = None, hop: int = 2, block_attributes: List[dict] = []) -> List[GNode]:
         # 
         result = self.get_hop_infos(attributes, node_type, hop, block_attributes)
@@ -310,70 +317,6 @@ class GeaBaseHandler(GBHandler):
         result = self.get_hop_infos(attributes, node_type, hop, block_attributes)
         return result.paths
 
-    def deduplicate_paths(self, result, block_attributes: List[dict] = {}, select_attributes: dict = {}, hop:int=None, reverse=False):
-        # 获取数据
-        n0, n1, e, p = result["n0"], result["n1"], result["e"], result["p"]
-        block_node_ids = [
-            i["id"]
-            for i in n0+n1
-            for block_attribute in block_attributes
-            # 这里block为空时也会生效，属于合理情况
-            # if block_attributes=={} or all(item in i.items() for item in block_attributes.items())
-            if block_attribute and all(item in i.items() for item in block_attribute.items())
-        ] + [
-            i["id"]
-            for i in n0+n1
-            if select_attributes and not all(item not in i.items() for item in select_attributes.items())
-        ]
-        p = [_p for _p in p if all([_pid not in block_node_ids for _pid in _p])]
-        # deduplicate the paths
-        path_strs = ["&&".join(_p) for _p in p]
-        new_p = []
-        add_path_strs = set()
-        for path_str, _p in zip(path_strs, p):
-            if path_str in add_path_strs: continue
-            if not any(path_str in other for other in path_strs if path_str != other):
-                new_p.append(_p)
-                add_path_strs.add(path_str)
-            
-        # 根据保留路径进行合并
-        nodeid2type = {i["id"]: i["type"] for i in n0+n1}
-        unique_node_ids = [j for i in new_p for j in i]
-        if reverse:
-            last_node_ids = list(set([i[0] for i in new_p if len(i)>=hop and i[0] not in i[1:]]))
-        else:
-            last_node_ids = list(set([i[-1] for i in new_p if len(i)>=hop and i[-1] not in i[:-1]]))
-
-        last_node_types = [nodeid2type[i] for i in last_node_ids]
-        new_n0 = deduplicate_dict([i for i in n0 if i["id"] in unique_node_ids])
-        new_n1 = deduplicate_dict([i for i in n1 if i["id"] in unique_node_ids])
-        new_e = deduplicate_dict([i for i in e if i["start_id"] in unique_node_ids and i["end_id"] in unique_node_ids])
-
-        return last_node_ids, last_node_types, {"n0": new_n0, "n1": new_n1, "e": new_e, "p": new_p}
-
-    def merge_hotinfos(self, result1, result2, reverse=False) -> Dict:
-        old_n0_sets = set([n["id"] for n in result1["n0"]])
-        old_n1_sets = set([n["id"] for n in result1["n1"]])
-        new_n0 = result1["n0"] + [n for n in result2["n0"] if n["id"] not in old_n0_sets]
-        new_n1 = result1["n1"] + [n for n in result2["n1"] if n["id"] not in old_n1_sets]
-        new_e = result1["e"] + result2["e"]
-        if reverse:
-            new_p = result1["p"] + [
-                p_old_2[:-1] + p_old_1
-                for p_old_1 in result1["p"] 
-                for p_old_2 in result2["p"] 
-                if p_old_2[-1] == p_old_1[0]
-            ] # + result2["p"]
-        else:
-            new_p = result1["p"] + [
-                p_old_1 + p_old_2[1:]
-                for p_old_1 in result1["p"] 
-                for p_old_2 in result2["p"] 
-                if p_old_2[0] == p_old_1[-1]
-            ] # + result2["p"]
-        new_result = {"n0": new_n0, "n1": new_n1, "e": new_e, "p": new_p}
-        return new_result
-    
     def decode_result(self, geabase_result, gql: str) -> Dict:
         return_keys = gql.split("RETURN")[-1].split(',')
         save_keys = [k.strip() if "." not in k else k.strip().split(".")[0]+".attr" for k in return_keys]
@@ -492,6 +435,13 @@ class GeaBaseHandler(GBHandler):
     def decode_attribute(self, col_data, k) -> Dict:
         return {k: col_data.get("strVal", "") or col_data.get("intVal", "0")}
     
+    def _batch_status(self, status: GbaseExecStatus, count: int) -> GbaseExecStatus:
+        '''a batch is one gql statement, every item shares its status'''
+        status.results = [
+            GbaseExecStatus(errorMessage=status.errorMessage, errorCode=status.errorCode) for _ in range(count)
+        ]
+        return status
+
     def _get_crud_status(self, result: Dict) -> GbaseExecStatus:
         '''Mapping error messages to error codes.'''
         text2code = {
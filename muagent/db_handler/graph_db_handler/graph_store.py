@@ -0,0 +1,529 @@
+from typing import List, Dict, Tuple, Iterable, Hashable
+from array import array
+from contextlib import contextmanager
+import threading
+import shutil
+import json
+import time
+import os
+
+import numpy as np
+
+
+class CSRGraphStore:
+    '''
+    compact in-memory directed graph:
+    - string node ids are interned to int indexes
+    - node/edge attributes are kept column by column (None means missing)
+    - topology is kept as COO edge arrays and compiled into CSR (out and in) on demand,
+      edges written after the last compile live in a small delta adjacency until the next compile,
+      deleted edges are tombstoned and dropped by compact()
+    - secondary hash indexes map value -> node indexes for the configured index_keys
+
+    persistence is a binary snapshot (npy topology arrays plus a json attribute table) and an
+    append-only delta log of the writes made since that snapshot. each snapshot is written into its
+    own version directory with its own log and CURRENT names the live one.
+    with mmap the topology arrays stay read-only memory maps until the first edge write copies the
+    edge arrays, the attribute table and the hash indexes are always loaded into memory
+    '''
+    SNAPSHOT_ARRAYS = ["edge_src", "edge_dst", "out_indptr", "out_eidx", "in_indptr", "in_eidx"]
+    SNAPSHOT_META = "meta.json"
+    DELTA_LOG = "delta.log"
+    CURRENT = "CURRENT"
+    SNAPSHOT_PREFIX = "snapshot-"
+
+    def __init__(self, index_keys: List[str] = ["type", "teamids"], compact_threshold: int = 1024):
+        self.index_keys = list(dict.fromkeys(["ID"] + list(index_keys)))
+        self.compact_threshold = compact_threshold
+        self._lock = threading.RLock()
+        # pending delta log records, None until a snapshot is attached
+        self.journal: List[list] = None
+        self.log_size = 0
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._log("clear")
+            # node table
+            self.nodeid2idx: Dict[str, int] = {}
+            self.nodeids: List[str] = []
+            self.node_types: List[str] = []
+            self.node_alive = bytearray()
+            self.node_columns: Dict[str, List] = {}
+            self.node_count = 0
+            # edge table
+            self.edge_src = array("q")
+            self.edge_dst = array("q")
+            self.edge_types: List[str] = []
+            self.edge_alive = bytearray()
+            self.edge_columns: Dict[str, List] = {}
+            self.edge_key2eidx: Dict[Tuple[int, int, str], int] = {}
+            self.edge_count = 0
+            # secondary indexes
+            self.node_indexes: Dict[str, Dict[Hashable, set]] = {k: {} for k in self.index_keys}
+            self.edge_type_index: Dict[str, set] = {}
+            # csr
+            self._out_indptr = np.zeros(1, dtype=np.int64)
+            self._out_eidx = np.zeros(0, dtype=np.int64)
+            self._in_indptr = np.zeros(1, dtype=np.int64)
+            self._in_eidx = np.zeros(0, dtype=np.int64)
+            self._out_delta: Dict[int, List[int]] = {}
+            self._in_delta: Dict[int, List[int]] = {}
+            self._delta_size = 0
+
+    # ---------------- node ----------------
+    def has_node(self, node_id: str) -> bool:
+        idx = self.nodeid2idx.get(node_id)
+        return idx is not None and self.node_alive[idx] == 1
+
+    def node_index(self, node_id: str) -> int:
+        '''return -1 if the node is missing'''
+        idx = self.nodeid2idx.get(node_id, -1)
+        return idx if idx >= 0 and self.node_alive[idx] else -1
+
+    def upsert_node(self, node_id: str, node_type: str, attributes: dict) -> int:
+        with self._lock:
+            self._log("upsert_node", node_id, node_type, attributes)
+            idx = self.nodeid2idx.get(node_id)
+            if idx is None:
+                idx = len(self.nodeids)
+                self.nodeid2idx[node_id] = idx
+                self.nodeids.append(node_id)
+                self.node_types.append(node_type)
+                self.node_alive.append(1)
+                for column in self.node_columns.values():
+                    column.append(None)
+                self.node_count += 1
+            else:
+                if not self.node_alive[idx]:
+                    self.node_alive[idx] = 1
+                    self.node_count += 1
+                self._unindex_node(idx)
+                self.node_types[idx] = node_type or self.node_types[idx]
+
+            for k, v in attributes.items():
+                self._node_column(k)[idx] = v
+            self._index_node(idx)
+            return idx
+
+    def update_node(self, idx: int, set_attributes: dict):
+        with self._lock:
+            self._log("update_node", self.nodeids[idx], set_attributes)
+            self._unindex_node(idx)
+            for k, v in set_attributes.items():
+                self._node_column(k)[idx] = v
+            self._index_node(idx)
+
+    def remove_node(self, idx: int):
+        with self._lock:
+            if not self.node_alive[idx]: return
+            self._log("remove_node", self.nodeids[idx])
+            for eidx in self.out_edges(idx) + self.in_edges(idx):
+                self._remove_edge(eidx)
+            self._unindex_node(idx)
+            for column in self.node_columns.values():
+                column[idx] = None
+            self.node_alive[idx] = 0
+            self.node_count -= 1
+
+    def node_attributes(self, idx: int, keys: List[str] = None) -> dict:
+        keys = keys or self.node_columns.keys()
+        return {
+            k: self.node_columns[k][idx] for k in keys
+            if k in self.node_columns and self.node_columns[k][idx] is not None
+        }
+
+    def find_nodes(self, attributes: dict, node_type: str = None) -> List[int]:
+        '''node indexes matching all attributes, narrowed by the smallest secondary index first'''
+        with self._lock:
+            attributes = dict(attributes or {})
+            if "id" in attributes:
+                idx = self.node_index(attributes.pop("id"))
+                candidates = [idx] if idx >= 0 else []
+            else:
+                candidate_set = None
+                lookups = list(attributes.items()) + ([("type", node_type)] if node_type else [])
+                for k, v in lookups:
+                    if k not in self.node_indexes or not _hashable(v): continue
+                    hit = self.node_indexes[k].get(v, set())
+                    if candidate_set is None or len(hit) < len(candidate_set):
+                        candidate_set = hit
+                candidates = (
+                    sorted(candidate_set) if candidate_set is not None
+                    else [i for i in range(len(self.nodeids)) if self.node_alive[i]]
+                )
+
+            if node_type:
+                candidates = [i for i in candidates if self.node_types[i] == node_type]
+            for k, v in attributes.items():
+                if k == "type":
+                    candidates = [i for i in candidates if self.node_types[i] == v]
+                    continue
+                column = self.node_columns.get(k)
+                if column is None: return []
+                candidates = [i for i in candidates if column[i] == v]
+            return candidates
+
+    def _node_column(self, key: str) -> List:
+        if key not in self.node_columns:
+            self.node_columns[key] = [None] * len(self.nodeids)
+        return self.node_columns[key]
+
+    def _index_values(self, idx: int) -> Iterable[Tuple[str, Hashable]]:
+        for k in self.index_keys:
+            column = self.node_columns.get(k)
+            v = self.node_types[idx] if k == "type" else (column[idx] if column else None)
+            if v is not None and _hashable(v):
+                yield k, v
+
+    def _index_node(self, idx: int):
+        for k, v in self._index_values(idx):
+            self.node_indexes[k].setdefault(v, set()).add(idx)
+
+    def _unindex_node(self, idx: int):
+        for k, v in self._index_values(idx):
+            hit = self.node_indexes[k].get(v)
+            if hit is None: continue
+            hit.discard(idx)
+            if not hit:
+                self.node_indexes[k].pop(v)
+
+    # ---------------- edge ----------------
+    def edge_index(self, src_idx: int, dst_idx: int, edge_type: str = None) -> int:
+        '''return -1 if the edge is missing, any edge type matches if edge_type is None'''
+        if edge_type is not None:
+            return self.edge_key2eidx.get((src_idx, dst_idx, edge_type), -1)
+        for eidx in self.out_edges(src_idx):
+            if self.edge_dst[eidx] == dst_idx:
+                return eidx
+        return -1
+
+    def upsert_edge(self, src_idx: int, dst_idx: int, edge_type: str, attributes: dict) -> int:
+        with self._lock:
+            self._log("upsert_edge", self.nodeids[src_idx], self.nodeids[dst_idx], edge_type, attributes)
+            if len(self.edge_types) - self.edge_count > max(self.compact_threshold, self.edge_count // 4):
+                self.compact()
+            key = (src_idx, dst_idx, edge_type)
+            eidx = self.edge_key2eidx.get(key)
+            if eidx is None:
+                self._own_edge_arrays()
+                eidx = len(self.edge_types)
+                self.edge_key2eidx[key] = eidx
+                self.edge_src.append(src_idx)
+                self.edge_dst.append(dst_idx)
+                self.edge_types.append(edge_type)
+                self.edge_alive.append(1)
+                for column in self.edge_columns.values():
+                    column.append(None)
+                self.edge_type_index.setdefault(edge_type, set()).add(eidx)
+                self._out_delta.setdefault(src_idx, []).append(eidx)
+                self._in_delta.setdefault(dst_idx, []).append(eidx)
+                self._delta_size += 1
+                self.edge_count += 1
+
+            for k, v in attributes.items():
+                self._edge_column(k)[eidx] = v
+            return eidx
+
+    def update_edge(self, eidx: int, set_attributes: dict):
+        with self._lock:
+            self._log("update_edge", *self._edge_key(eidx), set_attributes)
+            for k, v in set_attributes.items():
+                self._edge_column(k)[eidx] = v
+
+    def remove_edge(self, eidx: int):
+        with self._lock:
+            if not self.edge_alive[eidx]: return
+            self._log("remove_edge", *self._edge_key(eidx))
+            self._remove_edge(eidx)
+
+    def _remove_edge(self, eidx: int):
+        with self._lock:
+            if not self.edge_alive[eidx]: return
+            self.edge_alive[eidx] = 0
+            self.edge_key2eidx.pop((self.edge_src[eidx], self.edge_dst[eidx], self.edge_types[eidx]), None)
+            hit = self.edge_type_index.get(self.edge_types[eidx], set())
+            hit.discard(eidx)
+            for column in self.edge_columns.values():
+                column[eidx] = None
+            self.edge_count -= 1
+
+    def _edge_key(self, eidx: int) -> Tuple[str, str, str]:
+        return self.nodeids[self.edge_src[eidx]], self.nodeids[self.edge_dst[eidx]], self.edge_types[eidx]
+
+    def edge_attributes(self, eidx: int) -> dict:
+        return {k: column[eidx] for k, column in self.edge_columns.items() if column[eidx] is not None}
+
+    def find_edges(self, attributes: dict, edge_type: str = None) -> List[int]:
+        with self._lock:
+            candidates = (
+                sorted(self.edge_type_index.get(edge_type, set())) if edge_type
+                else [i for i in range(len(self.edge_types)) if self.edge_alive[i]]
+            )
+            for k, v in (attributes or {}).items():
+                if k == "type":
+                    candidates = [i for i in candidates if self.edge_types[i] == v]
+                    continue
+                column = self.edge_columns.get(k)
+                if column is None: return []
+                candidates = [i for i in candidates if column[i] == v]
+            return candidates
+
+    def out_edges(self, idx: int) -> List[int]:
+        return self._adjacent_edges(idx, reverse=False)
+
+    def in_edges(self, idx: int) -> List[int]:
+        return self._adjacent_edges(idx, reverse=True)
+
+    def neighbors(self, idx: int, reverse: bool = False) -> List[Tuple[int, int]]:
+        '''[(eidx, neighbor_idx)] following the edge direction, or against it if reverse'''
+        ends = self.edge_src if reverse else self.edge_dst
+        return [(eidx, int(ends[eidx])) for eidx in self._adjacent_edges(idx, reverse)]
+
+    def _adjacent_edges(self, idx: int, reverse: bool) -> List[int]:
+        with self._lock:
+            if self._delta_size > max(self.compact_threshold, self.edge_count // 8):
+                self._build_csr()
+            indptr, eidxs, delta = (
+                (self._in_indptr, self._in_eidx, self._in_delta) if reverse
+                else (self._out_indptr, self._out_eidx, self._out_delta)
+            )
+            result = []
+            if idx + 1 < len(indptr):
+                result = eidxs[indptr[idx]: indptr[idx + 1]].tolist()
+            result.extend(delta.get(idx, []))
+            return [eidx for eidx in result if self.edge_alive[eidx]]
+
+    def _edge_column(self, key: str) -> List:
+        if key not in self.edge_columns:
+            self.edge_columns[key] = [None] * len(self.edge_types)
+        return self.edge_columns[key]
+
+    def _own_edge_arrays(self):
+        # edge arrays loaded from a snapshot are read-only memory maps until the first edge write
+        if not isinstance(self.edge_src, array):
+            self.edge_src = array("q", np.ascontiguousarray(self.edge_src, dtype=np.int64).tobytes())
+            self.edge_dst = array("q", np.ascontiguousarray(self.edge_dst, dtype=np.int64).tobytes())
+
+    def compact(self):
+        '''drop deleted edges from the edge table (edge indexes change) and recompile the CSR arrays'''
+        with self._lock:
+            alive = np.frombuffer(bytes(self.edge_alive), dtype=np.uint8).astype(bool)
+            if not alive.all():
+                self._own_edge_arrays()
+                keep = np.nonzero(alive)[0].tolist()
+                self.edge_src = array("q", (self.edge_src[i] for i in keep))
+                self.edge_dst = array("q", (self.edge_dst[i] for i in keep))
+                self.edge_types = [self.edge_types[i] for i in keep]
+                self.edge_alive = bytearray(b"\x01" * len(keep))
+                self.edge_columns = {k: [column[i] for i in keep] for k, column in self.edge_columns.items()}
+                self.edge_key2eidx = {
+                    (s, d, t): i for i, (s, d, t) in enumerate(zip(self.edge_src, self.edge_dst, self.edge_types))
+                }
+                self.edge_type_index = {}
+                for i, t in enumerate(self.edge_types):
+                    self.edge_type_index.setdefault(t, set()).add(i)
+            self._build_csr()
+
+    def _build_csr(self):
+        '''merge the delta adjacency into CSR, deleted edges are kept and skipped while reading'''
+        with self._lock:
+            node_num = len(self.nodeids)
+            src = np.array(self.edge_src, dtype=np.int64)
+            dst = np.array(self.edge_dst, dtype=np.int64)
+            self._out_indptr, self._out_eidx = _csr_arrays(src, node_num)
+            self._in_indptr, self._in_eidx = _csr_arrays(dst, node_num)
+            self._out_delta, self._in_delta = {}, {}
+            self._delta_size = 0
+
+
+    # ---------------- persistence ----------------
+    def _log(self, op: str, *args):
+        if self.journal is not None:
+            self.journal.append([op, *args])
+
+    def save_snapshot(self, dir_path: str):
+        '''
+        write a full snapshot with an empty delta log into a new version directory, then switch CURRENT
+        to it with one rename. a crash at any point leaves CURRENT naming a complete snapshot and its own log
+        '''
+        with self._lock:
+            self.compact()
+            version = f"{self.SNAPSHOT_PREFIX}{time.time_ns()}"
+            version_path = os.path.join(dir_path, version)
+            os.makedirs(version_path)
+            arrays = {
+                "edge_src": np.array(self.edge_src, dtype=np.int64),
+                "edge_dst": np.array(self.edge_dst, dtype=np.int64),
+                "out_indptr": self._out_indptr, "out_eidx": self._out_eidx,
+                "in_indptr": self._in_indptr, "in_eidx": self._in_eidx,
+            }
+            for name in self.SNAPSHOT_ARRAYS:
+                with _synced_open(os.path.join(version_path, f"{name}.npy"), "wb") as f:
+                    np.save(f, np.asarray(arrays[name], dtype=np.int64))
+
+            meta = {
+                "version": 1,
+                "nodeids": self.nodeids,
+                "node_types": self.node_types,
+                "node_alive": list(self.node_alive),
+                "node_columns": self.node_columns,
+                "edge_types": self.edge_types,
+                "edge_columns": self.edge_columns,
+            }
+            with _synced_open(os.path.join(version_path, self.SNAPSHOT_META), "w") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            with _synced_open(os.path.join(version_path, self.DELTA_LOG), "w"):
+                pass
+            _fsync_dir(version_path)
+
+            with _synced_open(os.path.join(dir_path, f"{self.CURRENT}.tmp"), "w") as f:
+                f.write(version)
+            os.replace(os.path.join(dir_path, f"{self.CURRENT}.tmp"), os.path.join(dir_path, self.CURRENT))
+            _fsync_dir(dir_path)
+            self.journal, self.log_size = [], 0
+
+            # older versions and the unversioned files are no longer referenced
+            for name in os.listdir(dir_path):
+                if name.startswith(self.SNAPSHOT_PREFIX) and name != version:
+                    shutil.rmtree(os.path.join(dir_path, name), ignore_errors=True)
+                elif name in [f"{n}.npy" for n in self.SNAPSHOT_ARRAYS] + [self.SNAPSHOT_META, self.DELTA_LOG]:
+                    os.remove(os.path.join(dir_path, name))
+
+    def snapshot_path(self, dir_path: str) -> str:
+        '''the version directory named by CURRENT, dir_path itself for snapshots saved before versioning'''
+        try:
+            with open(os.path.join(dir_path, self.CURRENT), "r", encoding="utf-8") as f:
+                return os.path.join(dir_path, f.read().strip())
+        except FileNotFoundError:
+            return dir_path
+
+    def append_log(self, dir_path: str):
+        '''append the pending writes to the delta log instead of rewriting the snapshot'''
+        with self._lock:
+            if not self.journal: return
+            with open(os.path.join(self.snapshot_path(dir_path), self.DELTA_LOG), "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in self.journal))
+                f.flush()
+                os.fsync(f.fileno())
+            self.log_size += len(self.journal)
+            self.journal = []
+
+    def load_snapshot(self, dir_path: str, mmap: bool = True) -> bool:
+        '''load the current snapshot (topology arrays memory-mapped if mmap) and replay its delta log'''
+        dir_path = self.snapshot_path(dir_path)
+        meta_path = os.path.join(dir_path, self.SNAPSHOT_META)
+        if not os.path.exists(meta_path):
+            return False
+
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(dir_path, f"{name}.npy"), mmap_mode="r" if mmap else None)
+            for name in self.SNAPSHOT_ARRAYS
+        }
+        with self._lock:
+            self.journal = None
+            self.clear()
+            self.nodeids = meta["nodeids"]
+            self.nodeid2idx = {nodeid: idx for idx, nodeid in enumerate(self.nodeids)}
+            self.node_types = meta["node_types"]
+            self.node_alive = bytearray(meta["node_alive"])
+            self.node_columns = meta["node_columns"]
+            self.node_count = sum(self.node_alive)
+            for idx in range(len(self.nodeids)):
+                if self.node_alive[idx]:
+                    self._index_node(idx)
+
+            self.edge_src, self.edge_dst = arrays["edge_src"], arrays["edge_dst"]
+            if not mmap:
+                self._own_edge_arrays()
+            self.edge_types = meta["edge_types"]
+            self.edge_alive = bytearray(b"\x01" * len(self.edge_types))
+            self.edge_columns = meta["edge_columns"]
+            self.edge_count = len(self.edge_types)
+            for eidx, key in enumerate(zip(self.edge_src.tolist(), self.edge_dst.tolist(), self.edge_types)):
+                self.edge_key2eidx[key] = eidx
+                self.edge_type_index.setdefault(key[2], set()).add(eidx)
+            self._out_indptr, self._out_eidx = arrays["out_indptr"], arrays["out_eidx"]
+            self._in_indptr, self._in_eidx = arrays["in_indptr"], arrays["in_eidx"]
+
+            self.log_size = self.replay_log(dir_path)
+            self.journal = []
+        return True
+
+    def replay_log(self, dir_path: str) -> int:
+        log_path = os.path.join(dir_path, self.DELTA_LOG)
+        if not os.path.exists(log_path):
+            return 0
+
+        count = 0
+        with open(log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a torn tail write, the records before it are complete
+                    break
+                self._apply(*record)
+                count += 1
+        return count
+
+    def _apply(self, op: str, *args):
+        if op == "clear":
+            self.clear()
+        elif op == "upsert_node":
+            self.upsert_node(*args)
+        elif op == "update_node":
+            idx = self.node_index(args[0])
+            if idx >= 0: self.update_node(idx, args[1])
+        elif op == "remove_node":
+            idx = self.node_index(args[0])
+            if idx >= 0: self.remove_node(idx)
+        elif op == "upsert_edge":
+            src_idx, dst_idx = self.node_index(args[0]), self.node_index(args[1])
+            if src_idx >= 0 and dst_idx >= 0: self.upsert_edge(src_idx, dst_idx, args[2], args[3])
+        elif op in ["update_edge", "remove_edge"]:
+            src_idx, dst_idx = self.node_index(args[0]), self.node_index(args[1])
+            eidx = self.edge_index(src_idx, dst_idx, args[2]) if src_idx >= 0 and dst_idx >= 0 else -1
+            if eidx < 0: return
+            if op == "update_edge":
+                self.update_edge(eidx, args[3])
+            else:
+                self.remove_edge(eidx)
+
+
+def _csr_arrays(keys: np.ndarray, node_num: int) -> Tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(keys, kind="stable")
+    counts = np.bincount(keys, minlength=node_num)
+    indptr = np.zeros(node_num + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, order.astype(np.int64)
+
+
+def _hashable(value) -> bool:
+    try:
+        hash(value)
+        return True
+    except TypeError:
+        return False
+
+
+@contextmanager
+def _synced_open(path: str, mode: str):
+    '''open path for writing and fsync it when done'''
+    with open(path, mode, **({} if "b" in mode else {"encoding": "utf-8"})) as f:
+        yield f
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(path: str):
+    if os.name == "nt":
+        # directories cannot be opened for fsync on windows
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
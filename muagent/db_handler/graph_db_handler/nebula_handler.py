@@ -6,6 +6,7 @@
 @desc:
 '''
 import time
+import threading
 from loguru import logger
 from typing import List, Dict, Any
 import json
@@ -14,6 +15,7 @@ import requests
 from muagent.schemas.common import GNode, GEdge, Graph
 from muagent.schemas.db import GBConfig
 from .base_gb_handler import GBHandler
+from .query_builder import NebulaQueryBuilder
 from muagent.schemas.common import *
 from muagent.utils.common_utils import double_hashing
 
@@ -43,7 +45,17 @@ class CustomResultSet(ResultSet):
             return "Failed to decode error message."
 
 
-class NebulaHandler:
+class _PooledSession:
+    '''空闲池中的 session 及其已绑定的 space'''
+    __slots__ = ("session", "space", "last_used")
+
+    def __init__(self, session):
+        self.session = session
+        self.space = None
+        self.last_used = time.time()
+
+
+class NebulaHandler(GBHandler):
     def __init__(self,gb_config : GBConfig = None):
         '''
         init nebula connection_pool
@@ -52,58 +64,253 @@ class NebulaHandler:
         @param username: username
         @param password: password
         '''
+        extra_kwargs = gb_config.extra_kwargs if gb_config else {}
+
+        # 连接池配置: 池大小(同时借出的 session 数上限), 空闲超时(ms), 空闲检查间隔(s)
         config = Config()
+        config.max_connection_pool_size = extra_kwargs.get("max_connection_pool_size", 10)
+        config.idle_time = extra_kwargs.get("idle_time", 0)
+        config.interval_check = extra_kwargs.get("interval_check", -1)
 
-        self.connection_pool = ConnectionPool()
+        # 等待 nebula 就绪的最长时间(s)
+        self.ready_timeout = extra_kwargs.get("ready_timeout", 120)
 
         if gb_config == None:
             
-            self.connection_pool.init([('graphd', '9669')], config)
+            self.init_connection_pool([('graphd', '9669')], config)
             self.username = '' or 'root'
             self.nb_pw = '' or 'nebula'
             self.space_name = "client"
         else:
-            logger.info('NebulaGraph容器启动中，等待20秒')
-            time.sleep(20)
-            self.connection_pool.init([(gb_config.extra_kwargs.get("host"), gb_config.extra_kwargs.get("port"))], config)
+            self.init_connection_pool([(gb_config.extra_kwargs.get("host"), gb_config.extra_kwargs.get("port"))], config)
             self.username = gb_config.extra_kwargs.get("username")
             self.nb_pw = gb_config.extra_kwargs.get("password")
             self.space_name = gb_config.extra_kwargs.get("space")
 
-    def execute_cypher(self, cypher: str, space_name: str = '',ignore_log: bool = False, format_res: str = 'as_primitive', use_space_name: bool = True):
+        # 批量写入时单条语句包含的最大节点/边数
+        self.batch_size = extra_kwargs.get("batch_size") or 500
+
+        # 每次执行时从空闲池借出 session, 执行完归还, 线程退出不会一直占用连接;
+        # 同时借出的 session 不超过连接池大小, 超出时等待 session_wait_timeout(s),
+        # 超过 health_check_interval(s) 未使用的 session 先 ping 再复用
+        self.health_check_interval = extra_kwargs.get("health_check_interval", 60)
+        self.session_wait_timeout = extra_kwargs.get("session_wait_timeout", 30)
+        self._session_slots = threading.BoundedSemaphore(config.max_connection_pool_size)
+        self._idle_sessions: List[_PooledSession] = []
+        self._sessions_lock = threading.Lock()
+        # space 被删除/重建后递增, 已绑定旧 space 的 session 需要重新 USE
+        self._space_epoch = 0
+
+        # 按 (tag, 属性集合) 缓存语句模板
+        self.query_builder = NebulaQueryBuilder()
+
+    def init_connection_pool(self, addresses: list, config: Config):
+        '''轮询 graphd 直到连接池初始化成功, 超过 ready_timeout 仍未就绪时抛出异常'''
+        def _init_pool():
+            connection_pool = ConnectionPool()
+            try:
+                connection_pool.init(addresses, config)
+            except Exception as e:
+                connection_pool.close()
+                raise e
+            self.connection_pool = connection_pool
+            return True
+
+        if not self.wait_until(_init_pool, f"NebulaGraph graphd {addresses}"):
+            raise RuntimeError(f"NebulaGraph graphd {addresses} is not ready after {self.ready_timeout}s")
+
+    def wait_until(self, check_func, desc: str = '', timeout: float = None) -> bool:
         '''
-        @param space_name: space_name, if provided, will execute use space_name first
-        @param cypher:
-        @return:
+        以指数退避方式轮询 check_func, 直到其返回 True 或超时
+        @param check_func: 就绪检查函数, 返回 True 表示就绪, 抛出异常视为未就绪
+        @param desc: 日志中的描述
+        @param timeout: 最长等待时间(s), 默认取 ready_timeout
+        @return: 是否在超时前就绪
+        '''
+        timeout = timeout or self.ready_timeout
+        deadline = time.time() + timeout
+        interval = 0.5
+        while True:
+            try:
+                if check_func():
+                    logger.info(f"{desc} is ready")
+                    return True
+            except Exception as e:
+                logger.debug(f"{desc} is not ready: {e}")
+
+            if time.time() >= deadline:
+                logger.error(f"{desc} is not ready after {timeout}s")
+                return False
+            time.sleep(min(interval, max(deadline - time.time(), 0)))
+            interval = min(interval * 2, 8)
+
+    def wait_for_hosts(self, hostname: str = None, timeout: float = None) -> bool:
+        '''
+        等待 storaged 上线(SHOW HOSTS 中状态为 ONLINE)
+        @param hostname: 指定等待的 storaged 主机, 为空时任一主机上线即可
+        '''
+        def _check():
+            resp = self._execute('SHOW HOSTS', use_space_name=False)
+            if not resp.is_succeeded():
+                return False
+            return any(
+                item.get('Status') == 'ONLINE' and (hostname is None or item.get('Host') == hostname)
+                for item in resp.as_primitive()
+            )
+        return self.wait_until(_check, f"NebulaGraph storaged {hostname or ''}", timeout)
+
+    def wait_for_space(self, space_name: str = '', timeout: float = None) -> bool:
+        '''等待 space 出现在 SHOW SPACES 中并且可以 USE'''
+        space_name = space_name or self.space_name
+
+        def _check():
+            resp = self._execute('SHOW SPACES', use_space_name=False)
+            if not resp.is_succeeded() or \
+                    space_name not in [item.get('Name') for item in resp.as_primitive()]:
+                return False
+            # 通过 _execute 的 space 绑定执行 USE, 成功后 session 记录已绑定的 space
+            return self._execute('YIELD 1', space_name).is_succeeded()
+        return self.wait_until(_check, f"NebulaGraph space {space_name}", timeout)
+
+    def wait_for_schema(self, tag_names: List[str] = [], edge_type_names: List[str] = [], space_name: str = '', timeout: float = None) -> bool:
+        '''
+        等待 tag/edge type 同步到 graphd, 所有 tag 和 edge type 都能通过语义校验时视为就绪
         '''
-        with self.connection_pool.session_context(self.username, self.nb_pw) as session:
-            if use_space_name:
-                if space_name:
-                    cypher = f'USE {space_name};{cypher}'
-                elif self.space_name:
-                    cypher = f'USE {self.space_name};{cypher}'
+        cyphers = [f'DESCRIBE TAG {tag_name}' for tag_name in tag_names]
+        cyphers += [f'DESCRIBE EDGE {edge_type_name}' for edge_type_name in edge_type_names]
+        # FETCH 会在 graphd 中校验 schema, 可以确认 schema 已经同步
+        if tag_names:
+            cyphers.append(f'FETCH PROP ON {", ".join(tag_names)} "__schema_probe__" YIELD vertex AS v')
+        cyphers += [
+            f'FETCH PROP ON {edge_type_name} "__schema_probe__" -> "__schema_probe__" YIELD edge AS e'
+            for edge_type_name in edge_type_names
+        ]
+        cypher = ';'.join(cyphers)
+
+        def _check():
+            return self._execute(cypher, space_name).is_succeeded()
+        return self.wait_until(_check, f"NebulaGraph schema", timeout)
+
+    def _checkout_session(self) -> "_PooledSession":
+        '''借出一个空闲 session, 没有空闲 session 时新建, 连接失效时重新认证'''
+        if not self._session_slots.acquire(timeout=self.session_wait_timeout):
+            raise RuntimeError(f"no nebula session available after {self.session_wait_timeout}s")
+        try:
+            with self._sessions_lock:
+                pooled = self._idle_sessions.pop() if self._idle_sessions else None
+            if pooled is not None and \
+                    time.time() - pooled.last_used > self.health_check_interval and \
+                    not pooled.session.ping():
+                self._close_session(pooled)
+                pooled = None
+
+            if pooled is None:
+                pooled = _PooledSession(self.connection_pool.get_session(self.username, self.nb_pw))
+            return pooled
+        except Exception as e:
+            self._session_slots.release()
+            raise e
+
+    def _checkin_session(self, pooled: "_PooledSession"):
+        '''归还 session 到空闲池'''
+        with self._sessions_lock:
+            self._idle_sessions.append(pooled)
+        self._session_slots.release()
+
+    def _discard_session(self, pooled: "_PooledSession"):
+        '''释放借出的 session, 用于连接异常或 session 失效'''
+        self._close_session(pooled)
+        self._session_slots.release()
 
-            # logger.debug(cypher)
-            resp = session.execute(cypher)
+    def _close_session(self, pooled: "_PooledSession"):
+        try:
+            pooled.session.release()
+        except Exception as e:
+            logger.warning(f"release nebula session failed: {e}")
 
+    def _execute(self, cypher: str, space_name: str = '', use_space_name: bool = True, params: dict = None) -> CustomResultSet:
+        '''
+        在当前线程的 session 上执行语句, session 已绑定目标 space 时不再追加 USE,
+        连接异常或 session 失效时重连并重试一次
+        @param params: 参数化查询的参数, 语句中以 $name 引用
+        '''
+        space_name = (space_name or self.space_name) if use_space_name else ''
+        params = self._build_params(params) if params else None
+        for retry in range(2):
+            pooled = self._checkout_session()
+            try:
+                bind_space = (space_name, self._space_epoch) if space_name else None
+                stmt = cypher
+                if bind_space and pooled.space != bind_space:
+                    stmt = f'USE {space_name};{cypher}'
+
+                resp = pooled.session.execute_parameter(stmt, params) if params else pooled.session.execute(stmt)
+            except Exception as e:
+                self._discard_session(pooled)
+                if retry > 0:
+                    raise e
+                logger.warning(f"nebula session execute failed, reconnecting: {e}")
+                continue
+
+            if resp.error_code() in [ErrorCode.E_SESSION_INVALID, ErrorCode.E_SESSION_TIMEOUT] and retry == 0:
+                self._discard_session(pooled)
+                continue
+
+            pooled.last_used = time.time()
+            if bind_space and resp.is_succeeded():
+                pooled.space = bind_space
+            self._checkin_session(pooled)
             # 使用自定义 ResultSet 类处理响应
-            resp = CustomResultSet(resp._resp, resp._all_latency)
-            
-            if ignore_log == False:
-                if resp.is_succeeded():
-                    #logger.info(f"Successfully executed Cypher query: {cypher}")
-                    
-                    pass
-                    
-                else:
-                    logger.error(f"Failed to execute Cypher query: {cypher}")
-                    print(resp.error_msg())
+            return CustomResultSet(resp._resp, resp._all_latency)
+
+    def _bump_space_epoch(self):
+        '''space 被删除/重建, 已绑定的 session 在下次执行时重新 USE'''
+        with self._sessions_lock:
+            self._space_epoch += 1
+
+    def _build_params(self, params: dict) -> dict:
+        '''python 值转换为 nebula Value'''
+        nebula_params = {}
+        for k, v in params.items():
+            value = Value()
+            if isinstance(v, bool):
+                value.set_bVal(v)
+            elif isinstance(v, int):
+                value.set_iVal(v)
+            elif isinstance(v, float):
+                value.set_fVal(v)
+            elif v is None:
+                value.set_nVal(NullType.__NULL__)
+            else:
+                value.set_sVal(f"{v}")
+            nebula_params[k] = value
+        return nebula_params
+
+    def execute_cypher(self, cypher: str, space_name: str = '',ignore_log: bool = False, format_res: str = 'as_primitive', use_space_name: bool = True, params: dict = None):
+        '''
+        @param space_name: space_name, if provided, will execute use space_name first
+        @param cypher:
+        @param params: parameters referenced as $name in cypher
+        @return:
+        '''
+        # logger.debug(cypher)
+        resp = self._execute(cypher, space_name, use_space_name, params)
+        
+        if ignore_log == False:
+            if resp.is_succeeded():
+                #logger.info(f"Successfully executed Cypher query: {cypher}")
+                
+                pass
                 
+            else:
+                logger.error(f"Failed to execute Cypher query: {cypher}")
+                print(resp.error_msg())
+            
 
-            if format_res == 'as_primitive':
-                resp = resp.as_primitive()
-            elif format_res == 'dict_for_vis':
-                resp = resp.dict_for_vis()
+        if format_res == 'as_primitive':
+            resp = resp.as_primitive()
+        elif format_res == 'dict_for_vis':
+            resp = resp.dict_for_vis()
         return resp
     
     def execute_cypher_return_status(self, cypher: str, space_name: str = '', format_res: str = 'as_primitive', use_space_name: bool = True):
@@ -112,34 +319,35 @@ class NebulaHandler:
         @param cypher:
         @return:
         '''
-        with self.connection_pool.session_context(self.username, self.nb_pw) as session:
-            if use_space_name:
-                if space_name:
-                    cypher = f'USE {space_name};{cypher}'
-                elif self.space_name:
-                    cypher = f'USE {self.space_name};{cypher}'
+        # logger.debug(cypher)
+        resp = self._execute(cypher, space_name, use_space_name)
 
-            # logger.debug(cypher)
-            resp = session.execute(cypher)
-
-            # 使用自定义 ResultSet 类处理响应
-            resp = CustomResultSet(resp._resp, resp._all_latency)
+        if resp.is_succeeded():
+            logger.info(f"Successfully executed Cypher query: {cypher}")
+            # 添加成功
+            return GbaseExecStatus(
+            errorMessage="GDB_SUCCEED", 
+            errorCode=0, 
+            )
+            
+        else:
+            logger.error(f"Failed to execute Cypher query: {cypher}")
+            print(resp.error_msg())
+            return GbaseExecStatus(
+            errorMessage=resp.error_msg(), 
+            errorCode=resp.error_code(), 
+            )
 
-            if resp.is_succeeded():
-                logger.info(f"Successfully executed Cypher query: {cypher}")
-                # 添加成功
-                return GbaseExecStatus(
-                errorMessage="GDB_SUCCEED", 
-                errorCode=0, 
-                )
-                
-            else:
-                logger.error(f"Failed to execute Cypher query: {cypher}")
-                print(resp.error_msg())
-                return GbaseExecStatus(
-                errorMessage=resp.error_msg(), 
-                errorCode=resp.error_code(), 
-                )
+    def execute_many(self, cyphers: List[str], space_name: str = '', use_space_name: bool = True) -> GbaseExecStatus:
+        '''
+        将多条语句用分号拼接后在一次请求中执行, 遇到失败的语句时后续语句不再执行
+        @param cyphers: 语句列表
+        @return: 执行状态
+        '''
+        cypher = ';'.join(c.strip().rstrip(';') for c in cyphers if c.strip())
+        if not cypher:
+            return GbaseExecStatus(errorMessage="GDB_SUCCEED", errorCode=0)
+        return self.execute_cypher_return_status(cypher, space_name, use_space_name=use_space_name)
             
 
     def add_hosts(self, hostname, port):
@@ -149,6 +357,10 @@ class NebulaHandler:
             return resp
 
     def close_connection(self):
+        with self._sessions_lock:
+            sessions, self._idle_sessions = self._idle_sessions, []
+        for pooled in sessions:
+            self._close_session(pooled)
         self.connection_pool.close()
 
     def create_space(self, space_name: str, vid_type: str = 'FIXED_STRING(32)', comment: str = ''):
@@ -161,6 +373,7 @@ class NebulaHandler:
         cypher = f'CREATE SPACE IF NOT EXISTS {space_name} (vid_type={vid_type}, partition_num=10, replica_factor=1);'
         # logger.debug(f"{cypher}")
         resp = self.execute_cypher(cypher, use_space_name=False)
+        self._bump_space_epoch()
 
         return resp
 
@@ -171,7 +384,9 @@ class NebulaHandler:
 
     def drop_space(self, space_name):
         cypher = f'DROP SPACE {space_name}'
-        return self.execute_cypher(cypher)
+        resp = self.execute_cypher(cypher)
+        self._bump_space_epoch()
+        return resp
 
     def create_tag(self, tag_name: str, prop_dict: dict = {}):
         '''
@@ -258,60 +473,64 @@ class NebulaHandler:
         @param node: Dictionary containing node information
         @return: Result of Cypher query execution
         '''
+        return self.add_nodes([node]).results[0]
+    
+    def add_nodes(self, nodes: List[GNode], batch_size: int = None) -> GbaseExecStatus:
+        '''
+        批量插入节点, 按 tag 和属性集合分组, 每个分块只执行一条多值 INSERT VERTEX
 
-        # 查询节点提前error判断
-        check_res = self.check_node_before_execute(node.id,"add")
-        if check_res != None:
-            return check_res
-
-        # 从GNode实例中提取信息
-        vid = node.id
-        tag_name = node.type  # 使用type作为tag名称
-        # attributes = node.attributes
+        @param nodes: 待插入的节点
+        @param batch_size: 单条 INSERT 语句最多包含的节点数, 默认取 gb_config 中的 batch_size
+        @return: 汇总状态, results 中按输入顺序给出每个节点的 GbaseExecStatus
+        '''
+        batch_size = batch_size or self.batch_size
+        results: List[GbaseExecStatus] = [None] * len(nodes)
+
+        # 查询节点提前error判断, 一次批量FETCH完成存在性检查
+        exist_ids = self.get_exist_nodeids([node.id for node in nodes if node.id])
+
+        # 按 (tag, 属性名) 分组, 同组节点可以合并到同一条 INSERT
+        groups = {}
+        insert_ids = set()
+        for idx, node in enumerate(nodes):
+            if node.id == "":
+                results[idx] = GbaseExecStatus(
+                    errorMessage="GDB_ENGINE_PROP_INVALID", 
+                    errorCode=2, 
+                    )
+                continue
+
+            if node.id in exist_ids or node.id in insert_ids:
+                logger.info(f'Node {node.id} already exits!')
+                results[idx] = GbaseExecStatus(
+                    errorMessage='GDB_ENGINE_PRIMARY_KEY_DUPLICATE', 
+                    errorCode=1, 
+                    )
+                continue
+
+            insert_ids.add(node.id)
+            # 初始化节点属性字典，并将节点的ID属性添加进去
+            node_attributes = {"id": node.id, "type": node.type}
+            node_attributes["ID"] = node.attributes.pop("ID", "") or double_hashing(node.id)
+            node_attributes.update(node.attributes)
+
+            properties_name = tuple(node_attributes.keys())
+            groups.setdefault((node.type, properties_name), []).append((idx, node.id, node_attributes))
+
+        for (tag_name, properties_name), items in groups.items():
+            for i in range(0, len(items), batch_size):
+                chunk = items[i: i+batch_size]
+                cypher = self.query_builder.insert_vertex(
+                    tag_name, properties_name, 
+                    [(vid, node_attributes) for _, vid, node_attributes in chunk]
+                )
 
-        # 初始化节点属性字典，并将节点的ID属性添加进去
-        node_attributes = {"id": node.id, "type": node.type}
-        node_attributes["ID"] = node.attributes.pop("ID", "") or double_hashing(node.id)
-        node_attributes.update(node.attributes)
-        
-        # 构建 Cypher 查询
-        properties_name = list(node_attributes.keys())
-        
-        # 构建查询字符串
-        cypher = f'INSERT VERTEX {tag_name} ('
-        cypher += ','.join(properties_name)
-        cypher += ') VALUES '
-        
-        cypher += f'"{vid}":('
-        for prop_name in properties_name:
-            value = node_attributes.get(prop_name)
-            if isinstance(value, str):
-                if prop_name in {'extra', 'description', 'envdescription','updaterule'}:
-                    # 转义换行符和双引号
-                    value = value.replace("\n", "\\n").replace("\"", "\\\"")
-                    cypher += f'"{value}",'
-                elif prop_name == 'description':
-                    value = value.replace("\n", "\\n").replace("\"", "\\\"")
-                    cypher += f'"{value}",'
-                elif prop_name == 'envdescription':
-                    value = value.replace("\n", "\\n").replace("\"", "\\\"")
-                    cypher += f'"{value}",'
-                else:
-                    cypher += f'"{value}",'
-                #cypher += f'"{value}",'
-            else:
-                cypher += f'{value},'
-        cypher = cypher.rstrip(',')
-        cypher += ');'
-        
-        # 执行 Cypher 查询
-        res = self.execute_cypher_return_status(cypher, self.space_name)
-        return res
-    
-    def add_nodes(self, nodes: List[GNode]) -> GbaseExecStatus:
-        for node in nodes:
-            self.add_node(node)
+                # 执行 Cypher 查询
+                res = self.execute_cypher_return_status(cypher, self.space_name)
+                for idx, _, _ in chunk:
+                    results[idx] = res
 
+        return self.merge_exec_status(results)
 
     def add_edge(self, edge: GEdge) -> GbaseExecStatus:
         '''
@@ -319,74 +538,71 @@ class NebulaHandler:
         @param edge: 边的信息字典，包括标签名称、起始节点 ID、结束节点 ID 和属性字典
         @return: 执行结果
         '''
-        # if edge.start_id or edge.end_id == "":
-        #     return GbaseExecStatus(
-        #     errorMessage="GDB_ENGINE_PROP_INVALID", 
-        #     errorCode=2, 
-        #     )
-        
-        # if len(self.get_current_edge(edge.start_id, edge.end_id)) > 0:
-        #     return GbaseExecStatus(
-        #     errorMessage='GDB_ENGINE_PRIMARY_KEY_DUPLICATE', 
-        #     errorCode=1, 
-        #     )
-        edge_exits = self.check_edge_before_execute(edge.start_id, edge.end_id,'add')
-        if edge_exits != None:
-            return edge_exits
-        
-        edge_type_name = edge.type
-        src_vid = edge.start_id
-        dst_vid = edge.end_id
-        attributes = edge.attributes
+        return self.add_edges([edge]).results[0]
+    
+    def add_edges(self, edges: List[GEdge], batch_size: int = None) -> GbaseExecStatus:
+        '''
+        批量插入边, 按边类型和属性集合分组, 每个分块只执行一条多值 INSERT EDGE
 
-        attributes["type"] = edge_type_name
+        @param edges: 待插入的边
+        @param batch_size: 单条 INSERT 语句最多包含的边数, 默认取 gb_config 中的 batch_size
+        @return: 汇总状态, results 中按输入顺序给出每条边的 GbaseExecStatus
+        '''
+        batch_size = batch_size or self.batch_size
+        results: List[GbaseExecStatus] = [None] * len(edges)
 
-        # 如果SRCID 和DSTID不存在，使用哈希赋值
-        edge_attributes = {
-            "SRCID": edge.attributes.pop("SRCID", 0) or double_hashing(edge.start_id),
-            "DSTID": edge.attributes.pop("DSTID", 0) or double_hashing(edge.end_id),
-        }
-        attributes.update(edge_attributes)
+        # 一次批量查询完成存在性检查
+        exist_pairs = self.get_exist_edgeids(
+            [edge.start_id for edge in edges if edge.start_id and edge.end_id]
+        )
 
-        # 构建 Cypher 查询
-        cypher = f'INSERT EDGE {edge_type_name} ('
-
-        # 获取属性名称
-        properties_name = list(attributes.keys())
-        for property_name in properties_name:
-            # 处理 @timestamp 字段
-            if property_name == '@timestamp':
-                cypher += f'`timestamp`,'
-            else:
-                cypher += f'{property_name},'
-            #cypher += f'{property_name},'
-        cypher = cypher.rstrip(',')
+        groups = {}
+        insert_pairs = set()
+        for idx, edge in enumerate(edges):
+            if edge.start_id == "" or edge.end_id == "":
+                results[idx] = GbaseExecStatus(
+                    errorMessage="GDB_ENGINE_PROP_INVALID", 
+                    errorCode=2, 
+                    )
+                continue
+
+            if (edge.start_id, edge.end_id) in exist_pairs or (edge.start_id, edge.end_id) in insert_pairs:
+                logger.info(f'Edge {edge.start_id}->{edge.end_id} already exists!')
+                results[idx] = GbaseExecStatus(
+                    errorMessage='GDB_ENGINE_PRIMARY_KEY_DUPLICATE', 
+                    errorCode=1, 
+                    )
+                continue
+
+            insert_pairs.add((edge.start_id, edge.end_id))
+            attributes = edge.attributes
+            attributes["type"] = edge.type
+
+            # 如果SRCID 和DSTID不存在，使用哈希赋值
+            edge_attributes = {
+                "SRCID": edge.attributes.pop("SRCID", 0) or double_hashing(edge.start_id),
+                "DSTID": edge.attributes.pop("DSTID", 0) or double_hashing(edge.end_id),
+            }
+            attributes.update(edge_attributes)
+
+            properties_name = tuple(attributes.keys())
+            groups.setdefault((edge.type, properties_name), []).append(
+                (idx, edge.start_id, edge.end_id, attributes))
+
+        for (edge_type_name, properties_name), items in groups.items():
+            for i in range(0, len(items), batch_size):
+                chunk = items[i: i+batch_size]
+                cypher = self.query_builder.insert_edge(
+                    edge_type_name, properties_name, 
+                    [(src_vid, dst_vid, attributes) for _, src_vid, dst_vid, attributes in chunk]
+                )
 
-        cypher += ') VALUES '
-        cypher += f'"{src_vid}"->"{dst_vid}":('
-
-        # 添加属性值
-        for attr_name in properties_name:
-            attr_value = attributes[attr_name]
-            if isinstance(attr_value, str):
-                if attr_name == 'extra':
-                    # 处理 extra 字段中的 JSON 字符串，转义双引号
-                    attr_value = attr_value.replace('"', '\\"')
-                    cypher += f'"{attr_value}",'
-                else:
-                    cypher += f'"{attr_value}",'
-            else:
-                cypher += f'{attr_value},'
-        cypher = cypher.rstrip(',')
-        cypher += ');'
+                # 执行查询
+                res = self.execute_cypher_return_status(cypher, self.space_name)
+                for idx, _, _, _ in chunk:
+                    results[idx] = res
 
-        # 执行查询
-        res = self.execute_cypher_return_status(cypher, self.space_name)
-        return res
-    
-    def add_edges(self, edges: List[GEdge]) -> GbaseExecStatus:
-        for edge in edges:
-            self.add_edge(edge)
+        return self.merge_exec_status(results)
 
     def update_node(self, attributes: dict, set_attributes: dict, node_type: str = None, ID: int = None) -> GbaseExecStatus:
         # 添加引号并构造 SET 子句
@@ -399,29 +615,8 @@ class NebulaHandler:
         if check_res != None:
             return check_res
 
-        set_clause_parts = []
-        for k, v in set_attributes.items():
-            # todo: 需要对更多特殊字符进行转义
-            if k == 'extra' and isinstance(v, str):
-                # 转义 extra 字段中的 JSON 字符串中的双引号
-                v = v.replace('"', '\\"')
-                set_clause_parts.append(f'{k} = "{v}"')
-            elif isinstance(v, str):
-                set_clause_parts.append(f'{k} = "{v}"')
-            else:
-                set_clause_parts.append(f'{k} = {v}')
-
-        set_clause = ', '.join(set_clause_parts)
-        # if attributes == {}:
-        #     attributes = {'ID': ID}
-        # id = self.get_current_nodeID(attributes, node_type)
-        #ngql里字段str需要用""括起来, 语句最好采用拼接的方式
-        # cypher = f'UPDATE VERTEX ON {node_type} "{id}" '
-        cypher = f'UPDATE VERTEX ON {node_type} "{node_id}" '
-                
-        cypher += f'SET {set_clause} '
-                
-        cypher += f'YIELD {", ".join(set_attributes.keys())};'
+        # 字符串统一转义, 模板按 (tag, 属性集合) 缓存
+        cypher = self.query_builder.update_vertex(node_type, node_id, set_attributes)
 
         # 执行查询
         res = self.execute_cypher_return_status(cypher, self.space_name)
@@ -439,22 +634,7 @@ class NebulaHandler:
         # if self.check_edge_before_execute(src_id, dst_id) != None:
         #     return self.check_edge_before_execute(src_id, dst_id)
 
-        set_clause_parts = []
-        for k, v in set_attributes.items():
-            if k == 'extra' and isinstance(v, str):
-                # 转义 extra 字段中的 JSON 字符串中的双引号
-                v = v.replace('"', '\\"')
-                set_clause_parts.append(f'{k} = "{v}"')
-            elif isinstance(v, str):
-                set_clause_parts.append(f'{k} = "{v}"')
-            else:
-                set_clause_parts.append(f'{k} = {v}')
-
-        set_clause = ', '.join(set_clause_parts)
-
-        cypher = f'UPDATE EDGE ON {edge_type} "{src_id}" -> "{dst_id}" '
-                
-        cypher += f'SET {set_clause} '
+        cypher = self.query_builder.update_edge(edge_type, src_id, dst_id, set_attributes)
 
         # 执行查询
         res = self.execute_cypher_return_status(cypher, self.space_name)
@@ -606,26 +786,11 @@ class NebulaHandler:
     
     def get_current_nodes(self, attributes: dict, node_type: str = None, return_keys: list = []) -> List[GNode]:
         
-        # 生成MATCH子句
-        match_clause = f'MATCH (n0{":" + node_type if node_type else ""}) WITH n0, properties(n0) as props, keys(properties(n0)) as kk '
-
-        # 生成WHERE子句
-        where_clause = ' AND '.join(
-            f'props["{key}"] == "{value}"' if isinstance(value, str) else f'props["{key}"] == {value}'
-            for key, value in attributes.items()
-        )
-
-        # 将WHERE子句包装成正确的格式
-        where_clause = f'WHERE [i IN kk WHERE {where_clause}]'
-
-        # 生成RETURN子句
-        return_clause = 'RETURN n0' if not return_keys else f'RETURN n0, {", ".join(return_keys)}'
-
-        # 拼接最终的Cypher查询语句
-        cypher = f'{match_clause} {where_clause} {return_clause}'
+        # 参数化查询, 语句只随 schema 变化, 属性值通过 $p0, $p1... 绑定
+        cypher, params = self.query_builder.match_nodes(node_type, attributes, return_keys)
 
         # 执行查询
-        resp = self.execute_cypher(cypher, self.space_name)
+        resp = self.execute_cypher(cypher, self.space_name, params=params)
 
         decode_resp = self.decode_result(resp,['n0'])
 
@@ -725,6 +890,23 @@ class NebulaHandler:
         result = self.get_neighbor_nodes(attributes, node_type)
         return len(result) > 0
 
+    def get_reachable_nodeids(self, attributes: dict, node_type: str = None, hop: int = 15, reverse=False) -> set:
+        '''GO 按步去重扩展, 只返回可达节点 id, 不枚举路径'''
+        if attributes.get('id'):
+            id_list = [attributes['id']]
+        else:
+            id_list = [item.id for item in self.get_current_nodes(attributes, node_type)]
+        if not id_list: return set()
+
+        vids = ", ".join(self.query_builder.literal(i) for i in id_list)
+        # REVERSELY 时 src(edge) 才是沿遍历方向的下一个节点
+        if reverse:
+            cypher = f'GO 1 TO {hop} STEPS FROM {vids} OVER * REVERSELY YIELD DISTINCT src(edge) AS id'
+        else:
+            cypher = f'GO 1 TO {hop} STEPS FROM {vids} OVER * YIELD DISTINCT dst(edge) AS id'
+        resp = self.execute_cypher(cypher, self.space_name)
+        return set(id_list) | {item['id'] for item in resp}
+
     # 结果待去重
     def get_hop_infos(self, attributes: dict, node_type: str = None, hop: int = 2, block_attributes: List[dict] = {}, select_attributes: dict = {}, reverse=False) -> Graph:
         '''
@@ -982,6 +1164,39 @@ class NebulaHandler:
         else:
             return True
 
+    def get_exist_nodeids(self, nodeids: List[str]) -> set:
+        '''
+        批量查询已存在的节点id, 每个分块只执行一条 FETCH
+        @param nodeids: 待检查的节点id
+        @return: 已存在的节点id集合
+        '''
+        nodeids = list(dict.fromkeys(nodeids))
+        exist_ids = set()
+        for i in range(0, len(nodeids), self.batch_size):
+            nodeids_str = '", "'.join(nodeids[i: i+self.batch_size])
+            cypher = f'FETCH PROP ON * "{nodeids_str}" YIELD id(vertex) AS vid'
+            resp = self.execute_cypher(cypher, self.space_name)
+            exist_ids.update(self.convert_value(item.get('vid')) for item in resp)
+        return exist_ids
+
+    def get_exist_edgeids(self, src_ids: List[str]) -> set:
+        '''
+        批量查询从 src_ids 出发的已存在边, 每个分块只执行一条 GO
+        @param src_ids: 起点id
+        @return: 已存在边的 (src_id, dst_id) 集合
+        '''
+        src_ids = list(dict.fromkeys(src_ids))
+        exist_pairs = set()
+        for i in range(0, len(src_ids), self.batch_size):
+            src_ids_str = '", "'.join(src_ids[i: i+self.batch_size])
+            cypher = f'GO FROM "{src_ids_str}" OVER * YIELD src(edge) AS src, dst(edge) AS dst'
+            resp = self.execute_cypher(cypher, self.space_name)
+            exist_pairs.update(
+                (self.convert_value(item.get('src')), self.convert_value(item.get('dst')))
+                for item in resp
+            )
+        return exist_pairs
+
     def check_edge_exist(self, src_id: str, dst_id: str) -> bool:
         try:
             if self.get_current_edge(src_id, dst_id):
@@ -1,89 +1,274 @@
 import os
 import networkx as nx
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Union
 
+from .base_gb_handler import GBHandler
+from .graph_store import CSRGraphStore
+from muagent.db_handler.utils import bfs_hop_traversal
 from muagent.schemas.common import *
 from muagent.base_configs.env_config import KB_ROOT_PATH
 from muagent.schemas.db import GBConfig
+from muagent.utils.common_utils import double_hashing
 
 
 
-class NetworkxHandler:
+class NetworkxHandler(GBHandler):
+    '''
+    local directed graph handler backed by CSRGraphStore,
+    saved as a binary snapshot plus delta log, networkx is only used to export/import graphml
+    '''
     def __init__(
-            self, 
-            kb_root_path: str = KB_ROOT_PATH,
+            self,
             gb_config: GBConfig = None,
+            kb_root_path: str = KB_ROOT_PATH,
         ):
-        self.graph = nx.Graph()  # 使用有向图，根据需要也可以使用无向图 nx.Graph()
+        if isinstance(gb_config, str):
+            # compatible with NetworkxHandler(kb_root_path)
+            gb_config, kb_root_path = None, gb_config
+        extra_kwargs = gb_config.extra_kwargs if gb_config else {}
+        self.graph = CSRGraphStore(
+            index_keys=extra_kwargs.get("index_keys", ["type", "teamids"]),
+            compact_threshold=extra_kwargs.get("compact_threshold", 1024),
+        )
         self.kb_root_path = kb_root_path
         self.gb_config = gb_config
         self.kb_name = "default"
+        # save rewrites the snapshot once the delta log outgrows this many records (or 1/4 of the graph)
+        self.snapshot_threshold = extra_kwargs.get("snapshot_threshold", 10000)
+        self.snapshot_mmap = extra_kwargs.get("snapshot_mmap", True)
+        self.export_graphml_on_save = extra_kwargs.get("export_graphml", False)
+        # the snapshot dir that the in-memory graph and its journal are based on
+        self._snapshot_dir = None
 
-    def add_node(self, node: GNode):
-        insert_nodes = self.node_process([node])
-        self.graph.add_nodes_from(insert_nodes)
+    def add_node(self, node: GNode) -> GbaseExecStatus:
+        return self.add_nodes([node])
 
-    def add_nodes(self, nodes: List[GNode]):
-        insert_nodes = self.node_process(nodes)
-        self.graph.add_nodes_from(insert_nodes)
+    def add_nodes(self, nodes: List[GNode]) -> GbaseExecStatus:
+        results = []
+        for node in nodes:
+            try:
+                attributes = {k: v for k, v in node.attributes.items() if k not in ["id", "type"]}
+                attributes["ID"] = attributes.get("ID") or double_hashing(node.id)
+                self.graph.upsert_node(node.id, getattr(node, "type", None) or "", attributes)
+                results.append(GbaseExecStatus(errorMessage="", errorCode=0))
+            except Exception as e:
+                results.append(GbaseExecStatus(errorMessage=f"{node.id}: {e}", errorCode=2))
+        return self.merge_exec_status(results)
 
-    def add_edge(self, grelation: GRelation):
-        insert_relations = self.relation_process([grelation])
-        self.graph.add_edges_from(insert_relations)
+    def add_edge(self, edge: Union[GEdge, GRelation]) -> GbaseExecStatus:
+        return self.add_edges([edge])
 
-    def add_edges(self, grelations: List[GRelation]):
-        insert_relations = self.relation_process(grelations)
-        self.graph.add_edges_from(insert_relations)
+    def add_edges(self, edges: List[Union[GEdge, GRelation]]) -> GbaseExecStatus:
+        results = []
+        for edge in edges:
+            try:
+                # GRelation has no type
+                edge_type = getattr(edge, "type", None) or edge.attributes.get("type", "")
+                # missing endpoints are created like networkx.add_edges_from did
+                src_idx, dst_idx = self._ensure_node(edge.start_id), self._ensure_node(edge.end_id)
+                attributes = {k: v for k, v in edge.attributes.items() if k not in ["SRCID", "DSTID", "type"]}
+                self.graph.upsert_edge(src_idx, dst_idx, edge_type, attributes)
+                results.append(GbaseExecStatus(errorMessage="", errorCode=0))
+            except Exception as e:
+                results.append(GbaseExecStatus(errorMessage=f"{edge.start_id}->{edge.end_id}: {e}", errorCode=2))
+        return self.merge_exec_status(results)
 
-    def search_nodes_by_nodeid(self, nodeid: str) -> GNode:
-        if self.missing_node(nodeid): return None
- 
-        node_attrs = self.graph.nodes.get(nodeid, {})
-        return GNode(id=nodeid, attributes=node_attrs)
+    def _ensure_node(self, node_id: str) -> int:
+        idx = self.graph.node_index(node_id)
+        if idx < 0:
+            idx = self.graph.upsert_node(node_id, "", {"ID": double_hashing(node_id)})
+        return idx
+
+    def update_node(self, attributes: dict, set_attributes: dict, node_type: str = None, ID: int = None) -> GbaseExecStatus:
+        idxs = self._find_node_idxs(attributes, node_type, ID)
+        if not idxs:
+            return GbaseExecStatus(errorMessage=f"missing node {attributes}", errorCode=2)
+        set_attributes = {k: v for k, v in set_attributes.items() if k not in ["ID", "id", "type"]}
+        self.graph.update_node(idxs[0], set_attributes)
+        return GbaseExecStatus(errorMessage="", errorCode=0)
+
+    def update_edge(self, src_id, dst_id, set_attributes: dict, edge_type: str = None) -> GbaseExecStatus:
+        eidx = self._find_edge_idx(src_id, dst_id, edge_type)
+        if eidx < 0:
+            return GbaseExecStatus(errorMessage=f"missing edge {src_id}->{dst_id}", errorCode=2)
+        set_attributes = {k: v for k, v in set_attributes.items() if k not in ["SRCID", "DSTID", "type"]}
+        self.graph.update_edge(eidx, set_attributes)
+        return GbaseExecStatus(errorMessage="", errorCode=0)
+
+    def delete_node(self, attributes: Union[dict, str], node_type: str = None, ID: int = None) -> GbaseExecStatus:
+        if isinstance(attributes, str):
+            # compatible with delete_node(nodeid)
+            attributes = {"id": attributes}
+        for idx in self._find_node_idxs(attributes, node_type, ID)[:1]:
+            self.graph.remove_node(idx)
+        return GbaseExecStatus(errorMessage="", errorCode=0)
 
-    def search_edges_by_nodeid(self, nodeid: str) -> List[GRelation]:
-        if self.missing_node(nodeid): return []
-            
+    def delete_nodes(self, attributes: Union[dict, List[str]], node_type: str = None, IDs: List[int] = []) -> GbaseExecStatus:
+        if isinstance(attributes, list):
+            # compatible with delete_nodes(nodeids)
+            idxs = [self.graph.node_index(nodeid) for nodeid in attributes]
+        elif IDs:
+            idxs = [idx for ID in IDs for idx in self._find_node_idxs({}, node_type, ID)]
+        else:
+            idxs = self._find_node_idxs(attributes, node_type)
+        for idx in idxs:
+            if idx >= 0:
+                self.graph.remove_node(idx)
+        return GbaseExecStatus(errorMessage="", errorCode=0)
+
+    def delete_edge(self, src_id, dst_id, edge_type: str = None) -> GbaseExecStatus:
+        eidx = self._find_edge_idx(src_id, dst_id, edge_type)
+        if eidx >= 0:
+            self.graph.remove_edge(eidx)
+        return GbaseExecStatus(errorMessage="", errorCode=0)
+
+    def delete_edges(self, id_pairs: List, edge_type: str = None) -> GbaseExecStatus:
+        for src_id, dst_id in id_pairs:
+            self.delete_edge(src_id, dst_id, edge_type)
+        return GbaseExecStatus(errorMessage="", errorCode=0)
+
+    def delete_edges_by_nodeid(self, nodeid: str):
+        idx = self.graph.node_index(nodeid)
+        if idx < 0: return
+        for eidx in self.graph.out_edges(idx) + self.graph.in_edges(idx):
+            self.graph.remove_edge(eidx)
+
+    def clear(self):
+        self.graph.clear()
+
+    def get_nodeIDs(self, attributes: dict, node_type: str) -> List[int]:
+        return [self.graph.node_columns["ID"][idx] for idx in self._find_node_idxs(attributes, node_type)]
+
+    def get_current_node(self, attributes: dict, node_type: str = None, return_keys: list = []) -> GNode:
+        result = self.get_current_nodes(attributes, node_type, return_keys)
+        return result[0] if result else None
+
+    def get_nodes_by_ids(self, ids: List[int] = []) -> List[GNode]:
+        # ids from tbase are str
+        IDs = [int(ID) if isinstance(ID, str) and ID.isdigit() else ID for ID in ids]
+        idxs = [idx for ID in IDs for idx in self.graph.find_nodes({"ID": ID})]
+        return [self._to_gnode(idx) for idx in idxs]
+
+    def get_current_nodes(self, attributes: dict, node_type: str = None, return_keys: list = []) -> List[GNode]:
+        return [self._to_gnode(idx, return_keys) for idx in self._find_node_idxs(attributes, node_type)]
+
+    def get_current_edge(self, src_id, dst_id, edge_type: str = None, return_keys: list = []) -> GEdge:
+        eidx = self._find_edge_idx(src_id, dst_id, edge_type)
+        return self._to_gedge(eidx) if eidx >= 0 else None
+
+    def get_neighbor_nodes(self, attributes: dict, node_type: str = None, return_keys: list = [], reverse=False) -> List[GNode]:
+        neighbor_idxs = {}
+        for idx in self._find_node_idxs(attributes, node_type):
+            for _, neighbor_idx in self.graph.neighbors(idx, reverse):
+                neighbor_idxs.setdefault(neighbor_idx, None)
+        return [self._to_gnode(idx, return_keys) for idx in neighbor_idxs]
+
+    def get_neighbor_edges(self, attributes: dict, node_type: str = None, return_keys: list = []) -> List[GEdge]:
         return [
-            GRelation(
-                # id=f"{nodeid}-{neighbor}",
-                start_id=nodeid,
-                end_id=neighbor,
-                attributes=self.graph.get_edge_data(nodeid, neighbor)
+            self._to_gedge(eidx)
+            for idx in self._find_node_idxs(attributes, node_type)
+            for eidx in self.graph.out_edges(idx)
+        ]
+
+    def check_neighbor_exist(self, attributes: dict, node_type: str = None, check_attributes: dict = {}) -> bool:
+        result = self.get_neighbor_nodes(attributes, node_type,)
+        filter_result = [i for i in result if all([item in i.attributes.items() for item in check_attributes.items()])]
+        return len(filter_result) > 0
+
+    def get_reachable_nodeids(self, attributes: dict, node_type: str = None, hop: int = 15, reverse=False) -> set:
+        visited = set(self._find_node_idxs(attributes, node_type))
+        frontier = list(visited)
+        for _ in range(hop):
+            next_frontier = [
+                neighbor_idx for idx in frontier for _, neighbor_idx in self.graph.neighbors(idx, reverse)
+                if neighbor_idx not in visited
+            ]
+            next_frontier = list(dict.fromkeys(next_frontier))
+            if not next_frontier: break
+            visited.update(next_frontier)
+            frontier = next_frontier
+        return {self.graph.nodeids[idx] for idx in visited}
+
+    def get_hop_infos(
+            self,
+            attributes: dict,
+            node_type: str = None,
+            hop: int = 2,
+            block_attributes: List[dict] = [],
+            select_attributes: dict = {},
+            reverse=False
+        ) -> Graph:
+        '''
+        hop >= 1, expand level by level on the csr adjacency
+        '''
+        def _node_dict(idx) -> dict:
+            return {"id": self.graph.nodeids[idx], "type": self.graph.node_types[idx], **self.graph.node_attributes(idx)}
+
+        def _is_blocked(idx) -> bool:
+            node = _node_dict(idx)
+            return any(
+                block_attribute and all(item in node.items() for item in block_attribute.items())
+                for block_attribute in block_attributes
+            ) or (
+                select_attributes and any(item in node.items() for item in select_attributes.items())
             )
-            for neighbor, attr in self.graph.adj[nodeid].items()
+
+        def _expand(frontier_idxs: List[int]) -> List:
+            return [
+                (idx, neighbor_idx, eidx)
+                for idx in frontier_idxs
+                for eidx, neighbor_idx in self.graph.neighbors(idx, reverse)
+            ]
+
+        visited_idxs, eidxs, paths = bfs_hop_traversal(
+            self._find_node_idxs(attributes, node_type), _expand, hop, is_blocked=_is_blocked
+        )
+        if not paths:
+            return Graph(nodes=[], edges=[], paths=[])
+
+        path_idxs = set([j for i in paths for j in i])
+        nodes = [self._to_gnode(idx) for idx in visited_idxs if idx in path_idxs]
+        edges = [
+            self._to_gedge(eidx) for eidx in dict.fromkeys(eidxs)
+            if self.graph.edge_src[eidx] in path_idxs and self.graph.edge_dst[eidx] in path_idxs
         ]
-        
-    def search_edges_by_nodeids(self, start_id: str, end_id: str) -> GRelation:
+        # paths keep the edge direction
+        paths = [[self.graph.nodeids[idx] for idx in path] for path in paths]
+        if reverse:
+            paths = [path[::-1] for path in paths]
+        return Graph(nodes=nodes, edges=edges, paths=paths)
+
+    def get_hop_nodes(self, attributes: dict, node_type: str = None, hop: int = 2, block_attributes: List[dict] = []) -> List[GNode]:
+        result = self.get_hop_infos(attributes, node_type, hop, block_attributes)
+        return result.nodes
+
+    def get_hop_edges(self, attributes: dict, node_type: str = None, hop: int = 2, block_attributes: List[dict] = []) -> List[GEdge]:
+        result = self.get_hop_infos(attributes, node_type, hop, block_attributes)
+        return result.edges
+
+    def get_hop_paths(self, attributes: dict, node_type: str = None, hop: int = 2, block_attributes: List[dict] = []) -> List[str]:
+        result = self.get_hop_infos(attributes, node_type, hop, block_attributes)
+        return result.paths
+
+    def search_nodes_by_nodeid(self, nodeid: str) -> GNode:
+        if self.missing_node(nodeid): return None
+        return self._to_gnode(self.graph.node_index(nodeid))
+
+    def search_edges_by_nodeid(self, nodeid: str) -> List[GEdge]:
+        idx = self.graph.node_index(nodeid)
+        if idx < 0: return []
+        return [self._to_gedge(eidx) for eidx in self.graph.out_edges(idx) + self.graph.in_edges(idx)]
+
+    def search_edges_by_nodeids(self, start_id: str, end_id: str) -> GEdge:
         if self.missing_node(start_id) or self.missing_node(end_id): return None
-        if self.missing_edge(start_id, end_id): return None
+        return self.get_current_edge(start_id, end_id)
 
-        return GRelation(
-                # id=f"{start_id}-{end_id}",
-                start_id=start_id,
-                end_id=end_id,
-                attributes=self.graph.get_edge_data(start_id, end_id)
-            )
-        
     def search_nodes_by_attr(self, **attributes) -> List[GNode]:
-        return [
-            GNode(id=node, attributes=attr) 
-            for node, attr in self.graph.nodes(data=True) 
-            if all(attr.get(k) == v for k, v in attributes.items())
-        ]
+        return self.get_current_nodes(attributes)
+
+    def search_edges_by_attr(self, **attributes) -> List[GEdge]:
+        return [self._to_gedge(eidx) for eidx in self.graph.find_edges(attributes)]
 
-    def search_edges_by_attr(self, **attributes) -> List[GRelation]:
-        return [
-            GRelation(
-                # id=f"{left}-{right}",
-                start_id=left,
-                end_id=right,
-                attributes=attr
-            ) 
-            for left, right, attr in self.graph.edges(data=True) 
-            if all(attr.get(k) == v for k, v in attributes.items())
-        ]
-    
     def save(self, kb_name: str):
         self.kb_name = kb_name or self.kb_name
         self.save_to_local(self.kb_name)
@@ -95,53 +280,96 @@ class NetworkxHandler:
 
     def save_to_local(self, kb_name: str):
         dir_path = os.path.join(self.kb_root_path, kb_name)
-        os.makedirs(dir_path, exist_ok=True)
-        # 将图保存到本地文件
-        nx.write_graphml(self.graph, os.path.join(dir_path, 'graph.graphml'))
-        
+        snapshot_dir = os.path.join(dir_path, "graph_snapshot")
+        pending = len(self.graph.journal or [])
+        # 增量保存：只追加delta log，log过大时重写snapshot
+        if (
+            self._snapshot_dir != snapshot_dir or self.graph.journal is None
+            or self.graph.log_size + pending > max(self.snapshot_threshold, (self.graph.node_count + self.graph.edge_count) // 4)
+        ):
+            self.graph.save_snapshot(snapshot_dir)
+        else:
+            self.graph.append_log(snapshot_dir)
+        self._snapshot_dir = snapshot_dir
+
+        if self.export_graphml_on_save:
+            self.export_graphml(os.path.join(dir_path, 'graph.graphml'))
+
     def load_from_local(self, kb_name: str):
         dir_path = os.path.join(self.kb_root_path, kb_name)
-        # 从本地文件加载图
-        if os.path.exists(os.path.join(dir_path, 'graph.graphml')):
-            self.graph = nx.read_graphml(os.path.join(dir_path, 'graph.graphml'))
+        snapshot_dir = os.path.join(dir_path, "graph_snapshot")
+        # 从本地文件加载图, 优先snapshot, 兼容graphml
+        if self.graph.load_snapshot(snapshot_dir, mmap=self.snapshot_mmap):
+            self._snapshot_dir = snapshot_dir
+        elif os.path.exists(os.path.join(dir_path, 'graph.graphml')):
+            self.from_networkx(nx.read_graphml(os.path.join(dir_path, 'graph.graphml')))
 
-    def delete_node(self, nodeid: str):
-        self.graph.remove_node(nodeid)
+    def export_graphml(self, file_path: str):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        nx.write_graphml(self.to_networkx(), file_path)
 
-    def delete_nodes(self, nodeids: List[str]):
-        self.graph.remove_nodes_from(nodeids)
-        
-    def delete_edges_by_nodeid(self, nodeid: str):
-        edges = list(self.graph.edges(nodeid))
-        self.graph.remove_edges_from(edges)
+    def to_networkx(self) -> nx.MultiDiGraph:
+        graph = nx.MultiDiGraph()
+        for idx, nodeid in enumerate(self.graph.nodeids):
+            if self.graph.node_alive[idx]:
+                graph.add_node(nodeid, type=self.graph.node_types[idx], **self.graph.node_attributes(idx))
+        for eidx, edge_type in enumerate(self.graph.edge_types):
+            if self.graph.edge_alive[eidx]:
+                graph.add_edge(
+                    self.graph.nodeids[self.graph.edge_src[eidx]], self.graph.nodeids[self.graph.edge_dst[eidx]],
+                    key=edge_type, type=edge_type, **self.graph.edge_attributes(eidx)
+                )
+        return graph
 
-    def delete_edge(self, left: str, right: str):
-        self.graph.remove_edges_from([(left, right)])
-        
-    def delete_edges(self, edges: List[Tuple]):
-        self.graph.remove_edges_from(edges)
-
-    def clear(self):
+    def from_networkx(self, graph: nx.Graph):
+        # the next save writes a full snapshot
+        self.graph.journal, self._snapshot_dir = None, None
         self.graph.clear()
+        for nodeid, attrs in graph.nodes(data=True):
+            attrs = dict(attrs)
+            attrs["ID"] = attrs.get("ID") or double_hashing(nodeid)
+            self.graph.upsert_node(nodeid, attrs.pop("type", ""), attrs)
+        for left, right, attrs in graph.edges(data=True):
+            attrs = dict(attrs)
+            self.graph.upsert_edge(
+                self.graph.node_index(left), self.graph.node_index(right), attrs.pop("type", ""), attrs
+            )
+        self.graph.compact()
 
-    def node_process(self, nodes: List[GNode]) -> List[Tuple]:
-        node_list = []
-        for node in nodes:
-            node_id = node.id
-            node_attrs = node.attributes
-            node_list.append((node_id, node_attrs))
+    def missing_edge(self, left: str, right: str) -> bool:
+        return self._find_edge_idx(left, right) < 0
 
-        return node_list
+    def missing_node(self, nodeid: str) -> bool:
+        return not self.graph.has_node(nodeid)
 
-    def relation_process(self, relations: List[GRelation]) -> List[Tuple]:
-        relation_list = []
-        for relation in relations:
-            edge_attrs = relation.attributes
-            relation_list.append((relation.start_id, relation.end_id, edge_attrs))
-        return relation_list
+    def _find_node_idxs(self, attributes: dict, node_type: str = None, ID: int = None) -> List[int]:
+        if isinstance(ID, int):
+            return self.graph.find_nodes({"ID": ID}, node_type)
+        return self.graph.find_nodes(attributes, node_type)
 
-    def missing_edge(self, left: str, right: str) -> bool:
-        return not self.graph.has_edge(left, right)
-        
-    def missing_node(self, nodeid: str) -> bool:
-        return nodeid not in self.graph.nodes
\ No newline at end of file
+    def _find_edge_idx(self, src_id, dst_id, edge_type: str = None) -> int:
+        if isinstance(src_id, int) and isinstance(dst_id, int):
+            # SRCID/DSTID
+            src_idxs, dst_idxs = self._find_node_idxs({}, None, src_id), self._find_node_idxs({}, None, dst_id)
+            src_idx, dst_idx = (src_idxs or [-1])[0], (dst_idxs or [-1])[0]
+        else:
+            src_idx, dst_idx = self.graph.node_index(src_id), self.graph.node_index(dst_id)
+        if src_idx < 0 or dst_idx < 0: return -1
+        return self.graph.edge_index(src_idx, dst_idx, edge_type)
+
+    def _to_gnode(self, idx: int, return_keys: list = []) -> GNode:
+        keys = list(set(return_keys + ["ID"])) if return_keys else None
+        return GNode(
+            id=self.graph.nodeids[idx], type=self.graph.node_types[idx],
+            attributes=self.graph.node_attributes(idx, keys)
+        )
+
+    def _to_gedge(self, eidx: int) -> GEdge:
+        src_idx, dst_idx = self.graph.edge_src[eidx], self.graph.edge_dst[eidx]
+        attributes = self.graph.edge_attributes(eidx)
+        attributes["SRCID"] = self.graph.node_columns["ID"][src_idx]
+        attributes["DSTID"] = self.graph.node_columns["ID"][dst_idx]
+        return GEdge(
+            start_id=self.graph.nodeids[src_idx], end_id=self.graph.nodeids[dst_idx],
+            type=self.graph.edge_types[eidx], attributes=attributes
+        )
@@ -0,0 +1,189 @@
+from typing import List, Dict, Tuple, Callable, Any
+import threading
+
+
+class QueryBuilder:
+    '''
+    builds gql/ngql statements from templates which are compiled once per
+    (statement, label, property names) and cached, values are bound by the
+    dialect's literal encoder so every string is escaped the same way
+    '''
+    quote: str = '"'
+    escape_table: Dict[int, str] = {}
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._templates: Dict[Tuple, Any] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def template(self, key: Tuple, factory: Callable[[], Any]) -> Any:
+        tpl = self._templates.get(key)
+        if tpl is not None:
+            self.hits += 1
+            return tpl
+
+        tpl = factory()
+        with self._lock:
+            self.misses += 1
+            if len(self._templates) >= self.maxsize:
+                self._templates.clear()
+            self._templates[key] = tpl
+        return tpl
+
+    def literal(self, value) -> str:
+        if value is None:
+            return "NULL"
+        if isinstance(value, str):
+            return f"{self.quote}{value.translate(self.escape_table)}{self.quote}"
+        return f"{value}"
+
+    def cache_info(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._templates), "maxsize": self.maxsize}
+
+
+class NebulaQueryBuilder(QueryBuilder):
+    quote = '"'
+    escape_table = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r", "\t": "\\t"})
+
+    def insert_vertex(self, tag_name: str, properties_name: Tuple[str], rows: List[Tuple[str, dict]]) -> str:
+        '''rows: [(vid, attributes)], one multi-value INSERT VERTEX'''
+        head, row = self.template(
+            ("insert_vertex", tag_name, properties_name),
+            lambda: (
+                f'INSERT VERTEX {tag_name} ({",".join(properties_name)}) VALUES ',
+                "{}:(" + ",".join(["{}"] * len(properties_name)) + ")"
+            )
+        )
+        literal = self.literal
+        values = ", ".join(
+            row.format(literal(vid), *[literal(attributes.get(k)) for k in properties_name])
+            for vid, attributes in rows
+        )
+        return f"{head}{values};"
+
+    def insert_edge(self, edge_type: str, properties_name: Tuple[str], rows: List[Tuple[str, str, dict]]) -> str:
+        '''rows: [(src_vid, dst_vid, attributes)], one multi-value INSERT EDGE'''
+        def _factory():
+            # @timestamp 需要转成 `timestamp`
+            properties_str = ",".join("`timestamp`" if k == "@timestamp" else k for k in properties_name)
+            return (
+                f"INSERT EDGE {edge_type} ({properties_str}) VALUES ",
+                "{}->{}:(" + ",".join(["{}"] * len(properties_name)) + ")"
+            )
+
+        head, row = self.template(("insert_edge", edge_type, properties_name), _factory)
+        literal = self.literal
+        values = ", ".join(
+            row.format(literal(src_vid), literal(dst_vid), *[literal(attributes.get(k)) for k in properties_name])
+            for src_vid, dst_vid, attributes in rows
+        )
+        return f"{head}{values};"
+
+    def update_vertex(self, tag_name: str, vid: str, set_attributes: dict) -> str:
+        keys = tuple(set_attributes.keys())
+        tpl = self.template(
+            ("update_vertex", tag_name, keys),
+            lambda: (
+                f"UPDATE VERTEX ON {tag_name} {{}} SET "
+                + ", ".join(f"{k} = {{}}" for k in keys)
+                + f" YIELD {', '.join(keys)};"
+            )
+        )
+        return tpl.format(self.literal(vid), *[self.literal(v) for v in set_attributes.values()])
+
+    def update_edge(self, edge_type: str, src_vid: str, dst_vid: str, set_attributes: dict) -> str:
+        keys = tuple(set_attributes.keys())
+        tpl = self.template(
+            ("update_edge", edge_type, keys),
+            lambda: (
+                f"UPDATE EDGE ON {edge_type} {{}} -> {{}} SET "
+                + ", ".join(f"{k} = {{}}" for k in keys)
+            )
+        )
+        return tpl.format(
+            self.literal(src_vid), self.literal(dst_vid), *[self.literal(v) for v in set_attributes.values()]
+        )
+
+    def match_nodes(self, node_type: str, attributes: dict, return_keys: list = []) -> Tuple[str, dict]:
+        '''
+        parameterized MATCH, the statement text only depends on the schema so the server can reuse its plan
+        :return: statement, params ($p0, $p1, ...)
+        '''
+        keys, return_keys = tuple(attributes.keys()), tuple(return_keys)
+
+        def _factory():
+            match_clause = f'MATCH (n0{":" + node_type if node_type else ""}) WITH n0, properties(n0) as props, keys(properties(n0)) as kk'
+            where_clause = " AND ".join(f'props["{k}"] == $p{i}' for i, k in enumerate(keys))
+            where_clause = f" WHERE [i IN kk WHERE {where_clause}]" if keys else ""
+            return_clause = "RETURN n0" if not return_keys else f'RETURN n0, {", ".join(return_keys)}'
+            return f"{match_clause}{where_clause} {return_clause}"
+
+        stmt = self.template(("match_nodes", node_type, keys, return_keys), _factory)
+        return stmt, {f"p{i}": v for i, v in enumerate(attributes.values())}
+
+
+class GeaBaseQueryBuilder(QueryBuilder):
+    quote = "'"
+    escape_table = str.maketrans({"\\": "\\\\", "'": "\\'", "\n": "\\n", "\r": "\\r", "\t": "\\t"})
+
+    def literal(self, value) -> str:
+        # bool 和 str 一样以字符串写入
+        if isinstance(value, bool):
+            value = f"{value}"
+        return super().literal(value)
+
+    def insert_nodes(self, rows: List[Tuple[str, dict]]) -> str:
+        '''rows: [(node_type, attributes)]'''
+        patterns = []
+        for node_type, attributes in rows:
+            keys = tuple(attributes.keys())
+            tpl = self.template(
+                ("insert_node", node_type, keys),
+                lambda: f"(:{node_type} {{{{" + ", ".join(f"{k}: {{}}" for k in keys) + "}})"
+            )
+            patterns.append(tpl.format(*[self.literal(v) for v in attributes.values()]))
+        return f"INSERT {','.join(patterns)}"
+
+    def insert_edges(self, rows: List[Tuple[str, dict]]) -> str:
+        '''rows: [(edge_type, attributes)], @src_id/@dst_id are part of attributes'''
+        patterns = []
+        for edge_type, attributes in rows:
+            keys = tuple(attributes.keys())
+            tpl = self.template(
+                ("insert_edge", edge_type, keys),
+                lambda: f"()-[:{edge_type} {{{{" + ", ".join(f"{k}: {{}}" for k in keys) + "}}]->()"
+            )
+            patterns.append(tpl.format(*[self.literal(v) for v in attributes.values()]))
+        return f"INSERT {','.join(patterns)}"
+
+    def match_neighbors(self, IDs: List[int], reverse: bool = False, return_edges: bool = True) -> str:
+        '''one level of a hop expansion, the neighbors (and edges) of the nodes whose @id is in IDs'''
+        tpl = self.template(
+            ("match_neighbors", reverse, return_edges),
+            lambda: (
+                "MATCH (n0 WHERE @id in [{}])" + ("<-[e]-" if reverse else "-[e]->") + "(n1) "
+                + ("RETURN n0, n1, e" if return_edges else "RETURN n1")
+            )
+        )
+        return tpl.format(", ".join(self.literal(ID) for ID in IDs))
+
+    def update_node(self, node_type: str, ID: int, set_attributes: dict) -> str:
+        keys = tuple(set_attributes.keys())
+        tpl = self.template(
+            ("update_node", node_type, keys),
+            lambda: f"MATCH (n:{node_type}) WHERE n.@ID={{}} SET " + ", ".join(f"n.{k}={{}}" for k in keys)
+        )
+        return tpl.format(self.literal(ID), *[self.literal(v) for v in set_attributes.values()])
+
+    def update_edge(self, src_type: str, dst_type: str, src_id: int, dst_id: int, set_attributes: dict) -> str:
+        keys = tuple(set_attributes.keys())
+        tpl = self.template(
+            ("update_edge", src_type, dst_type, keys),
+            lambda: (
+                f"MATCH (n0:{src_type} {{{{@id: {{}}}}}})-[e]->(n1:{dst_type} {{{{@id:{{}}}}}}) SET "
+                + ", ".join(f"e.{k}={{}}" for k in keys)
+            )
+        )
+        return tpl.format(self.literal(src_id), self.literal(dst_id), *[self.literal(v) for v in set_attributes.values()])
@@ -1,4 +1,7 @@
 
+from typing import List, Tuple, Callable, Any
+
+
 def deduplicate_dict(dict_list: list = []):
     seen = set()
     unique_dicts = []
@@ -10,4 +13,65 @@ def deduplicate_dict(dict_list: list = []):
             seen.add(d_tuple)
             unique_dicts.append(d)
     
-    return unique_dicts
\ No newline at end of file
+    return unique_dicts
+
+def bfs_hop_traversal(
+        root_ids: List[str],
+        expand_func: Callable[[List[str]], List[Tuple[str, str, Any]]],
+        hop: int,
+        is_blocked: Callable[[str], bool] = None,
+    ) -> Tuple[List[str], List[Any], List[List[str]]]:
+    '''
+    k-hop BFS from root_ids, every node is expanded at most once (visited-set pruning),
+    blocked nodes are dropped while expanding and paths are only extended at their tail.
+    like the variable length MATCH of nebula every maximal path without repeated nodes is
+    returned, e.g. both a->b->d and a->c->d, only the neighbor queries are deduplicated
+
+    :param root_ids: start node ids
+    :param expand_func: expand one level, frontier ids -> [(parent_id, child_id, edge)],
+        child is the neighbor in traversal direction
+    :param hop: max number of edges of a path
+    :param is_blocked: node id -> whether the node (and the paths through it) should be dropped
+    :return: visited node ids in discovery order, traversed edges, maximal paths
+    '''
+    is_blocked = is_blocked or (lambda node_id: False)
+    root_ids = [i for i in dict.fromkeys(root_ids) if not is_blocked(i)]
+
+    visited = set(root_ids)
+    visited_ids = list(root_ids)
+    edges = []
+    # expanded node -> its children which are not blocked
+    children = {}
+    open_paths = [[i] for i in root_ids]
+    maximal_paths = []
+    frontier = list(root_ids)
+    for _ in range(hop):
+        if not open_paths: break
+
+        # a path tail is at most as deep as the path, so it is always expanded by now
+        if frontier:
+            next_frontier = []
+            for parent_id, child_id, edge in expand_func(frontier):
+                if child_id not in visited:
+                    if is_blocked(child_id): continue
+                    visited.add(child_id)
+                    visited_ids.append(child_id)
+                    next_frontier.append(child_id)
+                edges.append(edge)
+                children.setdefault(parent_id, {})[child_id] = None
+            frontier = next_frontier
+
+        # a path is maximal once its tail has no children outside of the path
+        new_paths = []
+        for path in open_paths:
+            child_ids = [i for i in children.get(path[-1], ()) if i not in path]
+            if child_ids:
+                new_paths.extend(path + [child_id] for child_id in child_ids)
+            else:
+                maximal_paths.append(path)
+        open_paths = new_paths
+
+    maximal_paths.extend(open_paths)
+    # single node paths mean the root has no neighbors
+    maximal_paths = [path for path in maximal_paths if len(path) > 1]
+    return visited_ids, edges, maximal_paths
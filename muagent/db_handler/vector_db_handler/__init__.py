@@ -7,9 +7,10 @@
 '''
 
 from .chroma_handler import ChromaHandler
-from .tbase_handler import TbaseHandler
+from .tbase_handler import TbaseHandler, get_tbase_handler, get_connection_pool, tbase_pool_stats
 from .local_faiss_handler import LocalFaissHandler
 
 __all__ = [
-    "ChromaHandler", "TbaseHandler", "LocalFaissHandler"
+    "ChromaHandler", "TbaseHandler", "LocalFaissHandler",
+    "get_tbase_handler", "get_connection_pool", "tbase_pool_stats"
 ]
\ No newline at end of file
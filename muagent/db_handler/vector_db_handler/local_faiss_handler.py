@@ -1,6 +1,6 @@
 from loguru import logger
 from typing import List
-from functools import lru_cache
+from collections import OrderedDict
 import os, shutil
 
 from langchain.embeddings.base import Embeddings
@@ -9,12 +9,13 @@ from langchain_community.docstore.document import Document
 from muagent.utils.server_utils import torch_gc
 from muagent.retrieval.base_service import SupportedVSType
 from muagent.retrieval.faiss_m import FAISS
+from muagent.retrieval.faiss_wal import FaissWAL, get_faiss_wal, reset_faiss_wal
 from muagent.llm_models.llm_config import EmbedConfig
 from muagent.schemas.db import VBConfig
-from muagent.retrieval.utils import load_embeddings_from_path
+from muagent.retrieval.utils import load_embeddings_from_path, faiss_index_kwargs
 
 from muagent.base_configs.env_config import (
-    KB_ROOT_PATH, FAISS_NORMALIZE_L2, SCORE_THRESHOLD
+    KB_ROOT_PATH, FAISS_NORMALIZE_L2, SCORE_THRESHOLD, CACHED_VS_NUM
 )
 
 
@@ -41,19 +42,41 @@ class LocalFaissHandler:
         self.kb_root_path = vb_config.kb_root_path or KB_ROOT_PATH
         self.kb_path = "default"
         self.vs_path = "default"
+        self.wal: FaissWAL = None
+        # recently used stores, vs_path -> (wal, store), so switching kb_name does not reload them
+        self._stores: OrderedDict = OrderedDict()
+        self.cached_vs_num = int(CACHED_VS_NUM)
+        # adds/deletes are logged and checkpointed in background instead of save_local per add
+        extra_kwargs = (vb_config.extra_kwargs if vb_config else None) or {}
+        self.checkpoint_interval = extra_kwargs.get("checkpoint_interval", 60)
+        self.checkpoint_ops = extra_kwargs.get("checkpoint_ops", 1000)
+        # faiss index factory (IVF/HNSW/PQ) and its training/search knobs, see FAISS.__init__
+        self.index_kwargs = faiss_index_kwargs(extra_kwargs)
         # DEFAULT
         self.distance_strategy = "EUCLIDEAN_DISTANCE"
         # init search_index
         self.create_vs()
 
-    @lru_cache(1)
     def create_vs(self, kb_name: str = None):
+        '''
+        bind the vector store of kb_name. a store is loaded (checkpoint + wal replay) once per vs_path and
+        shared through its wal, later calls only look it up
+        '''
         kb_name = kb_name or self.kb_name
-        self.mkdir_vspath(kb_name, self.kb_root_path)
-        if "index.faiss" in os.listdir(self.vs_path):
-            self.load_vs_from_localdir(self.vs_path)
+        vs_path = LocalFaissHandler.get_vs_path(kb_name, self.kb_root_path)
+        if vs_path in self._stores:
+            self.wal = self._stores[vs_path][0]
+            self.vs_path = vs_path
+            self.kb_path = LocalFaissHandler.get_kb_path(kb_name, self.kb_root_path)
         else:
-            self.create_empty_vs()
+            self.mkdir_vspath(kb_name, self.kb_root_path)
+            self.wal = get_faiss_wal(self.vs_path, self.checkpoint_interval, self.checkpoint_ops)
+        # a store dropped by a reset of the directory is loaded again
+        self.search_index = self.wal.load(self.load_vs_from_localdir)
+        self._stores[vs_path] = (self.wal, self.search_index)
+        self._stores.move_to_end(vs_path)
+        while len(self._stores) > self.cached_vs_num:
+            self._stores.popitem(last=False)
 
     def add_docs(
         self,
@@ -63,14 +86,18 @@ class LocalFaissHandler:
     ):
         if kb_name:
             self.create_vs(kb_name)
-        # 可能需要临时修改处理
-        self.search_index.embedding_function = self.embeddings.embed_documents
         # logger.info("loaded docs, docs' lens is {}".format(len(docs)))
-        self.search_index.add_documents(docs)
+        ids = self.wal.add_documents(self.search_index, docs, self.embeddings.embed_documents)
         torch_gc()
-        self.search_index.save_local(self.vs_path)
+        return ids
+
+    def checkpoint(self):
+        '''save the current vector store now and truncate its write-ahead log'''
+        return self.wal.checkpoint(force=True, search_index=self.search_index)
 
     def clear_vs(self):
+        self.wal.reset()
+        self._stores.pop(self.vs_path, None)
         if os.path.exists(self.kb_path):
             shutil.rmtree(self.kb_path)
         os.makedirs(self.kb_path)
@@ -83,12 +110,16 @@ class LocalFaissHandler:
             return True
         
         if kb_name:
+            reset_faiss_wal(LocalFaissHandler.get_vs_path(kb_name, self.kb_root_path))
+            self._stores.pop(LocalFaissHandler.get_vs_path(kb_name, self.kb_root_path), None)
             kb_path = LocalFaissHandler.get_kb_path(kb_name, self.kb_root_path)
             return _del(kb_path)
         
         for dir in os.listdir(self.kb_root_path):
             dir_path = os.path.join(self.kb_root_path, dir)
             if not os.path.isdir(dir_path): continue
+            reset_faiss_wal(LocalFaissHandler.get_vs_path(dir, self.kb_root_path))
+            self._stores.pop(LocalFaissHandler.get_vs_path(dir, self.kb_root_path), None)
             _del(dir_path)
         return True
 
@@ -98,31 +129,55 @@ class LocalFaissHandler:
         top_k: int,
         score_threshold: float = SCORE_THRESHOLD,
         kb_name: str = None,
+        **kwargs,
     ) -> List[Document]:
         
         if kb_name:
             self.create_vs(kb_name)
         
-        docs = self.search_index.similarity_search_with_score(query, k=top_k, score_threshold=score_threshold)
+        # kwargs: filter, nprobe/efSearch of this query
+        docs = self.search_index.similarity_search_with_score(query, k=top_k, score_threshold=score_threshold, **kwargs)
         return docs
+
+    def batch_search(
+        self,
+        queries: List[str],
+        top_k: int,
+        score_threshold: float = SCORE_THRESHOLD,
+        kb_name: str = None,
+        **kwargs,
+    ) -> List[List[Document]]:
+        '''
+        search many queries at once by one index search, queries are embedded by embed_query like search,
+        embed_documents may embed them differently (e.g. without the query instruction)
+        '''
+        if kb_name:
+            self.create_vs(kb_name)
+
+        return self.search_index.batch_similarity_search_with_score(
+            queries, k=top_k, score_threshold=score_threshold, **kwargs
+        )
     
     def get_all_documents(self, kb_name: str = None):
         if kb_name:
-            self.create_vs()
+            self.create_vs(kb_name)
         return self.search_index.get_all_documents()
     
     # method for initing vs
     def create_empty_vs(self, ):
         doc = Document(page_content="init", metadata={})
-        self.search_index = FAISS.from_documents([doc], self.embeddings, normalize_L2=FAISS_NORMALIZE_L2, distance_strategy=self.distance_strategy)
+        self.search_index = FAISS.from_documents([doc], self.embeddings, normalize_L2=FAISS_NORMALIZE_L2, distance_strategy=self.distance_strategy, **self.index_kwargs)
         ids = [k for k, v in self.search_index.docstore._dict.items()]
         self.search_index.delete(ids)
+        return self.search_index
 
-    def load_vs_from_localdir(self, vs_path):
-        if "index.faiss" in os.listdir(vs_path):
-            self.search_index = FAISS.load_local(vs_path, self.embeddings, normalize_L2=FAISS_NORMALIZE_L2, distance_strategy=self.distance_strategy)
+    def load_vs_from_localdir(self, checkpoint: str = None):
+        '''load the checkpoint directory (see FaissWAL.load), an empty store when there is none'''
+        if checkpoint:
+            self.search_index = FAISS.load_local(checkpoint, self.embeddings, normalize_L2=FAISS_NORMALIZE_L2, distance_strategy=self.distance_strategy, **self.index_kwargs)
         else:
             self.create_empty_vs()
+        return self.search_index
 
     def mkdir_vspath(self, kb_name, kb_root_path):
         self.vs_path = LocalFaissHandler.get_vs_path(kb_name, kb_root_path)
@@ -1,5 +1,8 @@
 from loguru import logger
-from typing import Union
+from typing import Union, Dict, List, Iterator
+import threading
+import time
+import json
 import numpy as np
 
 import redis
@@ -9,6 +12,9 @@ from redis.commands.search.indexDefinition import (
 
 from redis.commands.json.path import Path
 from redis.commands.search.query import Query
+from redis.commands.search.aggregation import AggregateRequest, Cursor
+from redis.commands.search.document import Document
+from redis.commands.search._util import to_string
 from redis.commands.search.field import (
     TextField,
     NumericField,
@@ -19,6 +25,90 @@ from redis.commands.search.field import (
 from muagent.schemas.db import TBConfig
 
 
+# 进程内共享的连接池与 handler, 以 tbase 的连接信息为 key
+_POOLS: Dict[tuple, redis.BlockingConnectionPool] = {}
+_HANDLERS: Dict[tuple, "TbaseHandler"] = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def _pool_key(tb_config: TBConfig) -> tuple:
+    return (
+        tb_config.host, str(tb_config.port), tb_config.username, 
+        tb_config.password, tb_config.extra_kwargs.get("db", 0)
+    )
+
+
+def get_connection_pool(tb_config: TBConfig) -> redis.BlockingConnectionPool:
+    '''
+    get the process-wide connection pool of tb_config's tbase, the pool is created on first use
+    pool settings come from tb_config.extra_kwargs: 
+        db, max_connections, pool_timeout, socket_keepalive, health_check_interval, socket_timeout, socket_connect_timeout
+    once max_connections are in use, callers wait up to pool_timeout seconds for a free connection
+    instead of failing right away
+    '''
+    key = _pool_key(tb_config)
+    with _REGISTRY_LOCK:
+        if key not in _POOLS:
+            extra_kwargs = tb_config.extra_kwargs
+            _POOLS[key] = redis.BlockingConnectionPool(
+                host=tb_config.host,
+                port=tb_config.port,
+                username=tb_config.username,
+                password=tb_config.password,
+                db=extra_kwargs.get("db", 0),
+                max_connections=extra_kwargs.get("max_connections", 64),
+                timeout=extra_kwargs.get("pool_timeout", 20),
+                socket_keepalive=extra_kwargs.get("socket_keepalive", True),
+                health_check_interval=extra_kwargs.get("health_check_interval", 30),
+                socket_timeout=extra_kwargs.get("socket_timeout", None),
+                socket_connect_timeout=extra_kwargs.get("socket_connect_timeout", None),
+            )
+        return _POOLS[key]
+
+
+def get_tbase_handler(
+        tb_config: TBConfig, 
+        index_name: str = None, 
+        definition_value: str = "message"
+    ) -> "TbaseHandler":
+    '''
+    get a process-wide TbaseHandler, handlers with the same tbase, index_name, definition_value
+    and handler settings (tb_config.extra_kwargs, e.g. expire_time, ttl_policies, pipeline_*, vector_*) are shared
+    '''
+    index_name = index_name or tb_config.index_name
+    key = _pool_key(tb_config) + (
+        index_name, definition_value, json.dumps(tb_config.extra_kwargs, sort_keys=True, default=str)
+    )
+    handler = _HANDLERS.get(key)
+    if handler is None:
+        handler = TbaseHandler(tb_config, index_name, definition_value)
+        with _REGISTRY_LOCK:
+            handler = _HANDLERS.setdefault(key, handler)
+    return handler
+
+
+def tbase_pool_stats() -> List[dict]:
+    '''stats of every shared connection pool'''
+    with _REGISTRY_LOCK:
+        pools = list(_POOLS.values())
+    return [_pool_stats(pool) for pool in pools]
+
+
+def _pool_stats(pool: redis.BlockingConnectionPool) -> dict:
+    kwargs = pool.connection_kwargs
+    created = len(pool._connections)
+    # the queue is pre-filled with None placeholders for connections not created yet
+    available = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+    return {
+        "host": kwargs.get("host"),
+        "port": kwargs.get("port"),
+        "db": kwargs.get("db"),
+        "max_connections": pool.max_connections,
+        "created_connections": created,
+        "available_connections": available,
+        "in_use_connections": created - available,
+    }
+
 
 class TbaseHandler:
     def __init__(
@@ -27,16 +117,21 @@ class TbaseHandler:
             index_name="test", 
             definition_value="message",
         ):
-        self.client = redis.Redis(
-            host=tb_config.host,
-            port=tb_config.port,
-            username=tb_config.username,
-            password=tb_config.password,
-        )
+        # 同一个 tbase 的 handler 共用一个连接池
+        self.client = redis.Redis(connection_pool=get_connection_pool(tb_config))
         self.index_name = index_name
         self.definition_value = definition_value
         self.tb_config = tb_config
         self.expire_time = tb_config.extra_kwargs.get("expire_time", 86400)
+        # ttl by message type, {role_type or role_name: seconds}, 0/None means no expire
+        # e.g. {"count": 86400, "DM": 259200, "observation": 86400, "summary": 2592000}
+        self.ttl_policies = tb_config.extra_kwargs.get("ttl_policies", {})
+        # 批量写入时每个 pipeline 包含的记录数, transaction 为 True 时用 MULTI/EXEC 包裹
+        self.pipeline_batch_size = tb_config.extra_kwargs.get("pipeline_batch_size", 500)
+        self.pipeline_transaction = tb_config.extra_kwargs.get("pipeline_transaction", False)
+
+    def pool_stats(self) -> dict:
+        return _pool_stats(self.client.connection_pool)
 
     def create_index(self, index_name=None, schema=None, definition: list =None):
         '''
@@ -59,6 +154,72 @@ class TbaseHandler:
         # logger.debug(self.client.ft(index_name).info())
         return True
 
+    def vector_field(self, name: str, dim: int = None, algorithm: str = None, metric: str = None, **params) -> VectorField:
+        '''
+        vector field, its settings default to tb_config.extra_kwargs:
+            vector_algorithm: HNSW or FLAT, default is HNSW
+            vector_dim: default is 768, it depends on your embedding model vector
+            vector_metric: COSINE, IP or L2, default is COSINE
+            vector_index_params: other attributes, e.g. M, EF_CONSTRUCTION, EF_RUNTIME of HNSW
+        '''
+        extra_kwargs = self.tb_config.extra_kwargs
+        algorithm = (algorithm or extra_kwargs.get("vector_algorithm", "HNSW")).upper()
+        attributes = {
+            "TYPE": "FLOAT32",
+            "DIM": dim or extra_kwargs.get("vector_dim", 768),
+            "DISTANCE_METRIC": metric or extra_kwargs.get("vector_metric", "COSINE"),
+        }
+        if algorithm == "HNSW":
+            attributes.update({"M": 16, "EF_CONSTRUCTION": 200, "EF_RUNTIME": 10})
+        attributes.update(extra_kwargs.get("vector_index_params", {}))
+        attributes.update(params)
+        return VectorField(name, algorithm, attributes)
+
+    def reindex(self, index_name: str = None, schema=None, definition: list = None, timeout: float = 3600) -> str:
+        '''
+        rebuild index online with a new schema, e.g. to change the vector algorithm.
+        a new index is built over the same documents, index_name is switched to it
+        as an alias once it is fully indexed, then the old index is dropped (documents are kept)
+        :param index_name:
+        :param schema:
+        :param definition:
+        :param timeout: max seconds to wait for the new index
+        :return: name of the new index
+        '''
+        index_name = index_name or self.index_name
+        new_index_name = f"{index_name}_{int(time.time())}"
+        self.create_index(new_index_name, schema=schema, definition=definition)
+        self.wait_for_indexing(new_index_name, timeout=timeout)
+
+        # FT.INFO of an alias returns its index
+        old_index_name = self.client.ft(index_name).info()["index_name"] \
+            if self.is_index_exists(index_name) else None
+        if old_index_name == index_name:
+            # index_name 还是一个索引, 需要先删除才能作为别名
+            self.client.ft(index_name).dropindex(delete_documents=False)
+            self.client.ft(new_index_name).aliasadd(index_name)
+        elif old_index_name:
+            self.client.ft(new_index_name).aliasupdate(index_name)
+            self.client.ft(old_index_name).dropindex(delete_documents=False)
+        else:
+            self.client.ft(new_index_name).aliasadd(index_name)
+        logger.info(f"reindex {index_name}: {old_index_name} -> {new_index_name}")
+        return new_index_name
+
+    def wait_for_indexing(self, index_name: str = None, timeout: float = 3600, interval: float = 1) -> bool:
+        '''
+        wait until index has indexed all existing documents
+        '''
+        index_name = index_name or self.index_name
+        deadline = time.time() + timeout
+        while True:
+            info = self.client.ft(index_name).info()
+            if int(info.get("indexing", 0)) == 0 and float(info.get("percent_indexed", 1)) >= 1:
+                return True
+            if time.time() > deadline:
+                raise TimeoutError(f"index {index_name} is still indexing after {timeout}s")
+            time.sleep(interval)
+
     def insert_data_hash(
             self, 
             data_list: Union[list[dict], dict], 
@@ -73,40 +234,142 @@ class TbaseHandler:
         :return:
         '''
         data_list = [data_list] if isinstance(data_list, dict) else data_list
+        self.bulk_insert_data_hash(data_list, key, expire_time, need_etime)
+        return len(data_list)
+
+    def bulk_insert_data_hash(
+            self, 
+            data_list: list[dict], 
+            key: str = "message_index", 
+            expire_time: int = None, 
+            need_etime: bool = True,
+            batch_size: int = None,
+            transaction: bool = None,
+        ) -> Dict[str, bool]:
+        '''
+        insert data into hash index by redis pipeline, hset and expire of every batch share one round-trip
+        :param data_list:
+        :param key: field used as the hash key suffix
+        :param expire_time: ttl of each key, default is decided by ttl_for
+        :param need_etime: whether to set expire
+        :param batch_size: records per pipeline
+        :param transaction: whether to wrap each batch in MULTI/EXEC
+        :return: {hash key: succeed or not}
+        '''
         if not isinstance(data_list, list):
             raise ValueError(f"data_list'type is {type(data_list)}, it must be List, ")
-        
-        # logger.debug(f"{data_list}")
-        for data in data_list:
-            key_value = f"{self.definition_value}:" + data.get(key, "")
-            r = self.client.hset(key_value, mapping=data)
-            if need_etime:
-                rr = self.client.expire(key_value, expire_time or self.expire_time)
-        return len(data_list)
 
-    def search(self, query, index_name: str = None, query_params: dict = {}, limit=10):
+        batch_size = batch_size or self.pipeline_batch_size
+        transaction = self.pipeline_transaction if transaction is None else transaction
+        status = {}
+        for i in range(0, len(data_list), batch_size):
+            key_values = []
+            pipe = self.client.pipeline(transaction=transaction)
+            for data in data_list[i: i+batch_size]:
+                key_value = f"{self.definition_value}:" + data.get(key, "")
+                key_values.append(key_value)
+                pipe.hset(key_value, mapping=data)
+                if need_etime:
+                    ttl = expire_time or self.ttl_for(data)
+                    if ttl:
+                        pipe.expire(key_value, ttl)
+                    else:
+                        pipe.persist(key_value)
+
+            try:
+                results = pipe.execute(raise_on_error=False)
+            except redis.RedisError as e:
+                logger.error(f"tbase pipeline insert failed: {e}")
+                results = [e] * (len(key_values) * (2 if need_etime else 1))
+
+            # 每条记录对应 hset (+ expire) 的结果
+            step = 2 if need_etime else 1
+            for j, key_value in enumerate(key_values):
+                failed = [r for r in results[j*step: (j+1)*step] if isinstance(r, Exception)]
+                if failed:
+                    logger.error(f"tbase insert {key_value} failed: {failed[0]}")
+                status[key_value] = not failed
+        return status
+
+    def ttl_for(self, data: dict) -> Union[int, None]:
+        '''
+        ttl of a record by ttl_policies, matched by its role_type then role_name, default is expire_time
+        '''
+        for key in ("role_type", "role_name"):
+            value = data.get(key)
+            if isinstance(value, str) and value in self.ttl_policies:
+                return self.ttl_policies[value]
+        return self.expire_time
+
+    def search(self, query, index_name: str = None, query_params: dict = {}, limit=10, offset=0, return_fields: List[str] = None):
         '''
         search
         :param index_name:
         :param query:
         :param query_params
+        :param limit:
+        :param offset:
+        :param return_fields: only return these fields, e.g. to skip vector blobs
         :return:
         '''
         index_name = index_name or self.index_name
         index = self.client.ft(index_name)
 
         if type(query) == str:
-            query = Query(query).paging(0, limit)
+            query = Query(query).paging(offset, limit)
+        if return_fields:
+            query = query.return_fields(*return_fields)
 
         res = index.search(query, query_params=query_params)
         return res
 
-    def vector_search(self, base_query: str, index_name: str = None, query_params: dict={}, limit=10):
+    def search_iter(
+            self, 
+            query: str, 
+            index_name: str = None, 
+            query_params: dict = {}, 
+            page_size: int = 500, 
+            return_fields: List[str] = None,
+        ) -> Iterator:
+        '''
+        iterate over all documents matching query by FT.AGGREGATE WITHCURSOR and FT.CURSOR READ,
+        unlike offset paging of FT.SEARCH it is not bounded by the index's MAXSEARCHRESULTS
+        :param query:
+        :param index_name:
+        :param query_params
+        :param page_size: documents per round-trip
+        :param return_fields: only load these fields, e.g. to skip vector blobs, all fields if None
+        :return: documents, like the docs of search (doc.id is only loaded with return_fields)
+        '''
+        index = self.client.ft(index_name or self.index_name)
+        request = AggregateRequest(query).load(*(["@__key"] + [f"@{field}" for field in return_fields] if return_fields else []))
+        request.cursor(count=page_size)
+        res = index.aggregate(request, query_params=query_params or None)
+        cursor = res.cursor
+        try:
+            while True:
+                for row in res.rows:
+                    fields = {to_string(row[i]): to_string(row[i+1]) for i in range(0, len(row) - 1, 2)}
+                    yield Document(fields.pop("__key", None), **fields)
+                if cursor is None or cursor.cid == 0:
+                    break
+                res = index.aggregate(cursor)
+                cursor = res.cursor
+        finally:
+            # the iteration was stopped early, release the cursor on the server
+            if cursor is not None and cursor.cid != 0:
+                try:
+                    self.client.execute_command("FT.CURSOR", "DEL", index.index_name, cursor.cid)
+                except Exception as e:
+                    logger.warning(f"delete cursor {cursor.cid} failed: {e}")
+
+    def vector_search(self, base_query: str, index_name: str = None, query_params: dict={}, limit=10, return_fields: List[str] = None):
         '''
         vector_search
         :param base_query:
         :param index_name:
         :param query_params
+        :param return_fields: only return these fields, the score alias (e.g. distance) must be included
         :return:
         '''
         query = (
@@ -114,9 +377,94 @@ class TbaseHandler:
                 .sort_by('distance')
                 .dialect(2)
         )
-        r = self.search(query, index_name, query_params, limit=limit)
+        r = self.search(query, index_name, query_params, limit=limit, return_fields=return_fields)
         return r
 
+    def sessions_key(self) -> str:
+        '''key of the sorted set of sessions, scored by their last write time'''
+        return f"{self.definition_value}_sessions"
+
+    def touch_sessions(self, session_ids: List[str], timestamp: float = None) -> int:
+        timestamp = timestamp or time.time()
+        return self.client.zadd(self.sessions_key(), {session_id: timestamp for session_id in session_ids})
+
+    def idle_sessions(self, idle_time: float) -> tuple:
+        '''
+        sessions without writes for idle_time seconds
+        :return: session ids, cutoff timestamp
+        '''
+        cutoff = time.time() - idle_time
+        session_ids = self.client.zrangebyscore(self.sessions_key(), 0, cutoff)
+        return [session_id.decode() for session_id in session_ids], cutoff
+
+    def remove_idle_sessions(self, cutoff: float) -> int:
+        '''sessions written after cutoff are kept'''
+        return self.client.zremrangebyscore(self.sessions_key(), 0, cutoff)
+
+    def state_key(self, session_id: str, node_id: str) -> str:
+        '''
+        key of the (session, node) state hash, it is outside of the index prefix so it won't be indexed.
+        it expires by the ttl policy of count
+        '''
+        return f"{self.definition_value}_state:{session_id}:{node_id}"
+
+    def state_get(self, session_id: str, node_id: str, field: str = None) -> Union[Dict[str, str], str, None]:
+        '''
+        get one field or all fields of the (session, node) state
+        '''
+        key = self.state_key(session_id, node_id)
+        if field:
+            res = self.client.hget(key, field)
+            return res.decode() if res is not None else None
+        return {k.decode(): v.decode() for k, v in self.client.hgetall(key).items()}
+
+    def state_set(self, session_id: str, node_id: str, mapping: dict) -> int:
+        '''
+        set fields of the (session, node) state by one HSET
+        '''
+        key = self.state_key(session_id, node_id)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hset(key, mapping={k: f"{v}" for k, v in mapping.items()})
+        self._expire_state(pipe, key)
+        return pipe.execute()[0]
+
+    def state_incr(self, session_id: str, node_id: str, field: str, amount: int = 1, defaults: dict = {}, limit: int = None) -> int:
+        '''
+        atomically increase one field of the (session, node) state by HINCRBY, a missing field starts from 0.
+        defaults are only set for missing fields (HSETNX) in the same transaction.
+        with limit, the value is checked under WATCH and nothing is written when the new value would reach limit
+        :return: the new value, or the rejected value when it reaches limit
+        '''
+        key = self.state_key(session_id, node_id)
+        if limit is None:
+            pipe = self.client.pipeline(transaction=True)
+            self._state_incr(pipe, key, field, amount, defaults)
+            return pipe.execute()[0]
+
+        def incr(pipe):
+            value = int(pipe.hget(key, field) or 0) + amount
+            if value < limit:
+                pipe.multi()
+                self._state_incr(pipe, key, field, amount, defaults)
+            return value
+        # retried when the state is changed between WATCH and EXEC
+        return self.client.transaction(incr, key, value_from_callable=True)
+
+    def _state_incr(self, pipe, key: str, field: str, amount: int, defaults: dict):
+        pipe.hincrby(key, field, amount)
+        for k, v in defaults.items():
+            pipe.hsetnx(key, k, f"{v}")
+        self._expire_state(pipe, key)
+
+    def _expire_state(self, pipe, key: str):
+        # state 的 ttl 使用 count 的策略
+        ttl = self.ttl_for({"role_name": "count"})
+        if ttl:
+            pipe.expire(key, ttl)
+
+    def state_delete(self, session_id: str, node_id: str) -> int:
+        return self.client.delete(self.state_key(session_id, node_id))
+
     def delete(self, content: str):
         '''
         delete
@@ -128,6 +476,18 @@ class TbaseHandler:
         res = self.client.delete(id)
         return res
 
+    def bulk_delete(self, contents: List[str]) -> int:
+        '''
+        delete many hashes by one DEL
+        '''
+        if not contents:
+            return 0
+        ids = [
+            content if content.startswith(f"{self.definition_value}:") else f"{self.definition_value}:{content}"
+            for content in contents
+        ]
+        return self.client.delete(*ids)
+
     def get(self, content, id=None, key=None):
         id = id or f"{self.definition_value}:{content}"
 
@@ -137,6 +497,30 @@ class TbaseHandler:
             res = self.client.hgetall(id)
         return res
 
+    def mget_fields(self, contents: List[str], field: str, batch_size: int = None) -> Dict[str, Union[bytes, None]]:
+        '''
+        get one field of many hashes by pipelined HGET
+        :param contents: hash key suffixes, same as content in get
+        :param field:
+        :param batch_size: keys per pipeline
+        :return: {content: value or None}
+        '''
+        batch_size = batch_size or self.pipeline_batch_size
+        contents = list(dict.fromkeys(contents))
+        res = {}
+        for i in range(0, len(contents), batch_size):
+            batch = contents[i: i+batch_size]
+            pipe = self.client.pipeline(transaction=False)
+            for content in batch:
+                pipe.hget(f"{self.definition_value}:{content}", field)
+            values = pipe.execute(raise_on_error=False)
+            for content, value in zip(batch, values):
+                if isinstance(value, Exception):
+                    logger.error(f"tbase hget {content} failed: {value}")
+                    value = None
+                res[content] = value
+        return res
+
     def fuzzy_delete(self, collection_name, delete_str, index_name="test"):
         '''
         delete by metaid
@@ -1,5 +1,7 @@
 from fastapi import FastAPI
 from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import asyncio
 import uvicorn
 from loguru import logger
@@ -56,11 +58,20 @@ def init_app(
         ekg_construct_service: EKGConstructService, 
         memory_manager, 
         geabase_handler, 
-        intention_router
+        intention_router,
+        max_workers: int = None,
 ):
 
     app = FastAPI()
 
+    # blocking llm/graph calls of the async endpoints run on this pool, the event loop keeps serving other sessions,
+    # sync endpoints already run on fastapi's threadpool
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ekg_api")
+
+    async def run_blocking(func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
     # ~/llm/params
     @app.get("/llm/params", response_model=LLMParamsResponse)
     async def llm_params():
@@ -69,7 +80,7 @@ def init_app(
     # ~/llm/ollama/pull
     @app.post("/llm/ollama/pull", response_model=EKGResponse)
     async def llm_params(request: LLMOllamaPullRequest):
-        result = ollama.pull(request.model_name)
+        result = await run_blocking(ollama.pull, request.model_name)
         return EKGResponse(
             successCode=True, errorMessage=json.dumps(result, ensure_ascii=False),
         )
@@ -115,7 +126,7 @@ def init_app(
                 f"please request llm/ollama/pull for downloading the ollama model"
                 successCode = False
             else:
-                answer = llm.predict(request.text, request.stop)
+                answer = await run_blocking(llm.predict, request.text, request.stop)
         except Exception as e:
             logger.exception(e)
             errorMessage = str(e)
@@ -169,7 +180,7 @@ def init_app(
                 f"please request llm/ollama/pull for downloading the ollama model"
                 successCode = False
             else:
-                embeddings_list = embeddings.embed_documents(request.texts)
+                embeddings_list = await run_blocking(embeddings.embed_documents, request.texts)
         except Exception as e:
             logger.exception(e)
             errorMessage = str(e)
@@ -188,7 +199,8 @@ def init_app(
         errorMessage = "ok"
         successCode = True
         try:
-            result = ekg_construct_service.create_ekg(
+            result = await run_blocking(
+                ekg_construct_service.create_ekg,
                 text=request.text, teamid=request.teamid,rootid=request.rootid,
                 service_name="text2graph",
                 intent_text=request.intentText,
@@ -264,7 +276,8 @@ def init_app(
         successCode = True
         try:
 
-            old_graph, result = ekg_construct_service.update_graph(
+            old_graph, result = await run_blocking(
+                ekg_construct_service.update_graph,
                 origin_nodes=origin_nodes,
                 origin_edges=origin_edges,
                 new_nodes=nodes,
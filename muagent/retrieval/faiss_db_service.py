@@ -18,9 +18,11 @@ from .base_service import KBService, SupportedVSType
 from muagent.utils.path_utils import *
 from muagent.schemas.kb.file_schema import DocumentFile
 from muagent.utils.server_utils import torch_gc
-from muagent.retrieval.utils import load_embeddings, load_embeddings_from_path
+from muagent.retrieval.utils import load_embeddings, load_embeddings_from_path, faiss_index_kwargs
 from muagent.retrieval.faiss_m import FAISS
+from muagent.retrieval.faiss_wal import get_faiss_wal, reset_faiss_wal, save_checkpoint
 from muagent.llm_models.llm_config import EmbedConfig
+from muagent.schemas.db import VBConfig
 
 
 # make HuggingFaceEmbeddings hashable
@@ -31,6 +33,8 @@ def _embeddings_hash(self):
 HuggingFaceEmbeddings.__hash__ = _embeddings_hash
 
 _VECTOR_STORE_TICKS = {}
+# kb_name -> faiss index kwargs of its VBConfig, kept outside of the lru_cache key like the ticks
+_VECTOR_STORE_INDEX_KWARGS = {}
 
 
 @lru_cache(CACHED_VS_NUM)
@@ -50,15 +54,19 @@ def load_vector_store(
         os.makedirs(vs_path)
     
     distance_strategy = "EUCLIDEAN_DISTANCE"
-    if "index.faiss" in os.listdir(vs_path):
-        search_index = FAISS.load_local(vs_path, embeddings, normalize_L2=FAISS_NORMALIZE_L2, distance_strategy=distance_strategy)
-    else:
+    index_kwargs = _VECTOR_STORE_INDEX_KWARGS.get(knowledge_base_name) or faiss_index_kwargs()
+    def loader(checkpoint: str = None) -> FAISS:
+        if checkpoint:
+            return FAISS.load_local(checkpoint, embeddings, normalize_L2=FAISS_NORMALIZE_L2, distance_strategy=distance_strategy, **index_kwargs)
         # create an empty vector store
         doc = Document(page_content="init", metadata={})
-        search_index = FAISS.from_documents([doc], embeddings, normalize_L2=FAISS_NORMALIZE_L2, distance_strategy=distance_strategy)
+        search_index = FAISS.from_documents([doc], embeddings, normalize_L2=FAISS_NORMALIZE_L2, distance_strategy=distance_strategy, **index_kwargs)
         ids = [k for k, v in search_index.docstore._dict.items()]
         search_index.delete(ids)
-        search_index.save_local(vs_path)
+        save_checkpoint(search_index, vs_path)
+        return search_index
+    # the store already loaded in this process, or the last checkpoint with the records written after it
+    search_index = get_faiss_wal(vs_path).load(loader)
     
     if tick == 0: # vector store is loaded first time
         _VECTOR_STORE_TICKS[knowledge_base_name] = 0
@@ -79,6 +87,11 @@ class FaissKBService(KBService):
     vs_path: str
     kb_path: str
 
+    def __init__(self, knowledge_base_name: str, embed_config: EmbedConfig, kb_root_path: str, vb_config: VBConfig = None):
+        # index settings (index_factory, nprobe, ...) are read from vb_config.extra_kwargs like LocalFaissHandler
+        self.vb_config = vb_config
+        super().__init__(knowledge_base_name, embed_config, kb_root_path)
+
     def vs_type(self) -> str:
         return SupportedVSType.FAISS
 
@@ -93,6 +106,7 @@ class FaissKBService(KBService):
     def do_init(self):
         self.kb_path = FaissKBService.get_kb_path(self.kb_name)
         self.vs_path = FaissKBService.get_vs_path(self.kb_name)
+        _VECTOR_STORE_INDEX_KWARGS[self.kb_name] = faiss_index_kwargs(self.vb_config.extra_kwargs if self.vb_config else None)
 
     def do_create_kb(self):
         if not os.path.exists(self.vs_path):
@@ -135,12 +149,12 @@ class FaissKBService(KBService):
                                          embeddings=embeddings,
                                          tick=_VECTOR_STORE_TICKS.get(self.kb_name, 0),
                                          kb_root_path=self.kb_root_path)
-        vector_store.embedding_function = embeddings.embed_documents
         # logger.info("loaded docs, docs' lens is {}".format(len(docs)))
-        vector_store.add_documents(docs)
+        # the shared store is updated in place and the add is logged, the save is left to the background checkpoint
+        wal = get_faiss_wal(get_vs_path(self.kb_name, self.kb_root_path))
+        wal.add_documents(vector_store, docs, embeddings.embed_documents)
         torch_gc()
         if not kwargs.get("not_refresh_vs_cache"):
-            vector_store.save_local(self.vs_path)
             refresh_vs_cache(self.kb_name)
 
     def do_delete_doc(self,
@@ -153,18 +167,18 @@ class FaissKBService(KBService):
                                          tick=_VECTOR_STORE_TICKS.get(self.kb_name, 0),
                                          kb_root_path=self.kb_root_path)
 
-        ids = [k for k, v in vector_store.docstore._dict.items() if v.metadata["source"] == kb_file.filepath]
+        ids = vector_store.get_ids_by_metadata("source", kb_file.filepath)
         if len(ids) == 0:
             return None
 
-        vector_store.delete(ids)
+        wal = get_faiss_wal(get_vs_path(self.kb_name, self.kb_root_path))
+        wal.delete(vector_store, ids)
         if not kwargs.get("not_refresh_vs_cache"):
-            vector_store.save_local(self.vs_path)
             refresh_vs_cache(self.kb_name)
-
         return True
 
     def do_clear_vs(self):
+        reset_faiss_wal(get_vs_path(self.kb_name, self.kb_root_path))
         if os.path.exists(self.vs_path):
             shutil.rmtree(self.vs_path)
         os.makedirs(self.vs_path)
@@ -103,8 +103,42 @@ class FAISS(VectorStore):
         relevance_score_fn: Optional[Callable[[float], float]] = None,
         normalize_L2: bool = False,
         distance_strategy: DistanceStrategy = DistanceStrategy.EUCLIDEAN_DISTANCE,
+        index_factory: Optional[str] = None,
+        train_size: int = 4096,
+        retrain_ratio: float = 4.0,
+        nprobe: Optional[int] = None,
+        efSearch: Optional[int] = None,
+        trained_size: int = 0,
+        metadata_index_keys: Optional[List[str]] = None,
+        prefilter_exact_size: int = 4096,
+        max_tombstone_ratio: float = 0.2,
     ):
-        """Initialize with necessary components."""
+        """Initialize with necessary components.
+
+        Args:
+            index_factory: faiss index factory string, e.g. ``IVF1024,PQ16``,
+                ``HNSW32`` or ``IVF256,SQ8``. The store keeps a flat index until
+                ``train_size`` vectors are added, then trains and switches to it.
+                If training fails (e.g. ``IVF4096`` needs at least 4096 points and
+                ``PQ`` 256) the store stays flat and retries at twice the size.
+                None keeps the exhaustive flat index.
+            retrain_ratio: retrain the index once the store grows to
+                ``retrain_ratio`` times the size it was trained on, 0 disables it.
+                Only lossless codes (``IVF*,Flat``) are retrained, retraining
+                ``PQ``/``SQ`` codes would train on their own quantized vectors.
+            nprobe: default number of IVF lists visited per query.
+            efSearch: default HNSW search depth per query.
+            trained_size: number of vectors the current index was trained on.
+            metadata_index_keys: metadata keys kept in a value -> ids inverted
+                index, see ``get_ids_by_metadata``. Defaults to ``["source"]``.
+                Filters on these keys select their ids before the index search.
+            prefilter_exact_size: pre-filtered searches over at most this many
+                ids compare the query with those vectors directly instead of
+                searching the index with an IDSelector.
+            max_tombstone_ratio: indexes that can not remove vectors (HNSW)
+                keep deleted ones as tombstones skipped by searches, the index is
+                rebuilt once they are more than this share of its vectors.
+        """
         self.embedding_function = embedding_function
         self.index = index
         self.docstore = docstore
@@ -112,6 +146,31 @@ class FAISS(VectorStore):
         self.distance_strategy = distance_strategy
         self.override_relevance_score_fn = relevance_score_fn
         self._normalize_L2 = normalize_L2
+        self.index_factory = index_factory
+        self.train_size = train_size
+        self.retrain_ratio = retrain_ratio
+        self.nprobe = nprobe
+        self.efSearch = efSearch
+        self.trained_size = trained_size
+        self._trainable: Optional[bool] = None
+        self._lossless: Optional[bool] = None
+        self._ensure_id_map()
+        self.max_tombstone_ratio = max_tombstone_ratio
+        # deleted faiss ids still in an index that can not remove them
+        self._tombstones: set = set()
+        self._tombstone_selector = None
+        if not self._supports_remove():
+            faiss = dependable_faiss_import()
+            self._tombstones = set(faiss.vector_to_array(self.index.id_map).tolist()).difference(self.index_to_docstore_id)
+        # faiss ids are stable int64, never reused after a delete
+        self._next_id = max(list(self.index_to_docstore_id) + list(self._tombstones), default=-1) + 1
+        self._docstore_id_to_index = {id_: i for i, id_ in self.index_to_docstore_id.items()}
+        self.metadata_index_keys = ["source"] if metadata_index_keys is None else metadata_index_keys
+        self.prefilter_exact_size = prefilter_exact_size
+        # (key, value) -> faiss ids
+        self._metadata_index: Dict[Tuple[str, Any], set] = {}
+        for i, id_ in self.index_to_docstore_id.items():
+            self._index_metadata(i, self.docstore.search(id_))
         if (
             self.distance_strategy != DistanceStrategy.EUCLIDEAN_DISTANCE
             and self._normalize_L2
@@ -150,15 +209,22 @@ class FAISS(VectorStore):
         vector = np.array(embeddings, dtype=np.float32)
         if self._normalize_L2:
             faiss.normalize_L2(vector)
-        self.index.add(vector)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        self.__register(vector, ids, documents)
+        return ids
+
+    def __register(self, vector: np.ndarray, ids: List[str], documents: List[Document]) -> None:
+        """Add vectors under new faiss ids and record their docs."""
+        int_ids = np.arange(self._next_id, self._next_id + len(ids), dtype=np.int64)
+        self._index_add(vector, int_ids)
+        self._next_id += len(ids)
 
         # Add information to docstore and index.
-        ids = ids or [str(uuid.uuid4()) for _ in texts]
         self.docstore.add({id_: doc for id_, doc in zip(ids, documents)})
-        starting_len = len(self.index_to_docstore_id)
-        index_to_id = {starting_len + j: id_ for j, id_ in enumerate(ids)}
-        self.index_to_docstore_id.update(index_to_id)
-        return ids
+        for i, id_, doc in zip(int_ids.tolist(), ids, documents):
+            self.index_to_docstore_id[i] = id_
+            self._docstore_id_to_index[id_] = i
+            self._index_metadata(i, doc)
 
     def add_texts(
         self,
@@ -227,47 +293,88 @@ class FAISS(VectorStore):
             List of documents most similar to the query text and L2 distance
             in float for each. Lower score represents more similarity.
         """
+        return self.batch_similarity_search_with_score_by_vector(
+            [embedding], k, filter=filter, fetch_k=fetch_k, **kwargs
+        )[0]
+
+    def batch_similarity_search_with_score_by_vector(
+        self,
+        embeddings: List[List[float]],
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+        **kwargs: Any,
+    ) -> List[List[Tuple[Document, float]]]:
+        """Return docs most similar to each query vector, with one index search
+        over the ``[n, d]`` query matrix.
+
+        Args:
+            embeddings: Query vectors.
+            k: Number of Documents to return per query. Defaults to 4.
+            filter (Optional[Dict[str, Any]]): Filter by metadata. Defaults to None.
+            fetch_k: (Optional[int]) Number of Documents to fetch before filtering.
+                      Defaults to 20.
+            **kwargs: score_threshold, nprobe, efSearch
+
+        Returns:
+            One list of (document, score) per query, as in
+            ``similarity_search_with_score_by_vector``.
+        """
         faiss = dependable_faiss_import()
-        vector = np.array([embedding], dtype=np.float32)
+        vectors = np.array(embeddings, dtype=np.float32).reshape(-1, self.index.d)
         if self._normalize_L2:
-            faiss.normalize_L2(vector)
-        scores, indices = self.index.search(vector, k if filter is None else fetch_k)
-        # 经过normalize的结果会超出1
+            faiss.normalize_L2(vectors)
+        if filter is not None:
+            filter = {
+                key: [value] if not isinstance(value, list) else value
+                for key, value in filter.items()
+            }
+            # indexed keys select their ids before searching, only the rest is checked per doc
+            candidates, filter = self._prefilter(filter)
+            filter = filter or None
+        else:
+            candidates = None
+
+        search_k = k if filter is None else fetch_k
+        if candidates is None:
+            scores, indices = self._index_search(vectors, search_k, **kwargs)
+        elif len(candidates) == 0:
+            return [[] for _ in range(len(vectors))]
+        elif len(candidates) <= self.prefilter_exact_size:
+            scores, indices = self._exact_search(vectors, candidates, search_k)
+        else:
+            scores, indices = self._index_search(vectors, search_k, sel=candidates, **kwargs)
+        found = indices != -1
+        # 经过normalize的结果会超出1, 按行归一化(不计未返回的-1位置)
         if self._normalize_L2:
-            scores = np.array([row / np.linalg.norm(row) if np.max(row) > 1 else row for row in scores])
-        docs = []
-        for j, i in enumerate(indices[0]):
-            if i == -1:
-                # This happens when not enough docs are returned.
-                continue
-            _id = self.index_to_docstore_id[i]
-            doc = self.docstore.search(_id)
-            if not isinstance(doc, Document):
-                raise ValueError(f"Could not find document for id {_id}, got {doc}")
-            if filter is not None:
-                filter = {
-                    key: [value] if not isinstance(value, list) else value
-                    for key, value in filter.items()
-                }
-                if all(doc.metadata.get(key) in value for key, value in filter.items()):
-                    docs.append((doc, scores[0][j]))
-            else:
-                docs.append((doc, scores[0][j]))
+            masked = np.where(found, scores, 0).astype(np.float64)
+            norms = np.linalg.norm(masked, axis=1, keepdims=True)
+            rescale = (np.max(masked, axis=1, keepdims=True) > 1) & (norms > 0)
+            scores = np.where(rescale, masked / np.where(norms > 0, norms, 1), scores).astype(np.float32)
 
+        keep = found
         score_threshold = kwargs.get("score_threshold")
         if score_threshold is not None:
-            cmp = (
-                operator.ge
-                if self.distance_strategy
-                in (DistanceStrategy.MAX_INNER_PRODUCT, DistanceStrategy.JACCARD)
-                else operator.le
-            )
-            docs = [
-                (doc, similarity)
-                for doc, similarity in docs
-                if cmp(similarity, score_threshold)
-            ]
-        return docs[:k]
+            if self.distance_strategy in (DistanceStrategy.MAX_INNER_PRODUCT, DistanceStrategy.JACCARD):
+                keep = keep & (scores >= score_threshold)
+            else:
+                keep = keep & (scores <= score_threshold)
+
+        results = []
+        for row_scores, row_indices, row_keep in zip(scores, indices, keep):
+            docs = []
+            for j in np.flatnonzero(row_keep):
+                _id = self.index_to_docstore_id[row_indices[j]]
+                doc = self.docstore.search(_id)
+                if not isinstance(doc, Document):
+                    raise ValueError(f"Could not find document for id {_id}, got {doc}")
+                if filter is not None and not all(doc.metadata.get(key) in value for key, value in filter.items()):
+                    continue
+                docs.append((doc, row_scores[j]))
+                if len(docs) >= k:
+                    break
+            results.append(docs)
+        return results
 
     def similarity_search_with_score(
         self,
@@ -300,6 +407,53 @@ class FAISS(VectorStore):
         )
         return docs
 
+    def batch_similarity_search_with_score(
+        self,
+        queries: List[str],
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+        embed_queries: Optional[Callable[[List[str]], List[List[float]]]] = None,
+        **kwargs: Any,
+    ) -> List[List[Tuple[Document, float]]]:
+        """Return docs most similar to each query.
+
+        Args:
+            queries: Texts to look up documents similar to.
+            embed_queries: embeds all queries in one model call, it must
+                produce the same vectors as the store's embedding function
+                (``embed_query``), ``embed_documents`` may not. Defaults to
+                calling the store's embedding function once per query.
+
+        Returns:
+            One list of (document, score) per query.
+        """
+        if not queries:
+            return []
+        if embed_queries is not None:
+            embeddings = embed_queries(queries)
+        else:
+            embeddings = [self.embedding_function(query) for query in queries]
+        return self.batch_similarity_search_with_score_by_vector(
+            embeddings, k, filter=filter, fetch_k=fetch_k, **kwargs
+        )
+
+    def batch_similarity_search(
+        self,
+        queries: List[str],
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+        **kwargs: Any,
+    ) -> List[List[Document]]:
+        """Return docs most similar to each query, see ``batch_similarity_search_with_score``."""
+        return [
+            [doc for doc, _ in docs_and_scores]
+            for docs_and_scores in self.batch_similarity_search_with_score(
+                queries, k, filter=filter, fetch_k=fetch_k, **kwargs
+            )
+        ]
+
     def similarity_search_by_vector(
         self,
         embedding: List[float],
@@ -382,7 +536,7 @@ class FAISS(VectorStore):
             List of Documents and similarity scores selected by maximal marginal
                 relevance and score for each.
         """
-        scores, indices = self.index.search(
+        scores, indices = self._index_search(
             np.array([embedding], dtype=np.float32),
             fetch_k if filter is None else fetch_k * 2,
         )
@@ -506,28 +660,266 @@ class FAISS(VectorStore):
         """
         if ids is None:
             raise ValueError("No ids provided to delete.")
-        missing_ids = set(ids).difference(self.index_to_docstore_id.values())
+        ids = list(dict.fromkeys(ids))
+        missing_ids = set(ids).difference(self._docstore_id_to_index)
         if missing_ids:
             raise ValueError(
                 f"Some specified ids do not exist in the current store. Ids not found: "
                 f"{missing_ids}"
             )
 
-        reversed_index = {id_: idx for idx, id_ in self.index_to_docstore_id.items()}
-        index_to_delete = [reversed_index[id_] for id_ in ids]
-
-        self.index.remove_ids(np.array(index_to_delete, dtype=np.int64))
+        # only the deleted ids are touched, the others keep their faiss ids
+        index_to_delete = [self._docstore_id_to_index.pop(id_) for id_ in ids]
+        for i in index_to_delete:
+            del self.index_to_docstore_id[i]
+        if self._supports_remove():
+            self.index.remove_ids(np.array(index_to_delete, dtype=np.int64))
+        else:
+            # hnsw can not remove, the vectors are skipped by searches until enough
+            # tombstones piled up to refill the trained index with the remaining vectors
+            self._tombstones.update(index_to_delete)
+            self._tombstone_selector = None
+            if len(self._tombstones) > self.max_tombstone_ratio * self.index.ntotal:
+                self._rebuild(*self._reconstruct_all())
+
+        for i, id_ in zip(index_to_delete, ids):
+            self._unindex_metadata(i, self.docstore.search(id_))
         self.docstore.delete(ids)
+        return True
 
-        remaining_ids = [
-            id_
-            for i, id_ in sorted(self.index_to_docstore_id.items())
-            if i not in index_to_delete
-        ]
-        self.index_to_docstore_id = {i: id_ for i, id_ in enumerate(remaining_ids)}
+    def get_ids_by_metadata(self, key: str, value: Any) -> List[str]:
+        """Return the ids of the docs whose metadata[key] == value.
+
+        ``key`` must be one of ``metadata_index_keys``.
+        """
+        if key not in self.metadata_index_keys:
+            raise ValueError(f"metadata key {key} is not indexed, indexed keys: {self.metadata_index_keys}")
+        try:
+            int_ids = self._metadata_index.get((key, value), ())
+        except TypeError:
+            # unhashable values are never indexed
+            return []
+        return [self.index_to_docstore_id[i] for i in int_ids]
+
+    def _index_metadata(self, int_id: int, doc: Any) -> None:
+        if not isinstance(doc, Document):
+            return
+        for key in self.metadata_index_keys:
+            value = doc.metadata.get(key)
+            # docs without the key are not indexed, a None filter value is checked per doc
+            if value is None:
+                continue
+            try:
+                self._metadata_index.setdefault((key, value), set()).add(int_id)
+            except TypeError:
+                continue
 
+    def _unindex_metadata(self, int_id: int, doc: Any) -> None:
+        if not isinstance(doc, Document):
+            return
+        for key in self.metadata_index_keys:
+            value = doc.metadata.get(key)
+            try:
+                int_ids = self._metadata_index.get((key, value))
+            except TypeError:
+                continue
+            if int_ids is not None:
+                int_ids.discard(int_id)
+                if not int_ids:
+                    del self._metadata_index[(key, value)]
+
+    def _prefilter(self, filter: Dict[str, List[Any]]) -> Tuple[Optional[np.ndarray], Dict[str, List[Any]]]:
+        """Split a normalized filter into the faiss ids allowed by its indexed keys
+        and the rest of the filter, which is still checked per doc.
+
+        Returns None ids when no key of the filter can be served by the index.
+        """
+        candidates, rest = None, {}
+        for key, values in filter.items():
+            if key not in self.metadata_index_keys or any(value is None for value in values):
+                rest[key] = values
+                continue
+            matched = set()
+            for value in values:
+                try:
+                    matched.update(self._metadata_index.get((key, value), ()))
+                except TypeError:
+                    continue
+            candidates = matched if candidates is None else candidates & matched
+        if candidates is None:
+            return None, rest
+        return np.fromiter(candidates, dtype=np.int64, count=len(candidates)), rest
+
+    def _exact_search(
+        self, vectors: np.ndarray, int_ids: np.ndarray, k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact search over the vectors of ``int_ids``, shaped like index.search."""
+        faiss = dependable_faiss_import()
+        metric = (
+            faiss.METRIC_INNER_PRODUCT
+            if self.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT
+            else faiss.METRIC_L2
+        )
+        kk = min(k, len(int_ids))
+        scores, positions = faiss.knn(vectors, self.index.reconstruct_batch(int_ids), kk, metric=metric)
+        indices = np.where(positions >= 0, int_ids[positions], -1)
+        if kk < k:
+            pad = ((0, 0), (0, k - kk))
+            scores = np.pad(scores, pad, constant_values=np.finfo(np.float32).max)
+            indices = np.pad(indices, pad, constant_values=-1)
+        return scores, indices
+
+    def _index_add(self, vector: np.ndarray, int_ids: np.ndarray) -> None:
+        """Add vectors, training or retraining the factory index when it is due."""
+        if self.index_factory:
+            total = self.index.ntotal + len(vector)
+            if (self.trained_size == 0 and total >= self.train_size) or (
+                self.trained_size and self.retrain_ratio
+                and total >= self.trained_size * self.retrain_ratio
+                and self._requires_training() and self._retrainable()
+            ):
+                old_ids, old_vectors = self._reconstruct_all()
+                if self._train(np.vstack([old_vectors, vector]), np.concatenate([old_ids, int_ids])):
+                    return
+        self.index.add_with_ids(vector, int_ids)
+
+    def _new_index(self) -> Any:
+        faiss = dependable_faiss_import()
+        metric = (
+            faiss.METRIC_INNER_PRODUCT
+            if self.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT
+            else faiss.METRIC_L2
+        )
+        index = faiss.index_factory(self.index.d, self.index_factory, metric)
+        if faiss.try_extract_index_ivf(index) is None:
+            index = faiss.IndexIDMap2(index)
+        return index
+
+    def _requires_training(self) -> bool:
+        # hnsw over raw vectors has nothing to retrain
+        if self._trainable is None:
+            self._trainable = not self._new_index().is_trained
+        return self._trainable
+
+    def _retrainable(self) -> bool:
+        # retraining reads the vectors back from the index, only flat codes give back the
+        # original vectors, pq/sq codes would compound their quantization error on every retrain
+        if self._lossless is None:
+            faiss = dependable_faiss_import()
+            index = faiss.index_factory(self.index.d, self.index_factory)
+            self._lossless = isinstance(index, (faiss.IndexIVFFlat, faiss.IndexFlat, faiss.IndexHNSWFlat))
+        return self._lossless
+
+    def _train(self, vectors: np.ndarray, int_ids: np.ndarray) -> bool:
+        """Build the factory index, train it on ``vectors`` and add them.
+
+        Returns False and keeps the current index when training fails.
+        """
+        index = self._new_index()
+        if not index.is_trained:
+            try:
+                index.train(vectors)
+            except RuntimeError as e:
+                # too few points for the factory, retry once the store doubled
+                if self.trained_size:
+                    self.trained_size = len(vectors)
+                else:
+                    self.train_size = 2 * len(vectors)
+                logger.warning(f"training faiss index {self.index_factory} on {len(vectors)} vectors failed, keep the current index: {e}")
+                return False
+        self.index = index
+        self._ensure_id_map()
+        self.index.add_with_ids(vectors, int_ids)
+        self._clear_tombstones()
+        self.trained_size = len(vectors)
+        logger.info(f"trained faiss index {self.index_factory} on {len(vectors)} vectors")
         return True
 
+    def _rebuild(self, int_ids: np.ndarray, vectors: np.ndarray) -> None:
+        """Refill the current index with ``vectors``, keeping its training."""
+        faiss = dependable_faiss_import()
+        index = faiss.clone_index(self.index)
+        index.reset()
+        self.index = index
+        self._ensure_id_map()
+        self.index.add_with_ids(vectors, int_ids)
+        self._clear_tombstones()
+
+    def _clear_tombstones(self) -> None:
+        self._tombstones = set()
+        self._tombstone_selector = None
+
+    def _reconstruct_all(self) -> Tuple[np.ndarray, np.ndarray]:
+        """faiss ids and vectors of every doc in the store."""
+        int_ids = np.fromiter(self.index_to_docstore_id, dtype=np.int64, count=len(self.index_to_docstore_id))
+        if len(int_ids) == 0:
+            return int_ids, np.zeros((0, self.index.d), dtype=np.float32)
+        return int_ids, self.index.reconstruct_batch(int_ids)
+
+    def _base_index(self) -> Any:
+        faiss = dependable_faiss_import()
+        if isinstance(self.index, faiss.IndexIDMap2):
+            return faiss.downcast_index(self.index.index)
+        return self.index
+
+    def _supports_remove(self) -> bool:
+        # flat/sq/pq codes compact on remove and ivf removes by id, hnsw can not remove
+        faiss = dependable_faiss_import()
+        base_index = self._base_index()
+        return isinstance(base_index, faiss.IndexFlatCodes) or faiss.try_extract_index_ivf(base_index) is not None
+
+    def _ensure_id_map(self) -> None:
+        """Give the index stable int64 ids, ivf carries them itself and other indexes are wrapped in IndexIDMap2."""
+        faiss = dependable_faiss_import()
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            # a hashtable direct map reconstructs and removes arbitrary ids, for retrain, rebuild and mmr
+            if ivf.direct_map.type != faiss.DirectMap.Hashtable:
+                ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+        elif not isinstance(self.index, faiss.IndexIDMap2):
+            # indexes saved before stable ids are addressed by position, IndexIDMap2 only wraps
+            # an empty index so the vectors are moved over once
+            ntotal = self.index.ntotal
+            vectors = self.index.reconstruct_n(0, ntotal) if ntotal else None
+            base_index = faiss.clone_index(self.index)
+            base_index.reset()
+            self.index = faiss.IndexIDMap2(base_index)
+            if ntotal:
+                self.index.add_with_ids(vectors, np.arange(ntotal, dtype=np.int64))
+
+    def _index_search(
+        self, vector: np.ndarray, k: int, nprobe: Optional[int] = None,
+        efSearch: Optional[int] = None, sel: Optional[np.ndarray] = None, **kwargs: Any
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """index.search with the per query nprobe/efSearch of ivf/hnsw indexes,
+        restricted to the faiss ids ``sel`` if given."""
+        faiss = dependable_faiss_import()
+        nprobe = nprobe or self.nprobe
+        efSearch = efSearch or self.efSearch
+        selector = faiss.IDSelectorBatch(sel) if sel is not None else None
+        if self._tombstones:
+            if self._tombstone_selector is None:
+                tombstones = np.fromiter(self._tombstones, dtype=np.int64, count=len(self._tombstones))
+                batch = faiss.IDSelectorBatch(tombstones)
+                # the python objects keep the wrapped selectors alive
+                self._tombstone_selector = (faiss.IDSelectorNot(batch), batch)
+            not_deleted = self._tombstone_selector[0]
+            selector = not_deleted if selector is None else faiss.IDSelectorAnd(selector, not_deleted)
+        ivf = faiss.try_extract_index_ivf(self.index)
+        base_index = self._base_index()
+        params = None
+        if ivf is not None and (nprobe or selector is not None):
+            params = faiss.SearchParametersIVF(nprobe=nprobe or ivf.nprobe, sel=selector)
+        elif isinstance(base_index, faiss.IndexHNSW) and (efSearch or selector is not None):
+            efSearch = efSearch or base_index.hnsw.efSearch
+            if sel is not None:
+                # the graph walk skips filtered out nodes, widen it by the inverse selectivity
+                efSearch = min(max(efSearch, k * self.index.ntotal // max(len(sel), 1)), 4096)
+            params = faiss.SearchParametersHNSW(efSearch=efSearch, sel=selector)
+        elif selector is not None:
+            params = faiss.SearchParameters(sel=selector)
+        return self.index.search(vector, k, params=params)
+
     def merge_from(self, target: FAISS) -> None:
         """Merge another FAISS object with the current one.
 
@@ -541,24 +933,20 @@ class FAISS(VectorStore):
         """
         if not isinstance(self.docstore, AddableMixin):
             raise ValueError("Cannot merge with this type of docstore")
-        # Numerical index for target docs are incremental on existing ones
-        starting_len = len(self.index_to_docstore_id)
-
-        # Merge two IndexFlatL2
-        self.index.merge_from(target.index)
 
         # Get id and docs from target FAISS object
-        full_info = []
-        for i, target_id in target.index_to_docstore_id.items():
+        target_int_ids, vectors = target._reconstruct_all()
+        target_ids, docs = [], []
+        for i in target_int_ids.tolist():
+            target_id = target.index_to_docstore_id[i]
             doc = target.docstore.search(target_id)
             if not isinstance(doc, Document):
                 raise ValueError("Document should be returned")
-            full_info.append((starting_len + i, target_id, doc))
+            target_ids.append(target_id)
+            docs.append(doc)
 
-        # Add information to docstore and index_to_docstore_id.
-        self.docstore.add({_id: doc for _, _id, doc in full_info})
-        index_to_id = {index: _id for index, _id, _ in full_info}
-        self.index_to_docstore_id.update(index_to_id)
+        # target vectors get new faiss ids in this index
+        self.__register(vectors, target_ids, docs)
 
     @classmethod
     def __from(
@@ -687,7 +1075,9 @@ class FAISS(VectorStore):
 
         # save docstore and index_to_docstore_id
         with open(path / "{index_name}.pkl".format(index_name=index_name), "wb") as f:
-            pickle.dump((self.docstore, self.index_to_docstore_id), f)
+            pickle.dump(
+                (self.docstore, self.index_to_docstore_id, {"trained_size": self.trained_size}), f
+            )
 
     @classmethod
     def load_local(
@@ -714,7 +1104,10 @@ class FAISS(VectorStore):
 
         # load docstore and index_to_docstore_id
         with open(path / "{index_name}.pkl".format(index_name=index_name), "rb") as f:
-            docstore, index_to_docstore_id = pickle.load(f)
+            docstore, index_to_docstore_id, *extra = pickle.load(f)
+        # pkl files written before index factories only hold two items
+        index_state = extra[0] if extra else {}
+        kwargs.setdefault("trained_size", index_state.get("trained_size", 0))
         return cls(
             embeddings.embed_query, index, docstore, index_to_docstore_id, **kwargs
         )
@@ -0,0 +1,303 @@
+from typing import List, Dict, Callable, Optional
+import os, json, base64, threading, atexit, uuid, time, shutil, weakref
+
+import numpy as np
+from loguru import logger
+from langchain_community.docstore.document import Document
+
+from muagent.retrieval.faiss_m import FAISS
+
+
+class FaissWAL:
+    '''
+    append-only write-ahead log of a faiss vector store, so an add/delete costs one fsynced
+    record instead of rewriting index.faiss and the pickled docstore.
+    the store is checkpointed (save_checkpoint) by the shared checkpoint thread checkpoint_interval
+    seconds after its first pending record or once checkpoint_ops records are pending, then the
+    log is truncated and the store is unbound again.
+    loading replays the log over the last checkpoint, replaying is idempotent so a crash
+    between writing the checkpoint and truncating the log is harmless.
+    the loaded store is shared by every handler of the directory in this process (load), it is
+    only referenced weakly once nothing is pending, so an unused store can still be released
+    '''
+    WAL_LOG = "wal.log"
+
+    def __init__(self, vs_path: str, checkpoint_interval: float = 60, checkpoint_ops: int = 1000):
+        self.vs_path = vs_path
+        self.log_path = os.path.join(vs_path, self.WAL_LOG)
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_ops = checkpoint_ops
+        self._lock = threading.RLock()
+        # the store the pending records belong to, bound while records are pending
+        self.search_index: Optional[FAISS] = None
+        self.pending_ops = 0
+        self.dirty_since = 0.0
+        self._store: Optional[weakref.ref] = None
+
+    def load(self, loader: Callable[[Optional[str]], FAISS]) -> FAISS:
+        '''
+        the store of this directory: the one already loaded in this process, or loader(checkpoint directory,
+        None when there is no checkpoint) with the log replayed over it.
+        the lock is held throughout, so a checkpoint can not switch CURRENT, remove the version being read
+        or truncate the log between reading the checkpoint and replaying the log
+        '''
+        with self._lock:
+            store = self.search_index or (self._store() if self._store is not None else None)
+            if store is None:
+                store = loader(checkpoint_path(self.vs_path) if has_checkpoint(self.vs_path) else None)
+                self.replay(store)
+                self._store = weakref.ref(store)
+            return store
+
+    def add_documents(self, search_index: FAISS, docs: List[Document], embed_documents: Callable[[List[str]], List[List[float]]]) -> List[str]:
+        '''embed docs, add them to search_index and log them'''
+        if not docs: return []
+        texts = [doc.page_content for doc in docs]
+        metadatas = [doc.metadata for doc in docs]
+        vectors = np.asarray(embed_documents(texts), dtype=np.float32)
+        ids = [str(uuid.uuid4()) for _ in texts]
+        with self._lock:
+            search_index.add_embeddings(zip(texts, vectors), metadatas=metadatas, ids=ids)
+            self._append({
+                "op": "add", "ids": ids, "texts": texts, "metadatas": metadatas,
+                "dim": int(vectors.shape[1]),
+                "vectors": base64.b64encode(vectors.tobytes()).decode("ascii"),
+            }, search_index)
+        return ids
+
+    def delete(self, search_index: FAISS, ids: List[str]) -> bool:
+        '''delete ids from search_index and log it'''
+        if not ids: return False
+        with self._lock:
+            search_index.delete(ids)
+            self._append({"op": "delete", "ids": ids}, search_index)
+        return True
+
+    def _append(self, record: dict, search_index: FAISS):
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.search_index = search_index
+        self._store = weakref.ref(search_index)
+        self.pending_ops += 1
+        if self.pending_ops == 1 or self.pending_ops >= self.checkpoint_ops:
+            _mark_dirty(self)
+
+    def replay(self, search_index: FAISS) -> int:
+        '''apply the logged records on top of a store loaded from the last checkpoint'''
+        with self._lock:
+            count = 0
+            if os.path.exists(self.log_path):
+                with open(self.log_path, "rb+") as f:
+                    offset = 0
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except (json.JSONDecodeError, UnicodeDecodeError):
+                            # a torn tail write, the records before it are complete.
+                            # cut it off so the records appended later are not hidden behind it
+                            f.truncate(offset)
+                            break
+                        self._apply(search_index, record)
+                        offset += len(line)
+                        count += 1
+            if count:
+                logger.info(f"replayed {count} wal records of {self.vs_path}")
+                self.search_index = search_index
+                self.pending_ops = count
+                _mark_dirty(self)
+            return count
+
+    def _apply(self, search_index: FAISS, record: dict):
+        # records already contained in the checkpoint are skipped
+        if record["op"] == "add":
+            vectors = np.frombuffer(base64.b64decode(record["vectors"]), dtype=np.float32).reshape(-1, record["dim"])
+            rows = [i for i, _id in enumerate(record["ids"]) if _id not in search_index.docstore._dict]
+            if rows:
+                search_index.add_embeddings(
+                    [(record["texts"][i], vectors[i]) for i in rows],
+                    metadatas=[record["metadatas"][i] for i in rows],
+                    ids=[record["ids"][i] for i in rows]
+                )
+        elif record["op"] == "delete":
+            ids = [_id for _id in record["ids"] if _id in search_index.docstore._dict]
+            if ids:
+                search_index.delete(ids)
+
+    def checkpoint(self, force: bool = False, search_index: FAISS = None) -> bool:
+        '''save the bound store (else the shared store, else search_index if given) and truncate the log'''
+        with self._lock:
+            if self.search_index is not None:
+                search_index = self.search_index
+            elif self._store is not None and self._store() is not None:
+                search_index = self._store()
+            if search_index is None or not (self.pending_ops or force):
+                return False
+            save_checkpoint(search_index, self.vs_path)
+            if os.path.exists(self.log_path):
+                os.remove(self.log_path)
+            self._clean()
+            return True
+
+    def reset(self):
+        '''drop the log and the bound store, used when the vector store directory is cleared'''
+        with self._lock:
+            if os.path.exists(self.log_path):
+                os.remove(self.log_path)
+            self._store = None
+            self._clean()
+
+    def due(self, now: float) -> bool:
+        return self.pending_ops > 0 and (
+            self.pending_ops >= self.checkpoint_ops
+            or (self.checkpoint_interval > 0 and now - self.dirty_since >= self.checkpoint_interval)
+        )
+
+    def _clean(self):
+        # the store is owned by its handler or cache, do not pin it once nothing is pending
+        self.search_index = None
+        self.pending_ops = 0
+        with _WALS_LOCK:
+            if _DIRTY.get(self.vs_path) is self:
+                _DIRTY.pop(self.vs_path)
+
+
+CURRENT = "CURRENT"
+CHECKPOINT_PREFIX = "checkpoint-"
+
+
+def checkpoint_path(vs_path: str) -> str:
+    '''the directory of the current checkpoint, vs_path itself for stores saved before versioning'''
+    try:
+        with open(os.path.join(vs_path, CURRENT), "r", encoding="utf-8") as f:
+            return os.path.join(vs_path, f.read().strip())
+    except FileNotFoundError:
+        return vs_path
+
+
+def has_checkpoint(vs_path: str) -> bool:
+    return os.path.exists(os.path.join(checkpoint_path(vs_path), "index.faiss"))
+
+
+def save_checkpoint(search_index: FAISS, vs_path: str):
+    '''
+    save_local into a new version directory, then switch CURRENT to it with one rename,
+    a crash at any point leaves CURRENT naming a complete checkpoint
+    '''
+    version = f"{CHECKPOINT_PREFIX}{time.time_ns()}"
+    version_path = os.path.join(vs_path, version)
+    search_index.save_local(version_path)
+    for name in ["index.faiss", "index.pkl"]:
+        with open(os.path.join(version_path, name), "rb") as f:
+            os.fsync(f.fileno())
+    _fsync_dir(version_path)
+
+    tmp_path = os.path.join(vs_path, f"{CURRENT}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(vs_path, CURRENT))
+    _fsync_dir(vs_path)
+
+    # older versions and the unversioned files are no longer referenced
+    for name in os.listdir(vs_path):
+        if name.startswith(CHECKPOINT_PREFIX) and name != version:
+            shutil.rmtree(os.path.join(vs_path, name), ignore_errors=True)
+        elif name in ["index.faiss", "index.pkl"]:
+            os.remove(os.path.join(vs_path, name))
+
+
+def _fsync_dir(path: str):
+    if os.name == "nt":
+        # directories cannot be opened for fsync on windows
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# a wal stays registered while a handler holds it or while it has pending records (_DIRTY),
+# idle ones are dropped from the registry once they are checkpointed and unreferenced
+_WALS: "weakref.WeakValueDictionary[str, FaissWAL]" = weakref.WeakValueDictionary()
+_DIRTY: Dict[str, FaissWAL] = {}
+_WALS_LOCK = threading.Lock()
+_WAKEUP = threading.Event()
+_CHECKPOINT_THREAD: Optional[threading.Thread] = None
+
+
+def get_faiss_wal(vs_path: str, checkpoint_interval: float = 60, checkpoint_ops: int = 1000) -> FaissWAL:
+    '''one wal per vector store directory, shared by the handlers and services of this process'''
+    key = os.path.abspath(vs_path)
+    with _WALS_LOCK:
+        wal = _WALS.get(key)
+        if wal is None:
+            os.makedirs(key, exist_ok=True)
+            wal = FaissWAL(key, checkpoint_interval, checkpoint_ops)
+            _WALS[key] = wal
+        return wal
+
+
+def reset_faiss_wal(vs_path: str):
+    '''drop the pending log of a vector store directory that is being cleared'''
+    wal = _WALS.get(os.path.abspath(vs_path))
+    if wal is not None:
+        wal.reset()
+    elif os.path.exists(os.path.join(vs_path, FaissWAL.WAL_LOG)):
+        os.remove(os.path.join(vs_path, FaissWAL.WAL_LOG))
+
+
+def _mark_dirty(wal: FaissWAL):
+    '''keep wal alive until it is checkpointed and wake the checkpoint thread to reschedule'''
+    global _CHECKPOINT_THREAD
+    with _WALS_LOCK:
+        if wal.vs_path not in _DIRTY:
+            wal.dirty_since = time.time()
+            _DIRTY[wal.vs_path] = wal
+        if _CHECKPOINT_THREAD is None:
+            _CHECKPOINT_THREAD = threading.Thread(target=_checkpoint_loop, name="faiss_wal_checkpoint", daemon=True)
+            _CHECKPOINT_THREAD.start()
+    _WAKEUP.set()
+
+
+def _checkpoint_loop():
+    '''one thread checkpoints every dirty wal of the process once it is due'''
+    while True:
+        _WAKEUP.clear()
+        timeout = _checkpoint_due()
+        _WAKEUP.wait(None if timeout is None else max(timeout, 0.01))
+
+
+def _checkpoint_due() -> Optional[float]:
+    '''checkpoint the due wals, return the seconds until the next one is due'''
+    now = time.time()
+    with _WALS_LOCK:
+        wals = list(_DIRTY.values())
+    timeout = None
+    for wal in wals:
+        try:
+            if wal.due(now):
+                wal.checkpoint()
+            elif wal.checkpoint_interval > 0:
+                left = wal.dirty_since + wal.checkpoint_interval - now
+                timeout = left if timeout is None else min(timeout, left)
+        except Exception as e:
+            logger.error(f"checkpoint of {wal.vs_path} failed: {e}")
+            # retry it after one more interval
+            wal.dirty_since = now
+    return timeout
+
+
+@atexit.register
+def checkpoint_all():
+    '''checkpoint every vector store with pending records, so the next start has nothing to replay'''
+    with _WALS_LOCK:
+        wals = list(_DIRTY.values())
+    for wal in wals:
+        try:
+            wal.checkpoint()
+        except Exception as e:
+            logger.error(f"checkpoint of {wal.vs_path} failed: {e}")
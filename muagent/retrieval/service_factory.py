@@ -10,6 +10,7 @@ from .base_service import KBService, SupportedVSType
 from muagent.service.ui_file_service import *
 from muagent.utils.path_utils import *
 from muagent.llm_models.llm_config import EmbedConfig
+from muagent.schemas.db import VBConfig
 
 
 class KBServiceFactory:
@@ -19,12 +20,13 @@ class KBServiceFactory:
                     vector_store_type: Union[str, SupportedVSType],
                     # embed_model: str = "text2vec-base-chinese",
                     embed_config: EmbedConfig,
-                    kb_root_path: str = KB_ROOT_PATH
+                    kb_root_path: str = KB_ROOT_PATH,
+                    vb_config: VBConfig = None,
                     ) -> KBService:
         if isinstance(vector_store_type, str):
             vector_store_type = getattr(SupportedVSType, vector_store_type.upper())
         if SupportedVSType.FAISS == vector_store_type:
-            return FaissKBService(kb_name, embed_config=embed_config, kb_root_path=kb_root_path)
+            return FaissKBService(kb_name, embed_config=embed_config, kb_root_path=kb_root_path, vb_config=vb_config)
         # if SupportedVSType.PG == vector_store_type:
         #     from server.knowledge_base.kb_service.pg_kb_service import PGKBService
         #     return PGKBService(kb_name, embed_model=embed_model)
@@ -38,12 +40,13 @@ class KBServiceFactory:
     @staticmethod
     def get_service_by_name(kb_name: str,
                             embed_config: EmbedConfig,
-                            kb_root_path: str = KB_ROOT_PATH
+                            kb_root_path: str = KB_ROOT_PATH,
+                            vb_config: VBConfig = None,
                             ) -> KBService:
         _, vs_type, embed_model = load_kb_from_db(kb_name)
         if vs_type is None and os.path.isdir(get_kb_path(kb_name, kb_root_path)): # faiss knowledge base not in db
             vs_type = "faiss"
-        return KBServiceFactory.get_service(kb_name, vs_type, embed_config, kb_root_path)
+        return KBServiceFactory.get_service(kb_name, vs_type, embed_config, kb_root_path, vb_config)
 
     @staticmethod
     def get_default():
@@ -23,3 +23,16 @@ def load_embeddings_from_path(model_path: str, device: str, langchain_embeddings
                                        model_kwargs={'device': device})
     return embeddings
 
+
+def faiss_index_kwargs(extra_kwargs: dict = None) -> dict:
+    '''faiss index factory (IVF/HNSW/PQ) and its training/search knobs from VBConfig.extra_kwargs, see FAISS.__init__'''
+    extra_kwargs = extra_kwargs or {}
+    index_kwargs = {
+        k: extra_kwargs[k]
+        for k in ["index_factory", "train_size", "retrain_ratio", "nprobe", "efSearch", "prefilter_exact_size", "max_tombstone_ratio"]
+        if k in extra_kwargs
+    }
+    # chat_index lets one shared store serve many memory sessions through pre-filtered search
+    index_kwargs["metadata_index_keys"] = extra_kwargs.get("metadata_index_keys", ["source", "chat_index"])
+    return index_kwargs
+
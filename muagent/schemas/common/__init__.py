@@ -4,5 +4,5 @@ from .auto_extract_graph_schema import *
 __all__ = [
     "GNodeAbs", "GEdgeAbs", "GRelationAbs", "Attribute", 
     "GNode", "GEdge", "Graph", "GEdgeRequst", "GNodeRequest", "GRelation", 
-    "ThemeEnums", "GbaseExecStatus"
+    "ThemeEnums", "GbaseExecStatus", "GNodesFetchResult"
 ]
\ No newline at end of file
@@ -107,3 +107,10 @@ class GbaseExecStatus(BaseModel):
     )
     # 
     results: Optional[Union[List, Dict]] = None
+
+
+class GNodesFetchResult(BaseModel):
+    # nodes in the order of the requested ids
+    nodes: List[GNode] = []
+    # requested ids without a node
+    missing_ids: List = []
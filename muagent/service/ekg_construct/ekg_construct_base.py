@@ -5,6 +5,9 @@ import json
 from typing import List, Dict, Optional, Tuple, Literal
 
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
 import random
 import uuid
 from redis.commands.search.field import (
@@ -48,6 +51,32 @@ def getClassFields(model):
     return all_fields
 
 
+_SEARCH_EXECUTOR: ThreadPoolExecutor = None
+_SEARCH_EXECUTOR_LOCK = threading.Lock()
+
+
+def get_search_executor() -> ThreadPoolExecutor:
+    '''one thread pool for the concurrent index queries of every EKGConstructService in the process'''
+    global _SEARCH_EXECUTOR
+    with _SEARCH_EXECUTOR_LOCK:
+        if _SEARCH_EXECUTOR is None:
+            _SEARCH_EXECUTOR = ThreadPoolExecutor(thread_name_prefix="ekg_search")
+        return _SEARCH_EXECUTOR
+
+
+def invalidate_team_reachable(func):
+    '''drop the team's cached reachable nodes before and after a write to its graph'''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        teamid = kwargs["teamid"] if "teamid" in kwargs else (args[1] if len(args) > 1 else '')
+        self.invalidate_team_reachable(teamid)
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.invalidate_team_reachable(teamid)
+    return wrapper
+
+
 class EKGConstructService:
 
     def __init__(
@@ -76,6 +105,10 @@ class EKGConstructService:
         self.llm_config: LLMConfig = llm_config
         self.node_indexname = "opsgptkg_node"
         self.edge_indexname = "opsgptkg_edge"
+        # the hybrid search sends its index queries concurrently
+        self.search_executor = get_search_executor()
+        # teamid -> (node ids reachable from the team's root, graph version, expire timestamp)
+        self.team_reachable_nodeids: Dict[str, Tuple[set, Optional[int], float]] = {}
 
         # get llm model
         self.model = getChatModelFromConfig(self.llm_config) if llm_config else None
@@ -102,34 +135,32 @@ class EKGConstructService:
         self.init_gb()
 
     def init_tb(self, do_init: bool=None):
+        if not self.tb_config:
+            self.tb = None
+            return
+
+        self.tb: TbaseHandler = get_tbase_handler(
+            tb_config=self.tb_config, 
+            index_name=self.tb_config.index_name, 
+            definition_value=self.tb_config.extra_kwargs.get(
+                "definition_value", "muagent_ekg")
+        )
 
-        DIM = 768 # it depends on your embedding model vector
-        NODE_SCHEMA = [
+        # vector algorithm/dim/metric are configured by tb_config.extra_kwargs, see TbaseHandler.vector_field
+        self.node_schema = [
             NumericField("ID", ),
             TextField("node_id", ),
             TextField("node_type", ),
             TextField("node_str", ),
-            VectorField("name_vector",
-                        'FLAT',
-                        {
-                            "TYPE": "FLOAT32",
-                            "DIM": DIM,
-                            "DISTANCE_METRIC": "COSINE"
-                        }),
-            VectorField("description_vector",
-                        'FLAT',
-                        {
-                            "TYPE": "FLOAT32",
-                            "DIM": DIM,
-                            "DISTANCE_METRIC": "COSINE"
-                        }),
+            self.tb.vector_field("name_vector"),
+            self.tb.vector_field("description_vector"),
             TextField("ekg_type",),
             TextField("graph_id",),
             TagField(name='name_keyword', separator='|'),
             TagField(name='description_keyword', separator='|')
         ]
 
-        EDGE_SCHEMA = [
+        self.edge_schema = [
             TextField("edge_id", ),
             TextField("edge_type", ),
             TextField("edge_source", ),
@@ -138,28 +169,24 @@ class EKGConstructService:
             TextField("ekg_type",),
         ]
 
+        # # create index
+        if not self.tb.is_index_exists(self.node_indexname):
+            res = self.tb.create_index(
+                index_name=self.node_indexname, schema=self.node_schema)
+            logger.info(f"tb init: {res}")
 
-        if self.tb_config:
-            tb_dict = {"TbaseHandler": TbaseHandler}
-            tb_class =  tb_dict.get(self.tb_config.tb_type, TbaseHandler)
-            self.tb: TbaseHandler = tb_class(
-                tb_config=self.tb_config, 
-                index_name=self.tb_config.index_name, 
-                definition_value=self.tb_config.extra_kwargs.get(
-                    "definition_value", "muagent_ekg")
-            )
-            # # create index
-            if not self.tb.is_index_exists(self.node_indexname):
-                res = self.tb.create_index(
-                    index_name=self.node_indexname, schema=NODE_SCHEMA)
-                logger.info(f"tb init: {res}")
-
-            if not self.tb.is_index_exists(self.edge_indexname):
-                res = self.tb.create_index(
-                    index_name=self.edge_indexname, schema=EDGE_SCHEMA)
-                logger.info(f"tb init: {res}")
-        else:
-            self.tb = None
+        if not self.tb.is_index_exists(self.edge_indexname):
+            res = self.tb.create_index(
+                index_name=self.edge_indexname, schema=self.edge_schema)
+            logger.info(f"tb init: {res}")
+
+    def reindex_tb(self, timeout: float = 3600) -> str:
+        '''
+        rebuild the node index online with the current node schema, 
+        e.g. to migrate an existing FLAT node index to HNSW after changing tb_config
+        '''
+        return self.tb.reindex(
+            index_name=self.node_indexname, schema=self.node_schema, timeout=timeout)
 
     def init_gb(self, do_init: bool=None):
         if self.gb_config:
@@ -170,21 +197,32 @@ class EKGConstructService:
             }
             gb_class =  gb_dict.get(self.gb_config.gb_type, NebulaHandler)
             self.gb: GBHandler = gb_class(self.gb_config)
+            if self.gb_config.extra_kwargs.get("use_cache", False):
+                # read-through cache for node/neighbor/hop queries
+                self.gb = CachedGBHandler(
+                    self.gb, 
+                    maxsize=self.gb_config.extra_kwargs.get("cache_maxsize", 10000),
+                    ttl=self.gb_config.extra_kwargs.get("cache_ttl", 300),
+                )
 
             initialize_space = self.initialize_space  # True or False
             if initialize_space and self.gb_config.gb_type=="NebulaHandler":
                 self.gb.add_hosts('storaged0', 9779)
-                print('增加NebulaGraph Storage主机中，等待20秒')
-                time.sleep(20)
+                logger.info('增加NebulaGraph Storage主机中，等待storaged上线')
+                if not self.gb.wait_for_hosts():
+                    raise RuntimeError("NebulaGraph storaged is not online, init_gb failed")
                 # 初始化space
                 self.gb.drop_space('client')
                 self.gb.create_space('client')
+                if not self.gb.wait_for_space('client'):
+                    raise RuntimeError("NebulaGraph space client is not ready, init_gb failed")
                 
                 # 创建node tags和edge types
-                self.create_gb_tags_and_edgetypes()
+                tag_names, edge_type_names = self.create_gb_tags_and_edgetypes()
 
-                print('Node Tags和Edge Types初始化中，等待20秒......')
-                time.sleep(20)
+                logger.info('Node Tags和Edge Types初始化中，等待schema同步......')
+                if not self.gb.wait_for_schema(tag_names, edge_type_names):
+                    raise RuntimeError("NebulaGraph tags and edge types are not synced, init_gb failed")
         else:
             self.gb = None
 
@@ -267,7 +305,9 @@ class EKGConstructService:
         return rootid_can_arrive_nodeids, graph
 
 
-    def create_gb_tags_and_edgetypes(self):
+    def create_gb_tags_and_edgetypes(self) -> Tuple[List[str], List[str]]:
+        '''create node tags and edge types, return the created tag names and edge type names'''
+        tag_names, edge_type_names = [], []
         # 节点标签和属性 (done)
         for node_type, schema in TYPE2SCHEMA.items():
             if node_type == 'edge':
@@ -292,6 +332,7 @@ class EKGConstructService:
                     logger.error(f"The type of Node attribute ({k}) shouldn't be None!")
 
             self.gb.create_tag(node_type, attributes_dict)
+            tag_names.append(node_type)
 
         # 边属性
         for edge_type, schema in TYPE2SCHEMA.items():
@@ -319,6 +360,8 @@ class EKGConstructService:
                     self.gb.create_edge_type(edge_type2, edge_attributes_dict)
                     edge_type3 = f"{node_types[i]}_conclude_{node_types[j]}"
                     self.gb.create_edge_type(edge_type3, edge_attributes_dict)
+                    edge_type_names.extend([edge_type, edge_type2, edge_type3])
+        return tag_names, edge_type_names
 
 
         
@@ -470,6 +513,7 @@ class EKGConstructService:
         }
 
 
+    @invalidate_team_reachable
     def add_nodes(self, nodes: List[GNode], teamid: str, ekg_type: str="ekgnode") -> Dict:
         '''
         add new nodes into tbase and graph base
@@ -478,10 +522,12 @@ class EKGConstructService:
         '''
         nodes = self._update_new_attr_for_nodes(nodes, teamid, do_check=True)
 
+        # get the nodes' teamids by one batched read
+        node_strs = self.tb.mget_fields([node.id for node in nodes], "node_str")
         tbase_nodes = []
         for node in nodes:
             # get the node's teamids
-            r = self.tb.get(node.id, key="node_str")
+            r = node_strs.get(node.id)
             teamids = [
                 i.strip()
                 for i in r.decode().replace("graph_id=", "").split(",")
@@ -512,7 +558,8 @@ class EKGConstructService:
 
         tb_result, gb_result = [], []
         try: 
-            gb_result = [self.gb.add_node(node) for node in nodes]
+            # one batch write, results holds the status of each node
+            gb_result = self.gb.add_nodes(nodes).results
             tb_result.append(
                 self.tb.insert_data_hash(tbase_nodes, key='node_id', need_etime=False)
             )
@@ -522,6 +569,7 @@ class EKGConstructService:
         # todo return nodes' infomation
         return {"gb_result": gb_result, "tb_result": tb_result}
 
+    @invalidate_team_reachable
     def add_edges(self, edges: List[GEdge], teamid: str, ekg_type: str="ekgedge"):
         edges = self._update_new_attr_for_edges(edges)
         
@@ -539,7 +587,7 @@ class EKGConstructService:
         tb_result, gb_result = [], []
         try:
             # bug: there is gap between zhizhu and geabase
-            gb_result = [self.gb.add_edge(edge) for edge in edges]
+            gb_result = self.gb.add_edges(edges).results
             tb_result.append(
                 self.tb.insert_data_hash(tbase_edges, key="edge_id", need_etime=False)
                 )
@@ -549,13 +597,14 @@ class EKGConstructService:
         # todo return nodes' infomation
         return {"gb_result": gb_result, "tb_result": tb_result}
 
+    @invalidate_team_reachable
     def delete_nodes(self, nodes: List[GNode], teamid: str=''):
         # delete tbase nodes
-        r = self.tb.search(
-            f"@node_str: *{teamid}*", index_name=self.node_indexname, limit=len(nodes)
+        docs = self.tb.search_iter(
+            f"@node_str: *{teamid}*", index_name=self.node_indexname, return_fields=["node_id"]
             )
 
-        tbase_nodeids = [data['node_id'] for data in r.docs] # 附带了definition信息
+        tbase_nodeids = [data['node_id'] for data in docs] # 附带了definition信息
         delete_nodeids = [node.id for node in nodes]
         tbase_missing_nodeids = [
             nodeid for nodeid in delete_nodeids 
@@ -619,15 +668,16 @@ class EKGConstructService:
             ))
         return {"gb_result": gb_result, "tb_result": tb_result}
     
+    @invalidate_team_reachable
     def delete_edges(self, edges: List[GEdge], teamid: str):
         # delete tbase nodes
-        r = self.tb.search(
+        docs = self.tb.search_iter(
             f"@edge_str: *{teamid}*", 
             index_name=self.edge_indexname, 
-            limit=len(edges)
+            return_fields=["edge_id"]
         )
 
-        tbase_edgeids = [data['edge_id'] for data in r.docs]
+        tbase_edgeids = [data['edge_id'] for data in docs]
         delete_edgeids = [f"{edge.start_id}__{edge.end_id}" for edge in edges]
         tbase_missing_edgeids = [
             edgeid for edgeid in delete_edgeids if edgeid not in tbase_edgeids]
@@ -657,14 +707,14 @@ class EKGConstructService:
         :param nodes:
         :param teamid:
         '''
-        r = self.tb.search(
+        docs = list(self.tb.search_iter(
             f"@node_str: *{teamid}*", 
             index_name=self.node_indexname, 
-            limit=len(nodes)
-        )
-        teamids_by_nodeid = {data['node_id']: data["node_str"]  for data in r.docs}
+            return_fields=["node_id", "node_str"]
+        ))
+        teamids_by_nodeid = {data['node_id']: data["node_str"]  for data in docs}
 
-        tbase_nodeids = [data['node_id'] for data in r.docs]
+        tbase_nodeids = [data['node_id'] for data in docs]
         update_nodeids = [node.id for node in nodes]
         tbase_missing_nodeids = [
             nodeid for nodeid in update_nodeids if nodeid not in tbase_nodeids]
@@ -672,8 +722,11 @@ class EKGConstructService:
         if len(tbase_missing_nodeids) > 0:
             logger.error(f"there must something wrong! "
                          f"ID not match, such as {tbase_missing_nodeids}")
+            node_strs = self.tb.mget_fields(
+                [nodeid.replace('-', '_') for nodeid in tbase_missing_nodeids], "node_str"
+            )
             for nodeid in tbase_missing_nodeids:
-                r = self.tb.get(nodeid.replace('-', '_'), key="node_str")
+                r = node_strs.get(nodeid.replace('-', '_'))
                 if r:
                     teamids_by_nodeid.update(
                         {nodeid.replace('-', '_'): r.decode()}
@@ -706,8 +759,8 @@ class EKGConstructService:
             tbase_datas.append(tbase_data)
 
         tb_result = []
-        for tbase_data in tbase_datas:
-            resp = self.tb.insert_data_hash(tbase_data, key="node_id", need_etime=False)
+        if tbase_datas:
+            resp = self.tb.insert_data_hash(tbase_datas, key="node_id", need_etime=False)
             tb_result.append(resp)
 
         # update the nodeids in geabase
@@ -724,13 +777,14 @@ class EKGConstructService:
             gb_result.append(resp)
         return {"gb_result": gb_result, "tb_result": tb_result}
 
+    @invalidate_team_reachable
     def update_edges(self, edges: List[GEdge], teamid: str):
-        r = self.tb.search(
+        docs = self.tb.search_iter(
             f"@edge_str: *{teamid}*", 
             index_name=self.node_indexname, 
-            limit=len(edges)
+            return_fields=["edge_id"]
         )
-        tbase_edgeids = [data['edge_id'] for data in r.docs]
+        tbase_edgeids = [data['edge_id'] for data in docs]
         delete_edgeids = [f"{edge.start_id}__{edge.end_id}" for edge in edges]
         tbase_missing_edgeids = [
             edgeid for edgeid in delete_edgeids if edgeid not in tbase_edgeids]
@@ -754,19 +808,20 @@ class EKGConstructService:
             gb_result.append(resp)
         return {"gb_result": gb_result, "tb_result": []}
 
+    @invalidate_team_reachable
     def delete_nodes_v2(self, nodes: List[GNode], teamid: str=''):
         '''
         delete tbase nodes
         :param nodes:
         :param teamid:
         '''
-        r = self.tb.search(
+        docs = self.tb.search_iter(
             f"@node_str: *{teamid}*", 
             index_name=self.node_indexname, 
-            limit=len(nodes)
+            return_fields=["node_id"]
         )
 
-        tbase_nodeids = [data['node_id'] for data in r.docs]
+        tbase_nodeids = [data['node_id'] for data in docs]
         delete_nodeids = [node.id for node in nodes]
         tbase_missing_nodeids = [
             nodeid for nodeid in delete_nodeids if nodeid not in tbase_nodeids
@@ -892,54 +947,15 @@ class EKGConstructService:
         '''
         if text is None: return []
 
-        nodeids = []
-        # 
-        if self.embed_config:
-            vector_dict = self._get_embedding(text)
-            query_embedding = np.array(vector_dict[text]).astype(dtype=np.float32).tobytes()
-
-            nodeid_with_dist = []
-            for key in ["name_vector", "description_vector"]:
-                
-                base_query = f'(*)=>[KNN {top_k} @{key} $vector AS distance]' if teamid is None \
-                        else f'(@node_str: *{teamid}*)=>[KNN {top_k} @{key} $vector AS distance]'
-                # base_query = f'(*)=>[KNN {top_k} @{key} $vector AS distance]'
-                query_params = {"vector": query_embedding}
-                r = self.tb.vector_search(
-                    base_query, index_name=self.node_indexname, query_params=query_params
-                )
+        nodeids = [ID for ID, _ in self.hybrid_search_nodeids(text, teamid=teamid, top_k=top_k)]
 
-                for i in r.docs:
-                    data_dict = i.__dict__
-                    if "ID" not in data_dict: continue # filter data
-                    nodeid_with_dist.append((data_dict["ID"], float(data_dict["distance"])))
-            
-            nodeid_with_dist = sorted(nodeid_with_dist, key=lambda x:x[1], reverse=False)
-            for nodeid, dis in nodeid_with_dist:
-                if nodeid not in nodeids:
-                    nodeids.append(nodeid)
-
-        # search keyword by jieba spliting text
-        keywords = extract_tags(text)
-        keyword = "|".join(keywords)
-        for key in ["name_keyword", "description_keyword"]:
-            query = f"(@node_str: *{teamid}*)(@{key}:{{{keyword}}})"
-            r = self.tb.search(query, index_name=self.node_indexname, limit=30)
-            for i in r.docs:
-                if i["ID"] not in nodeids:
-                    nodeids.append(i["ID"])
-
-        nodes = self.gb.get_nodes_by_ids(nodeids)
+        nodes = self.gb.fetch_nodes_by_ids(nodeids).nodes
         nodes = self._normalized_nodes_type(nodes)
         # tmp iead to filter by teamid 
         nodes = [node for node in nodes if str(teamid) in str(node.attributes)]
         # select the node which can connect the rootid
-        nodes = [
-            node for node in nodes 
-            if len(self.search_rootpath_by_nodeid(
-                node.id, node.type, f"ekg_team_{teamid}"
-            ).paths) > 0
-        ]
+        reachable_nodeids = self.get_team_reachable_nodeids(teamid)
+        nodes = [node for node in nodes if node.id in reachable_nodeids]
         # 
         nodes = [
             node for node in nodes
@@ -947,6 +963,83 @@ class EKGConstructService:
         ]
         return nodes
 
+    def hybrid_search_nodeids(
+            self, text: str, teamid: str = None, top_k=5, keyword_limit=30, rrf_k=60
+        ) -> List[Tuple[str, float]]:
+        '''
+        search nodes by name/description vectors and keywords, the index queries run concurrently
+        and their rankings are fused by reciprocal rank fusion
+        :return: [(node ID, score)] sorted by score
+        '''
+        team_filter = "*" if teamid is None else f"@node_str: *{teamid}*"
+        searches = []
+        if self.embed_config:
+            vector_dict = self._get_embedding(text)
+            query_embedding = np.array(vector_dict[text]).astype(dtype=np.float32).tobytes()
+            for key in ["name_vector", "description_vector"]:
+                searches.append(self.search_executor.submit(
+                    self.tb.vector_search, 
+                    f'({team_filter})=>[KNN {top_k} @{key} $vector AS distance]',
+                    index_name=self.node_indexname, 
+                    query_params={"vector": query_embedding}, 
+                    return_fields=["ID", "distance"],
+                ))
+
+        # search keyword by jieba spliting text
+        keyword = "|".join(extract_tags(text))
+        if keyword:
+            for key in ["name_keyword", "description_keyword"]:
+                query = f"(@{key}:{{{keyword}}})" if teamid is None else f"({team_filter})(@{key}:{{{keyword}}})"
+                searches.append(self.search_executor.submit(
+                    self.tb.search, query, 
+                    index_name=self.node_indexname, limit=keyword_limit, return_fields=["ID"]
+                ))
+
+        scores = {}
+        for future in searches:
+            ranked_ids = [doc.ID for doc in future.result().docs if "ID" in doc.__dict__] # filter data
+            for rank, ID in enumerate(dict.fromkeys(ranked_ids)):
+                scores[ID] = scores.get(ID, 0) + 1 / (rrf_k + rank + 1)
+        return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+
+    def get_team_reachable_nodeids(self, teamid: str, hop: int = 15) -> set:
+        '''
+        ids of the nodes reachable from the team's root node (ekg_team_{teamid}),
+        computed by one distinct-vertex traversal and cached until the team's graph version
+        (shared by all workers through tbase) changes or the ttl expires
+        '''
+        version = self._team_graph_version(teamid)
+        reachable_nodeids, cached_version, expire_time = self.team_reachable_nodeids.get(teamid, (None, None, 0))
+        if reachable_nodeids is not None and cached_version == version and expire_time > time.time():
+            return reachable_nodeids
+
+        rootid = f"ekg_team_{teamid}"
+        reachable_nodeids = self.gb.get_reachable_nodeids({"id": rootid}, hop=hop) | {rootid}
+        ttl = (self.gb_config.extra_kwargs if self.gb_config else {}).get("reachable_ttl", 300)
+        self.team_reachable_nodeids[teamid] = (reachable_nodeids, version, time.time() + ttl)
+        return reachable_nodeids
+
+    def invalidate_team_reachable(self, teamid: str):
+        '''drop the cached reachable nodes of the team in this worker and bump its version for the others'''
+        self.team_reachable_nodeids.pop(teamid, None)
+        if self.tb is None: return
+        try:
+            self.tb.client.incr(self._team_graph_version_key(teamid))
+        except Exception as e:
+            logger.warning(f"bump graph version of team {teamid} failed: {e}")
+
+    def _team_graph_version(self, teamid: str) -> Optional[int]:
+        if self.tb is None: return None
+        try:
+            version = self.tb.client.get(self._team_graph_version_key(teamid))
+        except Exception as e:
+            logger.warning(f"get graph version of team {teamid} failed: {e}")
+            return None
+        return int(version) if version is not None else 0
+
+    def _team_graph_version_key(self, teamid: str) -> str:
+        return f"{self.node_indexname}:graph_version:{teamid}"
+
     def search_rootpath_by_nodeid(
             self, nodeid: str, node_type: str, rootid: str
         ) -> Graph:
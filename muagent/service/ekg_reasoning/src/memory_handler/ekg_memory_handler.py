@@ -43,10 +43,15 @@ class memory_handler_ekg():
         在图谱推理过程中使用到的 和memory相关的tool
         只包含纯用memory的函数
     '''
+    # node count 中由 HINCRBY 维护的计数字段
+    NODECOUNT_INT_KEYS = ('chapter', 'section')
+
     def __init__(self,  memory_manager, geabase_handler):
         self.geabase_handler = geabase_handler
         self.memory_manager  = memory_manager
         self.gb_handler = GB_handler(self.geabase_handler) #gb_handler 以  geabase_handler 为基础，封装了一些处理逻辑
+        # node count 存在 tbase 的 (session, node) state hash 中，用 HSET/HINCRBY 原子更新
+        self.state_handler = getattr(memory_manager, "th", None)
 
         
 
@@ -59,11 +64,7 @@ class memory_handler_ekg():
         '''
         if nodeType != 'opsgptkg_task': #如果不是任务节点，一定执行完了. 只有任务节点才能执行多次？
             return True
-        memory_manager_res= self.memory_manager.get_memory_pool_by_all({ 
-                                                        #    "chat_index": sessionId, 
-                                                           "message_index" : hash_id( nodeId, sessionId, '_count'),
-                                                          })
-        get_messages_res = memory_manager_res.get_messages()
+        get_messages_res = self.nodecount_get(sessionId, nodeId)
         if get_messages_res == []: #没有查询到count数据
             return False
         if json.loads(get_messages_res[0].role_content)['nodestage'] == 'end':
@@ -251,6 +252,18 @@ class memory_handler_ekg():
 
             #{'chapter': 2,  'section': 10 , 'allsection': '20', 'nodestage': 'running' #end # notStart}
         '''
+        if self.state_handler is not None:
+            # chapter + 1, 不存在时初始化为 chapter 1
+            # 超过 8 次时不写入, 检查和 +1 在同一个事务中完成
+            chapter = self.state_handler.state_incr(
+                sessionId, currentNodeId, 'chapter', 1, 
+                defaults={'section': 0, 'allsection': 0, 'nodestage': 'running'},
+                limit=8,
+            )
+            if chapter >= 8:
+                raise ValueError("单个节点chapter超过了8次，退出")
+            return self.nodecount_get(sessionId, currentNodeId)
+
         count_info = self.nodecount_get(sessionId, currentNodeId)
         if count_info == []:
             #所有都设置为1，状态是running
@@ -264,21 +277,21 @@ class memory_handler_ekg():
             raise ValueError("单个节点chapter超过了8次，退出")
         
         self.nodecount_set(sessionId, currentNodeId, role_content)
-
-
-        memory_manager_res= self.memory_manager.get_memory_pool_by_all({ 
-                                                        #    "chat_index": sessionId, 
-                                                           "message_index" : hash_id( currentNodeId, sessionId, '_count'),
-
-                                                          })
-        get_messages_res = memory_manager_res.get_messages()
-        return get_messages_res
+        return self.nodecount_get(sessionId, currentNodeId)
         
     def nodecount_get(self, sessionId, currentNodeId):
         '''
             得到当前node的 count数据
             #{'chapter': 2,  'section': 10 , 'allsection': '20', 'nodestage': 'running' #end # notStart}
         '''
+        if self.state_handler is not None:
+            count_info = self.state_handler.state_get(sessionId, currentNodeId)
+            if not count_info:
+                return []
+            # 只有计数字段是 int, 其余字段(如 allsection)按写入时的字符串返回
+            count_info = {k: int(v) if k in self.NODECOUNT_INT_KEYS else v for k, v in count_info.items()}
+            return [self._nodecount_message(sessionId, currentNodeId, count_info)]
+
         memory_manager_res= self.memory_manager.get_memory_pool_by_all({ 
                                                         #    "chat_index": sessionId, 
                                                            "message_index" : hash_id( currentNodeId, sessionId, '_count'),
@@ -292,11 +305,7 @@ class memory_handler_ekg():
             得到当前node的 count数据
             #{'chapter': 2,  'section': 10 , 'allsection': '20', 'nodestage': 'running' #end # notStart}
         '''
-        memory_manager_res= self.memory_manager.get_memory_pool_by_all({ 
-                                                        #    "chat_index": sessionId, 
-                                                           "message_index" : hash_id( currentNodeId, sessionId, '_count'),
-                                                          })
-        get_messages_res = memory_manager_res.get_messages()
+        get_messages_res = self.nodecount_get(sessionId, currentNodeId)
         if get_messages_res == []:
             return None
         else:
@@ -308,6 +317,10 @@ class memory_handler_ekg():
         '''
             对nodecount的某一个key进行修改
         '''
+        if self.state_handler is not None:
+            self.state_handler.state_set(sessionId, currentNodeId, {key: value})
+            return
+
         get_messages_res = self.nodecount_get( sessionId, currentNodeId)
         node_count_info  = get_messages_res[0].role_content
         node_count_info  = json.loads(node_count_info)
@@ -318,10 +331,20 @@ class memory_handler_ekg():
     def nodecount_set(self, sessionId, currentNodeId, 
         role_content={'chapter': 2,  'section': 10 , 'allsection': '20', 'nodestage': 'running' }):
 
+            if self.state_handler is not None:
+                if type(role_content) == str:
+                    role_content = json.loads(role_content)
+                self.state_handler.state_set(sessionId, currentNodeId, role_content)
+                return
+
+            message = self._nodecount_message(sessionId, currentNodeId, role_content)
+            self.memory_manager.append(message)
+
+    def _nodecount_message(self, sessionId, currentNodeId, role_content):
             if type(role_content) != str:
                 role_content = json.dumps(role_content, ensure_ascii=False)
             hashpostfix_all = '_count'
-            message = Message(
+            return Message(
                 chat_index= sessionId,  
                 message_index=  hash_id(currentNodeId, sessionId, hashpostfix_all),  
                 user_name =  hash_id(currentNodeId),
@@ -329,9 +352,17 @@ class memory_handler_ekg():
                 role_type = 'None', 
                 role_content = role_content, 
             )
-            self.memory_manager.append(message)
     
     def tool_nodecount_add_chapter(self, sessionId, currentNodeId):
+        if self.state_handler is not None:
+            # chapter + 1, 不存在时初始化为 chapter 1 且状态是 end
+            chapter = self.state_handler.state_incr(
+                sessionId, currentNodeId, 'chapter', 1, 
+                defaults={'section': 1, 'allsection': '1', 'nodestage': 'end'}
+            )
+            logging.info(f'节点{sessionId} 的 chapter现在是{chapter}')
+            return
+
         count_res =  self.nodecount_get(sessionId, currentNodeId) 
         if count_res == []:
             count_info = {'chapter': 1,  'section': 1 , 'allsection': '1', 'nodestage': 'end' }
@@ -527,10 +558,7 @@ class memory_handler_ekg():
             self.memory_manager.append(message)
         
         #3. 更新section,覆盖式更新
-        node_count_res = self.nodecount_get( sessionId, currentNodeId)
-        role_content_nodeinfo = json.loads(node_count_res[0].role_content)
-        role_content_nodeinfo['section'] = len(memory_save_info_list)  
-        self.nodecount_set( sessionId, currentNodeId, role_content_nodeinfo)
+        self.nodecount_set_key( sessionId, currentNodeId, 'section', len(memory_save_info_list))
 
     def react_current_history_save(self, sessionId, currentNodeId, role_content):
             hashpostfix = '_his'
@@ -0,0 +1,72 @@
+import sys, os
+
+src_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+sys.path.append(src_dir)
+from muagent.db_handler.utils import bfs_hop_traversal
+
+
+def make_expand(adjacency: dict, calls: list = None):
+    def _expand(frontier):
+        if calls is not None:
+            calls.append(list(frontier))
+        return [(parent, child, (parent, child)) for parent in frontier for child in adjacency.get(parent, [])]
+    return _expand
+
+
+def test_paths_and_visit_order():
+    adjacency = {"a": ["b", "c"], "b": ["d"], "c": []}
+    visited, edges, paths = bfs_hop_traversal(["a"], make_expand(adjacency), hop=3)
+    assert visited == ["a", "b", "c", "d"]
+    assert sorted(edges) == [("a", "b"), ("a", "c"), ("b", "d")]
+    assert sorted(paths) == [["a", "b", "d"], ["a", "c"]]
+
+
+def test_diamond_keeps_every_path():
+    # a->b->d and a->c->d both reach d, nebula returns both paths
+    adjacency = {"a": ["b", "c"], "b": ["d"], "c": ["d"], "d": ["e"]}
+    calls = []
+    visited, edges, paths = bfs_hop_traversal(["a"], make_expand(adjacency, calls), hop=3)
+    assert visited == ["a", "b", "c", "d", "e"]
+    assert sorted(edges) == [("a", "b"), ("a", "c"), ("b", "d"), ("c", "d"), ("d", "e")]
+    assert sorted(paths) == [["a", "b", "d", "e"], ["a", "c", "d", "e"]]
+    # d is expanded once for both paths
+    assert calls == [["a"], ["b", "c"], ["d"]]
+
+
+def test_diamond_chain_expands_each_node_once():
+    # every level has two nodes linked to both nodes of the next level,
+    # the paths multiply but the neighbor queries do not
+    levels = 10
+    adjacency = {"root": ["0_0", "0_1"]}
+    for level in range(levels - 1):
+        for i in range(2):
+            adjacency[f"{level}_{i}"] = [f"{level + 1}_0", f"{level + 1}_1"]
+    calls = []
+    visited, edges, paths = bfs_hop_traversal(["root"], make_expand(adjacency, calls), hop=levels)
+
+    assert len(visited) == 2 * levels + 1
+    # each node is expanded once
+    expanded = [i for frontier in calls for i in frontier]
+    assert len(expanded) == len(set(expanded))
+    assert len(edges) == sum(len(v) for v in adjacency.values())
+    # every root to leaf path is returned
+    assert len(paths) == 2 ** levels
+    assert len(set(map(tuple, paths))) == len(paths)
+    assert all(len(path) == levels + 1 for path in paths)
+
+
+def test_hop_limit_cycles_and_blocked_nodes():
+    adjacency = {"a": ["b", "x"], "b": ["c", "a"], "c": ["d"]}
+    visited, edges, paths = bfs_hop_traversal(["a"], make_expand(adjacency), hop=2, is_blocked=lambda i: i == "x")
+    assert visited == ["a", "b", "c"]
+    assert ("a", "x") not in edges
+    # the edge back to the root is kept, the cycle is not followed
+    assert ("b", "a") in edges
+    assert paths == [["a", "b", "c"]]
+
+
+def test_no_neighbors():
+    visited, edges, paths = bfs_hop_traversal(["a", "a"], make_expand({}), hop=2)
+    assert visited == ["a"] and edges == [] and paths == []
@@ -0,0 +1,70 @@
+import sys, os, time
+
+src_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+sys.path.append(src_dir)
+from muagent.db_handler import NetworkxHandler
+from muagent.db_handler.graph_db_handler.cached_gb_handler import LRUTTLCache, CachedGBHandler
+from muagent.schemas.common import GNode, GRelation
+
+
+def test_lru_eviction():
+    cache = LRUTTLCache(maxsize=2, ttl=0)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == (True, 1)
+    # b is the least recently used one
+    cache.set("c", 3)
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, 1) and cache.get("c") == (True, 3)
+    assert len(cache) == 2
+    assert cache.hits == 3 and cache.misses == 1
+
+
+def test_ttl_expiry():
+    cache = LRUTTLCache(maxsize=10, ttl=0.05)
+    cache.set("a", 1, tags={"t"})
+    assert cache.get("a") == (True, 1)
+    time.sleep(0.1)
+    assert cache.get("a") == (False, None)
+    # the expired entry and its tags are dropped
+    assert len(cache) == 0 and cache.invalidate({"t"}) == 0
+
+
+def test_tag_invalidation():
+    cache = LRUTTLCache(maxsize=10, ttl=0)
+    cache.set("a", 1, tags={"n1", "n2"})
+    cache.set("b", 2, tags={"n2"})
+    cache.set("c", 3, tags={"n3"})
+    assert cache.invalidate({"n2"}) == 2
+    assert cache.get("a")[0] is False and cache.get("b")[0] is False
+    assert cache.get("c") == (True, 3)
+    # overwriting an entry replaces its tags
+    cache.set("c", 4, tags={"n4"})
+    assert cache.invalidate({"n3"}) == 0
+    assert cache.invalidate({"n4"}) == 1
+
+
+class RacingHandler(NetworkxHandler):
+    '''reads through the cache while its own write is in flight, like a concurrent request would'''
+    cached: CachedGBHandler = None
+
+    def add_edges(self, edges):
+        self.cached.get_neighbor_nodes({"id": "n1"})
+        return super().add_edges(edges)
+
+
+def test_write_invalidates_after_backend_write(tmp_path):
+    backend = RacingHandler(str(tmp_path))
+    cached = CachedGBHandler(backend, maxsize=100, ttl=0)
+    backend.cached = cached
+    cached.add_nodes([GNode(id=i, type="opsgptkg_task", attributes={"name": i}) for i in ["n1", "n2"]])
+
+    assert cached.get_neighbor_nodes({"id": "n1"}) == []
+    cached.add_edges([GRelation(start_id="n1", end_id="n2", attributes={})])
+    # the result cached during the write is stale and must not survive it
+    assert [node.id for node in cached.get_neighbor_nodes({"id": "n1"})] == ["n2"]
+    assert cached.cache_info()["hits"] == 0
+    assert [node.id for node in cached.get_neighbor_nodes({"id": "n1"})] == ["n2"]
+    assert cached.cache_info()["hits"] == 1
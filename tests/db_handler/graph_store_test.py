@@ -0,0 +1,138 @@
+import sys, os
+from array import array
+
+src_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+sys.path.append(src_dir)
+from muagent.db_handler.graph_db_handler.graph_store import CSRGraphStore
+from muagent.db_handler import NetworkxHandler
+from muagent.schemas.common import GNode, GRelation
+
+
+def build_store(compact_threshold: int = 1024) -> CSRGraphStore:
+    store = CSRGraphStore(compact_threshold=compact_threshold)
+    for nodeid in ["a", "b", "c", "d"]:
+        store.upsert_node(nodeid, "opsgptkg_task", {"ID": hash(nodeid), "name": nodeid})
+    for src, dst in [("a", "b"), ("a", "c"), ("b", "d"), ("c", "d")]:
+        store.upsert_edge(store.node_index(src), store.node_index(dst), "next", {"name": f"{src}{dst}"})
+    return store
+
+
+def neighbor_ids(store: CSRGraphStore, nodeid: str, reverse: bool = False):
+    return sorted(store.nodeids[idx] for _, idx in store.neighbors(store.node_index(nodeid), reverse))
+
+
+def test_add_nodes_and_edges():
+    store = build_store()
+    assert store.node_count == 4 and store.edge_count == 4
+    assert neighbor_ids(store, "a") == ["b", "c"]
+    assert neighbor_ids(store, "d", reverse=True) == ["b", "c"]
+    assert store.find_nodes({"name": "c"}) == [store.node_index("c")]
+    # upsert of an existing edge updates it in place
+    eidx = store.upsert_edge(store.node_index("a"), store.node_index("b"), "next", {"name": "ab2"})
+    assert store.edge_count == 4
+    assert store.edge_attributes(eidx)["name"] == "ab2"
+
+
+def test_delete_node_and_edge():
+    store = build_store()
+    store.remove_edge(store.edge_index(store.node_index("a"), store.node_index("b")))
+    assert neighbor_ids(store, "a") == ["c"]
+    assert store.edge_count == 3
+
+    store.remove_node(store.node_index("d"))
+    assert store.node_index("d") == -1
+    assert not store.has_node("d")
+    assert neighbor_ids(store, "b") == [] and neighbor_ids(store, "c") == []
+    assert store.find_nodes({"name": "d"}) == []
+
+
+def test_csr_compile_keeps_adjacency():
+    # a tiny threshold forces the delta adjacency to be compiled into CSR and deleted edges to be compacted
+    store = build_store(compact_threshold=1)
+    store.remove_edge(store.edge_index(store.node_index("a"), store.node_index("c")))
+    store.compact()
+    store.upsert_edge(store.node_index("d"), store.node_index("a"), "next", {})
+    assert neighbor_ids(store, "a") == ["b"]
+    assert neighbor_ids(store, "a", reverse=True) == ["d"]
+    assert neighbor_ids(store, "d", reverse=True) == ["b", "c"]
+
+
+def test_networkx_add_edges_continues_past_missing_nodes(tmp_path):
+    nh = NetworkxHandler(str(tmp_path))
+    nh.add_nodes([GNode(id="node1", type="opsgptkg_task", attributes={"name": "test"})])
+    status = nh.add_edges([
+        GRelation(start_id="node1", end_id="node2", attributes={"name": "e1"}),
+        GRelation(start_id="node3", end_id="node1", attributes={"name": "e2"}),
+    ])
+    assert status.errorCode == 0
+    assert [res.errorCode for res in status.results] == [0, 0]
+    # missing endpoints are created and every edge is added
+    assert nh.search_nodes_by_nodeid("node2") is not None
+    assert nh.search_nodes_by_nodeid("node3") is not None
+    assert len(nh.search_edges_by_nodeid("node1")) == 2
+
+
+def test_snapshot_and_delta_log_roundtrip(tmp_path):
+    store = build_store()
+    store.journal = []
+    store.save_snapshot(str(tmp_path))
+
+    # writes after the snapshot only go to the delta log
+    store.remove_edge(store.edge_index(store.node_index("a"), store.node_index("b")))
+    store.upsert_node("e", "opsgptkg_task", {"ID": hash("e"), "name": "e"})
+    store.upsert_edge(store.node_index("d"), store.node_index("e"), "next", {"name": "de"})
+    store.update_node(store.node_index("a"), {"name": "a2"})
+    store.append_log(str(tmp_path))
+
+    for mmap in [True, False]:
+        loaded = CSRGraphStore()
+        assert loaded.load_snapshot(str(tmp_path), mmap=mmap)
+        assert loaded.log_size == 4
+        assert loaded.node_count == 5 and loaded.edge_count == 4
+        assert neighbor_ids(loaded, "a") == ["c"]
+        assert neighbor_ids(loaded, "e", reverse=True) == ["d"]
+        assert loaded.find_nodes({"name": "a2"}) == [loaded.node_index("a")]
+
+    assert not CSRGraphStore().load_snapshot(str(tmp_path / "missing"))
+
+
+def test_snapshot_versions_are_switched_atomically(tmp_path):
+    store = build_store()
+    store.journal = []
+    store.save_snapshot(str(tmp_path))
+    first = store.snapshot_path(str(tmp_path))
+    store.upsert_node("e", "opsgptkg_task", {"ID": hash("e"), "name": "e"})
+    store.append_log(str(tmp_path))
+
+    # a crash while writing the next snapshot leaves a version that CURRENT does not name
+    (tmp_path / f"{CSRGraphStore.SNAPSHOT_PREFIX}0").mkdir()
+    (tmp_path / f"{CSRGraphStore.SNAPSHOT_PREFIX}0" / "edge_src.npy").write_bytes(b"torn")
+    loaded = CSRGraphStore()
+    assert loaded.load_snapshot(str(tmp_path))
+    assert loaded.node_count == 5 and loaded.log_size == 1
+
+    # the new snapshot starts its own empty log, the old version and its log are removed
+    store.save_snapshot(str(tmp_path))
+    second = store.snapshot_path(str(tmp_path))
+    assert second != first and not os.path.exists(first)
+    assert sorted(os.listdir(tmp_path)) == sorted([CSRGraphStore.CURRENT, os.path.basename(second)])
+    loaded = CSRGraphStore()
+    assert loaded.load_snapshot(str(tmp_path))
+    assert loaded.node_count == 5 and loaded.log_size == 0
+
+
+def test_mmap_edges_are_copied_on_first_write(tmp_path):
+    store = build_store()
+    store.journal = []
+    store.save_snapshot(str(tmp_path))
+
+    loaded = CSRGraphStore()
+    loaded.load_snapshot(str(tmp_path), mmap=True)
+    assert not isinstance(loaded.edge_src, array)
+    assert neighbor_ids(loaded, "a") == ["b", "c"]
+    loaded.upsert_edge(loaded.node_index("d"), loaded.node_index("a"), "next", {})
+    assert isinstance(loaded.edge_src, array)
+    assert neighbor_ids(loaded, "a", reverse=True) == ["d"]
+    assert loaded.edge_index(loaded.node_index("a"), loaded.node_index("b"), "next") >= 0
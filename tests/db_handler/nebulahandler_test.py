@@ -104,6 +104,18 @@ if __name__ == '__main__':
     # res = nebula.add_nodes([node1,node2,node3])
     # logger.info(res)
 
+    # 分块写入, 每条 INSERT VERTEX 最多包含2个节点, res.results 为逐个节点的状态
+    # res = nebula.add_nodes([node1,node2,node3], batch_size=2)
+    # logger.info(res.results)
+
+
+    ##### 一次请求执行多条语句 #####
+    # res = nebula.execute_many([
+    #     f'UPDATE VERTEX ON {node1.type} "{node1.id}" SET name = "开始"',
+    #     f'UPDATE VERTEX ON {node2.type} "{node2.id}" SET name = "中间"',
+    # ])
+    # logger.info(res)
+
 
     ##### 更新node #####
     # print({"id":node3.id}, node3.attributes, node3.type, node3.id)
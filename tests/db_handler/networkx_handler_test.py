@@ -15,10 +15,10 @@ from muagent.db_handler import NetworkxHandler
 from muagent.schemas.common import GNode, GRelation
 
 
-node1 = GNode(**{"id": "node1", "attributes": {"name": "test" }})
-node2 = GNode(**{"id": "node2", "attributes": {"name": "test" }})
-node3 = GNode(**{"id": "node3", "attributes": {"name": "test3" }})
-node4 = GNode(**{"id": "node4", "attributes": {"name": "test3" }})
+node1 = GNode(**{"id": "node1", "type": "opsgptkg_task", "attributes": {"name": "test" }})
+node2 = GNode(**{"id": "node2", "type": "opsgptkg_task", "attributes": {"name": "test" }})
+node3 = GNode(**{"id": "node3", "type": "opsgptkg_task", "attributes": {"name": "test3" }})
+node4 = GNode(**{"id": "node4", "type": "opsgptkg_task", "attributes": {"name": "test3" }})
 
 edge1 = GRelation(**{"start_id": "node1", "end_id": "node2", "attributes": {"id": "edge1", "name": "test" }})
 edge2 = GRelation(**{"start_id": "node2", "end_id": "node3", "attributes": {"id": "edge2", "name": "test2" }})
@@ -43,9 +43,20 @@ print("search by attr")
 print(nh.search_nodes_by_attr(**{"name": "test3"}))
 print(nh.search_edges_by_attr(**{"name": "test2"}))
 
+# 
+print("search by GBHandler api")
+print(nh.get_current_nodes({"name": "test3"}, node_type="opsgptkg_task"))
+print(nh.get_neighbor_nodes({"id": "node1"}))
+print(nh.get_hop_infos({"id": "node1"}, hop=2))
+print(nh.fetch_nodes_by_ids([nh.search_nodes_by_nodeid("node1").attributes["ID"], -1], chunk_size=1))
+
 # 
 print("save to local")
 nh.save_to_local("networkx_test")
+# 只追加delta log
+nh.save_to_local("networkx_test")
+# graphml export
+# nh.export_graphml(os.path.join(nh.kb_root_path, "networkx_test", "graph.graphml"))
 
 #
 print("clear cache for search by attr")
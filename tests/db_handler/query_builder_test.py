@@ -0,0 +1,49 @@
+import sys, os
+
+src_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+sys.path.append(src_dir)
+from muagent.db_handler.graph_db_handler.query_builder import NebulaQueryBuilder, GeaBaseQueryBuilder
+
+
+def test_nebula_literal_escaping():
+    qb = NebulaQueryBuilder()
+    assert qb.literal('say "hi"\n') == '"say \\"hi\\"\\n"'
+    assert qb.literal("a\\b\t") == '"a\\\\b\\t"'
+    assert qb.literal(None) == "NULL"
+    assert qb.literal(3) == "3"
+
+
+def test_nebula_insert_vertex_escapes_values_and_reuses_template():
+    qb = NebulaQueryBuilder()
+    stmt = qb.insert_vertex("task", ("name", "ID"), [("n1", {"name": 'a"b', "ID": 1}), ("n2", {"ID": 2})])
+    assert stmt == 'INSERT VERTEX task (name,ID) VALUES "n1":("a\\"b",1), "n2":(NULL,2);'
+
+    qb.insert_vertex("task", ("name", "ID"), [("n3", {"name": "c", "ID": 3})])
+    assert qb.cache_info()["misses"] == 1 and qb.cache_info()["hits"] == 1
+
+
+def test_nebula_match_nodes_is_parameterized():
+    qb = NebulaQueryBuilder()
+    stmt, params = qb.match_nodes("task", {"name": 'x" OR 1=1'})
+    assert 'x" OR 1=1' not in stmt
+    assert params == {"p0": 'x" OR 1=1'}
+    assert stmt == (
+        'MATCH (n0:task) WITH n0, properties(n0) as props, keys(properties(n0)) as kk'
+        ' WHERE [i IN kk WHERE props["name"] == $p0] RETURN n0'
+    )
+
+
+def test_geabase_literal_escaping():
+    qb = GeaBaseQueryBuilder()
+    assert qb.literal("it's") == "'it\\'s'"
+    assert qb.literal(True) == "'True'"
+    assert qb.update_node("task", 7, {"name": "o'k"}) == "MATCH (n:task) WHERE n.@ID=7 SET n.name='o\\'k'"
+
+
+def test_geabase_match_neighbors():
+    qb = GeaBaseQueryBuilder()
+    assert qb.match_neighbors([1, 2]) == "MATCH (n0 WHERE @id in [1, 2])-[e]->(n1) RETURN n0, n1, e"
+    assert qb.match_neighbors([3], reverse=True) == "MATCH (n0 WHERE @id in [3])<-[e]-(n1) RETURN n0, n1, e"
+    assert qb.match_neighbors([1], return_edges=False) == "MATCH (n0 WHERE @id in [1])-[e]->(n1) RETURN n1"
@@ -0,0 +1,45 @@
+import sys, os
+import threading
+
+import fakeredis
+
+src_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+sys.path.append(src_dir)
+from muagent.db_handler.vector_db_handler.tbase_handler import TbaseHandler
+from muagent.schemas.db import TBConfig
+
+
+def fake_handler() -> TbaseHandler:
+    tb_config = TBConfig(
+        tb_type="TbaseHandler", index_name="test_index", host="localhost", port="6379",
+        username="default", password=""
+    )
+    th = TbaseHandler(tb_config, "test_index", definition_value="message")
+    th.client = fakeredis.FakeRedis()
+    return th
+
+
+def test_state_incr_with_defaults():
+    th = fake_handler()
+    assert th.state_incr("s1", "n1", "chapter", 1, defaults={"section": 0, "nodestage": "running"}) == 1
+    assert th.state_incr("s1", "n1", "chapter", 1, defaults={"section": 5, "nodestage": "end"}) == 2
+    # defaults never overwrite existing fields
+    assert th.state_get("s1", "n1") == {"chapter": "2", "section": "0", "nodestage": "running"}
+
+
+def test_state_incr_limit_is_atomic():
+    th = fake_handler()
+    results = []
+
+    def worker():
+        for _ in range(5):
+            results.append(th.state_incr("s1", "n1", "chapter", 1, limit=8))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    # exactly 7 increments got under the limit, the rejected ones wrote nothing
+    assert sorted(v for v in results if v < 8) == list(range(1, 8))
+    assert th.state_get("s1", "n1", "chapter") == "7"
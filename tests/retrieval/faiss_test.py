@@ -0,0 +1,304 @@
+import sys, os, gc, zlib, threading
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_community.docstore.document import Document
+
+src_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+sys.path.append(src_dir)
+from muagent.retrieval.faiss_m import FAISS
+from muagent.retrieval import faiss_wal
+from muagent.retrieval.faiss_wal import get_faiss_wal, checkpoint_path, has_checkpoint
+
+
+class HashEmbeddings(Embeddings):
+    '''deterministic text -> vector embeddings for tests'''
+    dim = 8
+
+    def embed_query(self, text: str):
+        return np.random.default_rng(zlib.crc32(text.encode())).random(self.dim).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+def empty_store(embeddings: Embeddings, **kwargs) -> FAISS:
+    store = FAISS.from_documents([Document(page_content="init", metadata={})], embeddings, **kwargs)
+    store.delete(list(store.docstore._dict))
+    return store
+
+
+def load_store(vs_path: str, embeddings: Embeddings) -> FAISS:
+    if has_checkpoint(vs_path):
+        return FAISS.load_local(checkpoint_path(vs_path), embeddings)
+    return empty_store(embeddings)
+
+
+def add_texts(store: FAISS, embeddings: Embeddings, texts, metadatas=None):
+    return store.add_embeddings(zip(texts, embeddings.embed_documents(texts)), metadatas=metadatas)
+
+
+def docs_of(texts, source: str = "a.txt"):
+    return [Document(page_content=text, metadata={"source": source}) for text in texts]
+
+
+def test_wal_replay_after_crash(tmp_path):
+    embeddings = HashEmbeddings()
+    vs_path = str(tmp_path / "vs")
+    wal = get_faiss_wal(vs_path, checkpoint_interval=0)
+    store = empty_store(embeddings)
+    ids = wal.add_documents(store, docs_of(["a", "b", "c"]), embeddings.embed_documents)
+    wal.delete(store, ids[:1])
+    # a torn tail write is dropped on replay
+    with open(os.path.join(wal.vs_path, wal.WAL_LOG), "a") as f:
+        f.write('{"op": "add", "ids"')
+
+    # no checkpoint was written, a new process rebuilds the store from the log
+    recovered = load_store(vs_path, embeddings)
+    assert wal.replay(recovered) == 2
+    assert sorted(doc.page_content for doc in recovered.docstore._dict.values()) == ["b", "c"]
+    # replay is idempotent
+    assert wal.replay(recovered) == 2
+    assert len(recovered.docstore._dict) == 2
+    wal.reset()
+
+
+def test_wal_checkpoint_is_versioned_and_unbinds_store(tmp_path):
+    embeddings = HashEmbeddings()
+    vs_path = str(tmp_path / "vs")
+    wal = get_faiss_wal(vs_path, checkpoint_interval=0)
+    store = empty_store(embeddings)
+    wal.add_documents(store, docs_of(["a", "b"]), embeddings.embed_documents)
+    assert wal.search_index is store and wal.pending_ops == 1
+
+    assert wal.checkpoint()
+    first = checkpoint_path(wal.vs_path)
+    assert wal.search_index is None and wal.pending_ops == 0
+    assert not os.path.exists(os.path.join(wal.vs_path, wal.WAL_LOG))
+    assert os.path.basename(first).startswith(faiss_wal.CHECKPOINT_PREFIX)
+
+    wal.add_documents(store, docs_of(["c"]), embeddings.embed_documents)
+    assert wal.checkpoint()
+    second = checkpoint_path(wal.vs_path)
+    # CURRENT switched to the new version and the old one is removed
+    assert second != first and not os.path.exists(first)
+    assert len(load_store(vs_path, embeddings).docstore._dict) == 3
+
+
+def test_wal_background_checkpoint_and_eviction(tmp_path):
+    embeddings = HashEmbeddings()
+    vs_path = str(tmp_path / "vs")
+    wal = get_faiss_wal(vs_path, checkpoint_interval=0, checkpoint_ops=2)
+    store = empty_store(embeddings)
+    wal.add_documents(store, docs_of(["a"]), embeddings.embed_documents)
+    wal.add_documents(store, docs_of(["b"]), embeddings.embed_documents)
+
+    # checkpoint_ops reached, the shared checkpoint thread saves the store
+    for _ in range(100):
+        if has_checkpoint(vs_path): break
+        faiss_wal._WAKEUP.wait(0.05)
+    assert has_checkpoint(vs_path)
+    assert wal.vs_path not in faiss_wal._DIRTY
+
+    # an idle, unreferenced wal is dropped from the registry
+    key = wal.vs_path
+    del wal
+    gc.collect()
+    assert key not in faiss_wal._WALS
+
+
+def test_wal_load_is_shared_and_locked(tmp_path):
+    embeddings = HashEmbeddings()
+    vs_path = str(tmp_path / "vs")
+    wal = get_faiss_wal(vs_path, checkpoint_interval=0)
+    store = empty_store(embeddings)
+    wal.add_documents(store, docs_of(["a", "b"]), embeddings.embed_documents)
+    wal.checkpoint()
+    wal.add_documents(store, docs_of(["c"]), embeddings.embed_documents)
+    del store
+    wal.checkpoint()
+    gc.collect()
+
+    entered, release = threading.Event(), threading.Event()
+    loads = []
+
+    def loader(checkpoint):
+        loads.append(checkpoint)
+        entered.set()
+        release.wait(5)
+        return FAISS.load_local(checkpoint, embeddings)
+
+    result = []
+    t = threading.Thread(target=lambda: result.append(wal.load(loader)))
+    t.start()
+    entered.wait(5)
+    # a checkpoint can not switch CURRENT under a running load
+    c = threading.Thread(target=wal.checkpoint, kwargs={"force": True})
+    c.start()
+    c.join(0.2)
+    assert c.is_alive()
+    release.set()
+    t.join(); c.join()
+    assert len(result[0].docstore._dict) == 3
+
+    # later loads share the live store without reading the checkpoint again
+    assert wal.load(loader) is result[0] and len(loads) == 1
+
+
+def test_stable_ids_and_delete():
+    embeddings = HashEmbeddings()
+    store = empty_store(embeddings)
+    ids = add_texts(store, embeddings, ["a", "b", "c"], metadatas=[{"source": "x.txt"}, {"source": "y.txt"}, {"source": "x.txt"}])
+    faiss_ids = dict(store._docstore_id_to_index)
+
+    store.delete([ids[1]])
+    # the other docs keep their faiss ids and deleted ids are not reused
+    assert {id_: faiss_ids[id_] for id_ in [ids[0], ids[2]]} == store._docstore_id_to_index
+    new_id = add_texts(store, embeddings, ["d"], metadatas=[{"source": "y.txt"}])[0]
+    assert store._docstore_id_to_index[new_id] > max(faiss_ids.values())
+    assert store.get_ids_by_metadata("source", "y.txt") == [new_id]
+    assert sorted(store.get_ids_by_metadata("source", "x.txt")) == sorted([ids[0], ids[2]])
+
+    doc, score = store.similarity_search_with_score("c", k=1)[0]
+    assert doc.page_content == "c" and score < 1e-5
+    try:
+        store.delete([ids[1]])
+        assert False, "deleting a missing id should fail"
+    except ValueError:
+        pass
+
+
+def test_prefiltered_search():
+    embeddings = HashEmbeddings()
+    texts = [f"doc{i}" for i in range(40)]
+    metadatas = [{"source": f"{i % 4}.txt", "page": i} for i in range(40)]
+    for prefilter_exact_size in [4096, 0]:
+        # 0 searches the index with an IDSelector instead of comparing the candidates directly
+        store = empty_store(embeddings, prefilter_exact_size=prefilter_exact_size)
+        add_texts(store, embeddings, texts, metadatas)
+        docs = store.similarity_search_with_score("doc5", k=5, filter={"source": "1.txt"})
+        assert len(docs) == 5
+        assert docs[0][0].page_content == "doc5"
+        assert all(doc.metadata["source"] == "1.txt" for doc, _ in docs)
+        # keys outside metadata_index_keys are still checked per doc
+        docs = store.similarity_search_with_score("doc5", k=5, filter={"source": "1.txt", "page": 9})
+        assert [doc.page_content for doc, _ in docs] == ["doc9"]
+
+
+class QueryEmbeddings(HashEmbeddings):
+    '''embeds documents differently from queries, like models with a query instruction'''
+
+    def embed_documents(self, texts):
+        return [self.embed_query(f"passage: {text}") for text in texts]
+
+
+def test_batch_search_matches_search():
+    from muagent.db_handler.vector_db_handler.local_faiss_handler import LocalFaissHandler
+    embeddings = QueryEmbeddings()
+    handler = LocalFaissHandler.__new__(LocalFaissHandler)
+    handler.embeddings = embeddings
+    handler.search_index = empty_store(embeddings)
+    add_texts(handler.search_index, embeddings, [f"doc{i}" for i in range(20)])
+
+    queries = ["doc1", "doc7", "something else"]
+    batch = handler.batch_search(queries, top_k=3, score_threshold=100)
+    for query, docs in zip(queries, batch):
+        single = handler.search(query, top_k=3, score_threshold=100)
+        assert [doc.page_content for doc, _ in docs] == [doc.page_content for doc, _ in single]
+        assert np.allclose([score for _, score in docs], [score for _, score in single])
+
+
+def top_texts(store: FAISS, query: str, k: int = 3, **kwargs):
+    return [doc.page_content for doc, _ in store.similarity_search_with_score(query, k=k, **kwargs)]
+
+
+def test_ivf_flat_train_search_delete_reload(tmp_path):
+    import faiss
+    embeddings = HashEmbeddings()
+    store = empty_store(embeddings, index_factory="IVF4,Flat", train_size=64, retrain_ratio=2, nprobe=4)
+    ids = add_texts(store, embeddings, [f"doc{i}" for i in range(40)])
+    # below train_size the store stays flat
+    assert faiss.try_extract_index_ivf(store.index) is None and store.trained_size == 0
+    ids += add_texts(store, embeddings, [f"doc{i}" for i in range(40, 100)])
+    assert faiss.try_extract_index_ivf(store.index) is not None and store.trained_size == 100
+    # nprobe == nlist searches every list
+    assert top_texts(store, "doc7", k=1) == ["doc7"]
+    assert top_texts(store, "doc7", k=1, nprobe=1)[0].startswith("doc")
+
+    store.delete(ids[7:8])
+    assert "doc7" not in top_texts(store, "doc7", k=5)
+    store.save_local(str(tmp_path))
+    loaded = FAISS.load_local(str(tmp_path), embeddings, index_factory="IVF4,Flat", train_size=64, retrain_ratio=2, nprobe=4)
+    assert loaded.trained_size == 100
+    assert top_texts(loaded, "doc42") == top_texts(store, "doc42")
+
+    # the store grew to retrain_ratio times its training size, lossless codes are retrained
+    add_texts(loaded, embeddings, [f"doc{i}" for i in range(100, 201)])
+    assert loaded.trained_size == 200
+    assert top_texts(loaded, "doc150", k=1) == ["doc150"]
+
+
+def test_hnsw_train_search_delete_reload(tmp_path):
+    embeddings = HashEmbeddings()
+    store = empty_store(embeddings, index_factory="HNSW8", train_size=16, efSearch=64)
+    ids = add_texts(store, embeddings, [f"doc{i}" for i in range(50)])
+    assert store.trained_size == 50
+    assert top_texts(store, "doc3", k=1) == ["doc3"]
+    assert top_texts(store, "doc3", k=1, efSearch=16) == ["doc3"]
+
+    store.delete(ids[3:4])
+    assert "doc3" not in top_texts(store, "doc3", k=5)
+    assert len(store.docstore._dict) == 49
+    store.save_local(str(tmp_path))
+    loaded = FAISS.load_local(str(tmp_path), embeddings, index_factory="HNSW8", train_size=16, efSearch=64)
+    assert "doc3" not in top_texts(loaded, "doc3", k=5)
+    assert top_texts(loaded, "doc30", k=1) == ["doc30"]
+
+
+def test_hnsw_delete_tombstones_until_ratio(tmp_path):
+    embeddings = HashEmbeddings()
+    store = empty_store(embeddings, index_factory="HNSW8", train_size=16, efSearch=64, max_tombstone_ratio=0.1)
+    ids = add_texts(store, embeddings, [f"doc{i}" for i in range(50)])
+    index = store.index
+
+    # deletes below the ratio keep the graph, the ids are filtered at search time
+    store.delete(ids[:3])
+    assert store.index is index and store.index.ntotal == 50
+    deleted = set(store._tombstones)
+    assert len(deleted) == 3 and not deleted & set(store.index_to_docstore_id)
+    assert "doc1" not in top_texts(store, "doc1", k=5)
+    assert top_texts(store, "doc30", k=1) == ["doc30"]
+    assert top_texts(store, "doc30", k=1, filter={"source": "nope"}) == []
+
+    # reloaded stores recover the tombstones and never reuse their ids
+    store.save_local(str(tmp_path))
+    loaded = FAISS.load_local(str(tmp_path), embeddings, index_factory="HNSW8", train_size=16,
+                              efSearch=64, max_tombstone_ratio=0.1)
+    assert loaded._tombstones == deleted
+    assert "doc1" not in top_texts(loaded, "doc1", k=5)
+    next_id = loaded._next_id
+    add_texts(loaded, embeddings, ["doc50"])
+    assert next_id > max(deleted | set(store.index_to_docstore_id)) and next_id in loaded.index_to_docstore_id
+    assert top_texts(loaded, "doc50", k=1) == ["doc50"]
+
+    # past the ratio the index is refilled with the remaining vectors
+    store.delete(ids[3:6])
+    assert store.index is not index and store.index.ntotal == 44
+    assert not store._tombstones
+    assert "doc4" not in top_texts(store, "doc4", k=5)
+    assert top_texts(store, "doc30", k=1) == ["doc30"]
+
+
+def test_failed_training_stays_flat():
+    import faiss
+    embeddings = HashEmbeddings()
+    # pq needs 256 training points
+    store = empty_store(embeddings, index_factory="IVF4,PQ4", train_size=16)
+    add_texts(store, embeddings, [f"doc{i}" for i in range(32)])
+    assert faiss.try_extract_index_ivf(store.index) is None
+    assert store.trained_size == 0 and store.train_size == 64
+    assert top_texts(store, "doc9", k=1) == ["doc9"]
+    # quantized codes are never retrained
+    assert not store._retrainable()